@@ -0,0 +1,77 @@
+"""Benchmark token2wav of the tiny CosyVoice2 model on cpu, eager against load_compiled, as rtf of the flow and hift.
+
+    python benchmarks/bench_compile.py --num_tokens 200 --max_mel_len 600
+
+The speech tokens are fixed, so the llm is not part of the timing. The first run compiles every bucket into
+--compile_cache_dir, run it again to see the warm start.
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from tiny_model import SAMPLE_RATE, SPEECH_TOKEN_SIZE, make_model_input, make_tiny_model  # noqa
+
+
+def token2wav(model, tokens, model_input, stream):
+    """the token2wav calls of CosyVoice2Model.tts once every token is decoded, returns the speech"""
+    this_uuid = str(uuid.uuid1())
+    model.hift_cache_dict[this_uuid] = None
+    prompt_token, speech = model_input['flow_prompt_speech_token'], []
+    kwargs = {'prompt_token': prompt_token, 'prompt_feat': model_input['prompt_speech_feat'],
+              'embedding': model_input['flow_embedding'], 'uuid': this_uuid}
+    token_offset = 0
+    if stream is True:
+        prompt_token_pad = int(np.ceil(prompt_token.shape[1] / model.token_hop_len) * model.token_hop_len - prompt_token.shape[1])
+        while True:
+            this_token_hop_len = model.token_hop_len + prompt_token_pad if token_offset == 0 else model.token_hop_len
+            if tokens.shape[1] - token_offset < this_token_hop_len + model.flow.pre_lookahead_len:
+                break
+            speech.append(model.token2wav(tokens[:, :token_offset + this_token_hop_len + model.flow.pre_lookahead_len],
+                                          token_offset=token_offset, stream=True, finalize=False, **kwargs))
+            token_offset += this_token_hop_len
+    speech.append(model.token2wav(tokens, token_offset=token_offset, finalize=True, **kwargs))
+    model.hift_cache_dict.pop(this_uuid)
+    return torch.concat(speech, dim=1)
+
+
+def measure(model, tokens, model_input, stream, num_runs):
+    times = []
+    for _ in range(num_runs):
+        start_time = time.perf_counter()
+        speech = token2wav(model, tokens, model_input, stream)
+        times.append(time.perf_counter() - start_time)
+    return speech, min(times) / (speech.shape[1] / SAMPLE_RATE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark load_compiled on cpu')
+    parser.add_argument('--num_tokens', type=int, default=200)
+    parser.add_argument('--max_mel_len', type=int, default=600)
+    parser.add_argument('--num_runs', type=int, default=5)
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--compile_cache_dir', type=str, default='/tmp/cosyvoice_compile_cache')
+    args = parser.parse_args()
+    torch.set_num_threads(args.num_threads)
+    model = make_tiny_model()
+    model.hift.remove_weight_norm()
+    model.set_deterministic(True)
+    model_input = make_model_input(num_prompt_speech_tokens=40)
+    tokens = torch.randint(0, SPEECH_TOKEN_SIZE, (1, args.num_tokens), dtype=torch.int32)
+    eager = {stream: measure(model, tokens, model_input, stream, args.num_runs) for stream in [True, False]}
+    start_time = time.time()
+    model.load_compiled(args.compile_cache_dir, max_mel_len=args.max_mel_len, warmup=True)
+    print('load_compiled with warmup {:.1f}s'.format(time.time() - start_time))
+    for stream in [True, False]:
+        speech, rtf = measure(model, tokens, model_input, stream, args.num_runs)
+        print('stream {:<5} eager rtf {:.4f} compiled rtf {:.4f} speedup {:.2f} max abs diff {:.2e}'.format(
+            str(stream), eager[stream][1], rtf, eager[stream][1] / rtf, (speech - eager[stream][0]).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
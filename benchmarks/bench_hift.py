@@ -0,0 +1,69 @@
+"""Benchmark batched against looped HiFT vocoding on cpu, in seconds of speech per second.
+
+HiFTGenerator.inference only batches on gpu by default, this forces batched=True to measure it on cpu.
+
+    python benchmarks/bench_hift.py --batch_sizes 1 2 4 8 16 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.hifigan.generator import HiFTGenerator  # noqa
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor  # noqa
+
+
+def make_hift():
+    # cosyvoice2 hift with random weights, speed does not depend on the weights
+    hift = HiFTGenerator(sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                         source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                         f0_predictor=ConvRNNF0Predictor())
+    return hift.eval()
+
+
+def looped(hift, mels):
+    return [hift.inference(speech_feat=mel.unsqueeze(0))[0][0] for mel in mels]
+
+
+def batched(hift, mels):
+    mels_lens = torch.tensor([mel.shape[1] for mel in mels])
+    speech_feat = torch.nn.utils.rnn.pad_sequence([mel.transpose(0, 1) for mel in mels], batch_first=True).transpose(1, 2)
+    speech, _ = hift.inference(speech_feat=speech_feat, speech_feat_lens=mels_lens, batched=True)
+    return [speech[i, :mels_lens[i] * speech.shape[1] // speech_feat.shape[2]] for i in range(len(mels))]
+
+
+def run(fn, hift, mels, num_runs):
+    start_time = time.perf_counter()
+    for _ in range(num_runs):
+        speech = fn(hift, mels)
+    return speech, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark batched hift inference')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--min_frames', type=int, default=50)
+    parser.add_argument('--max_frames', type=int, default=300)
+    parser.add_argument('--num_runs', type=int, default=2)
+    parser.add_argument('--num_threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.num_threads)
+    hift = make_hift()
+    # the batched source draws its noise for the whole batch, without noise both modes give the same speech
+    hift.m_source.set_deterministic(True)
+    for batch_size in args.batch_sizes:
+        mels = [torch.randn(80, np.random.randint(args.min_frames, args.max_frames)) for _ in range(batch_size)]
+        speech_seconds = sum(mel.shape[1] for mel in mels) / 50 * args.num_runs
+        looped_speech, looped_time = run(looped, hift, mels, args.num_runs)
+        batched_speech, batched_time = run(batched, hift, mels, args.num_runs)
+        max_diff = max((i - j).abs().max().item() for i, j in zip(looped_speech, batched_speech))
+        print('batch_size {} looped {:.1f} s/s batched {:.1f} s/s speedup {:.2f}x max_diff {:.2e}'.format(
+            batch_size, speech_seconds / looped_time, speech_seconds / batched_time, looped_time / batched_time, max_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark the import time of cosyvoice modules with python -X importtime, compared against stored baselines.
+
+    python benchmarks/bench_import.py                            # compare with benchmarks/baselines/bench_import.json
+    python benchmarks/bench_import.py --modules cosyvoice.cli.model
+    python benchmarks/bench_import.py --check                    # exit 1 when an import is slower than baseline * threshold
+    python benchmarks/bench_import.py --save                     # store the current timings as the new baseline
+
+Every module is imported in --runs fresh interpreters, the min of the cumulative import time is reported with the
+packages that take longest to import under it. Baselines are machine specific, save them again on a new machine.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'bench_import.json')
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(module):
+    """cumulative import time in seconds of every module imported by a fresh interpreter importing module"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT_DIR, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'), env.get('PYTHONPATH', '')])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], cwd=ROOT_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is not None:
+            times[match.group(4)] = int(match.group(2)) / 1e6
+    return times
+
+
+def top_level_packages(times, module, top_k):
+    """the top_k packages outside of cosyvoice with the longest cumulative import time"""
+    packages = {}
+    for name, cumulative in times.items():
+        package = name.split('.')[0]
+        if package not in ['cosyvoice', 'matcha'] and name != module:
+            packages[package] = max(packages.get(package, 0), cumulative)
+    return sorted(packages.items(), key=lambda i: i[1], reverse=True)[:top_k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cosyvoice import time benchmark')
+    parser.add_argument('--modules', type=str, nargs='+', default=['cosyvoice.cli.cosyvoice'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top_k', type=int, default=8, help='number of slowest packages to print per module')
+    parser.add_argument('--baseline', type=str, default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='save the timings as baseline')
+    parser.add_argument('--check', action='store_true', help='exit 1 when an import regresses')
+    parser.add_argument('--threshold', type=float, default=1.25, help='min time ratio against baseline that counts as a regression')
+    args = parser.parse_args()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['modules']
+    results, regressions = {}, []
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.runs)]
+        fastest = min(runs, key=lambda i: i[module])
+        results[module] = {'min': fastest[module], 'num_modules': len(fastest)}
+        line = '{:<32} min {:>8.3f}s modules {:>5}'.format(module, results[module]['min'], results[module]['num_modules'])
+        if module in baseline:
+            ratio = results[module]['min'] / baseline[module]['min']
+            line += ' baseline {:>8.3f}s ratio {:.2f}'.format(baseline[module]['min'], ratio)
+            if ratio > args.threshold:
+                regressions.append(module)
+                line += ' REGRESSION'
+        print(line)
+        for package, cumulative in top_level_packages(fastest, module, args.top_k):
+            print('    {:<28} {:>8.3f}s'.format(package, cumulative))
+    if args.save:
+        baseline.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.processor() or platform.machine(), 'python': platform.python_version(),
+                       'modules': baseline}, f, indent=2)
+        print('baseline saved to {}'.format(args.baseline))
+    if args.check and regressions:
+        print('regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
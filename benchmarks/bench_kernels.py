@@ -0,0 +1,255 @@
+"""Microbenchmarks of the hot inference paths on cpu with synthetic weights, compared against stored baselines.
+
+    python benchmarks/bench_kernels.py                      # compare with benchmarks/baselines/bench_kernels.json
+    python benchmarks/bench_kernels.py -k sampling hift     # only benchmarks whose name contains sampling or hift
+    python benchmarks/bench_kernels.py --check              # exit 1 when a benchmark is slower than baseline * threshold
+    python benchmarks/bench_kernels.py --save               # store the current timings as the new baseline
+
+Every benchmark is timed as the min and median over --rounds rounds, a round averages enough calls to take
+about --min_round_time seconds. Baselines are machine specific, save them again before comparing on a new machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+import torch
+from omegaconf import DictConfig
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+from cosyvoice.utils.common import nucleus_sampling, ras_sampling, fade_in_out, overlap_add  # noqa
+from cosyvoice.utils.frontend_utils import split_paragraph  # noqa
+from cosyvoice.utils.mask import make_pad_mask  # noqa
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'bench_kernels.json')
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """register a setup function, it builds the inputs once and returns the function to time"""
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+@benchmark('nucleus_sampling')
+def setup_nucleus_sampling():
+    weighted_scores = torch.randn(6564).log_softmax(dim=-1)
+    return lambda: nucleus_sampling(weighted_scores, top_p=0.8, top_k=25)
+
+
+@benchmark('ras_sampling')
+def setup_ras_sampling():
+    weighted_scores = torch.randn(6564).log_softmax(dim=-1)
+    decoded_tokens = np.random.randint(0, 6561, size=200).tolist()
+    return lambda: ras_sampling(weighted_scores, decoded_tokens, 25, top_p=0.8, top_k=25, win_size=10, tau_r=0.1)
+
+
+@benchmark('fade_in_out_mel')
+def setup_fade_in_out_mel():
+    # CosyVoiceModel mel overlap, 34 frames
+    window = np.hamming(2 * 34)
+    fade_in_mel, fade_out_mel = torch.randn(1, 80, 200), torch.randn(1, 80, 34)
+    return lambda: fade_in_out(fade_in_mel, fade_out_mel, window)
+
+
+@benchmark('fade_in_out_speech')
+def setup_fade_in_out_speech():
+    # CosyVoice2Model speech cache, 8 mel frames of 480 samples
+    window = np.hamming(2 * 8 * 480)
+    fade_in_speech, fade_out_speech = torch.randn(1, 24000), torch.randn(1, 8 * 480)
+    return lambda: fade_in_out(fade_in_speech, fade_out_speech, window)
+
+
+@benchmark('overlap_add_mel')
+def setup_overlap_add_mel():
+    # in place, repeated calls keep crossfading the same tensor, which costs the same
+    fade_in_mel, fade_out_mel = torch.randn(1, 80, 200), torch.randn(1, 80, 34)
+    return lambda: overlap_add(fade_in_mel, fade_out_mel, 34)
+
+
+@benchmark('overlap_add_speech')
+def setup_overlap_add_speech():
+    fade_in_speech, fade_out_speech = torch.randn(1, 24000), torch.randn(1, 8 * 480)
+    return lambda: overlap_add(fade_in_speech, fade_out_speech, 8 * 480)
+
+
+@benchmark('solve_euler')
+def setup_solve_euler():
+    from cosyvoice.flow.decoder import ConditionalDecoder
+    from cosyvoice.flow.flow_matching import ConditionalCFM
+    estimator = ConditionalDecoder(in_channels=320, out_channels=80, channels=[64], dropout=0.0, attention_head_dim=16,
+                                   n_blocks=1, num_mid_blocks=2, num_heads=2, act_fn='gelu')
+    cfm = ConditionalCFM(in_channels=240, n_spks=1, spk_emb_dim=80, estimator=estimator,
+                         cfm_params=DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine',
+                                                'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})).eval()
+    t_span = 1 - torch.cos(torch.linspace(0, 1, 11) * 0.5 * torch.pi)
+    x, mu, cond = torch.randn(1, 80, 200), torch.randn(1, 80, 200), torch.randn(1, 80, 200)
+    mask, spks = torch.ones(1, 1, 200), torch.randn(1, 80)
+
+    def run():
+        with torch.inference_mode():
+            return cfm.solve_euler(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond)
+    return run
+
+
+@benchmark('hift_decode')
+def setup_hift_decode():
+    from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
+    from cosyvoice.hifigan.generator import HiFTGenerator
+    hift = HiFTGenerator(base_channels=128, sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                         source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                         f0_predictor=ConvRNNF0Predictor(cond_channels=128)).eval()
+    # 2s of speech, the source signal has one sample per output sample
+    speech_feat = torch.randn(1, 80, 100)
+    with torch.inference_mode():
+        f0 = hift.f0_predictor(speech_feat)
+        s, _, _ = hift.m_source(hift.f0_upsamp(f0[:, None]).transpose(1, 2))
+    s = s.transpose(1, 2)
+
+    def run():
+        with torch.inference_mode():
+            return hift.decode(x=speech_feat, s=s)
+    return run
+
+
+@benchmark('causal_f0_predictor')
+def setup_causal_f0_predictor():
+    from cosyvoice.hifigan.f0_predictor import CausalConvRNNF0Predictor
+    f0_predictor = CausalConvRNNF0Predictor(cond_channels=512).eval()
+    speech_feat = torch.randn(1, 80, 100)
+
+    def run():
+        with torch.inference_mode():
+            return f0_predictor(speech_feat, finalize=False)
+    return run
+
+
+def make_rel_pos_attention(use_sdpa):
+    from cosyvoice.transformer.attention import RelPositionMultiHeadedAttention
+    from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
+    # one UpsampleConformerEncoder self attention over 10s of speech tokens
+    attention = RelPositionMultiHeadedAttention(8, 512, 0.0, use_sdpa=use_sdpa).eval()
+    x = torch.randn(1, 250, 512)
+    pos_emb = EspnetRelPositionalEncoding(512, 0.0)(x)[1]
+    mask = torch.ones(1, 1, 250, dtype=torch.bool)
+
+    def run():
+        with torch.inference_mode():
+            return attention(x, x, x, mask, pos_emb)
+    return run
+
+
+@benchmark('rel_pos_attention')
+def setup_rel_pos_attention():
+    return make_rel_pos_attention(False)
+
+
+@benchmark('rel_pos_attention_sdpa')
+def setup_rel_pos_attention_sdpa():
+    return make_rel_pos_attention(True)
+
+
+ZH_TEXT = '收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。' * 8
+EN_TEXT = 'CosyVoice is a multi-lingual large voice generation model, it provides inference, training and deployment. ' * 8
+
+
+@benchmark('split_paragraph_zh')
+def setup_split_paragraph_zh():
+    # one token per character, the tokenizer is not what is benchmarked
+    return lambda: list(split_paragraph(ZH_TEXT, list, 'zh', token_max_n=80, token_min_n=60, merge_len=20, comma_split=False))
+
+
+@benchmark('split_paragraph_en')
+def setup_split_paragraph_en():
+    return lambda: list(split_paragraph(EN_TEXT, list, 'en', token_max_n=80, token_min_n=60, merge_len=20, comma_split=False))
+
+
+@benchmark('text_normalize')
+def setup_text_normalize():
+    import inflect
+    from cosyvoice.cli.frontend import CosyVoiceFrontEnd
+    # only the attributes text_normalize reads, the onnx sessions and the model tokenizer are not needed
+    frontend = CosyVoiceFrontEnd.__new__(CosyVoiceFrontEnd)
+    frontend.tokenizer = type('CharTokenizer', (), {'encode': lambda self, text, allowed_special=None: list(text)})()
+    frontend.allowed_special = 'all'
+    frontend.text_frontend = ''
+    frontend.inflect_parser = inflect.engine()
+    return lambda: (frontend.text_normalize(ZH_TEXT, split=True), frontend.text_normalize(EN_TEXT, split=True))
+
+
+@benchmark('make_pad_mask')
+def setup_make_pad_mask():
+    lengths = torch.randint(100, 1000, (32,))
+    return lambda: make_pad_mask(lengths)
+
+
+def measure(fn, rounds, min_round_time):
+    fn()
+    # calibrate the number of calls per round
+    number, start_time = 1, time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start_time
+    if elapsed < min_round_time:
+        number = int(min_round_time / max(elapsed, 1e-7)) + 1
+    times = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start_time) / number)
+    return {'min': min(times), 'median': statistics.median(times)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cosyvoice microbenchmarks')
+    parser.add_argument('-k', '--keywords', type=str, nargs='*', default=[], help='run benchmarks whose name contains one of the keywords')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--min_round_time', type=float, default=0.2)
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--baseline', type=str, default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='save the timings as baseline')
+    parser.add_argument('--check', action='store_true', help='exit 1 when a benchmark regresses')
+    parser.add_argument('--threshold', type=float, default=1.25, help='min time ratio against baseline that counts as a regression')
+    args = parser.parse_args()
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+    results, regressions = {}, []
+    for name, setup in BENCHMARKS.items():
+        if args.keywords and not any(k in name for k in args.keywords):
+            continue
+        results[name] = measure(setup(), args.rounds, args.min_round_time)
+        line = '{:<24} min {:>10.1f}us median {:>10.1f}us'.format(name, results[name]['min'] * 1e6, results[name]['median'] * 1e6)
+        if name in baseline:
+            ratio = results[name]['min'] / baseline[name]['min']
+            line += ' baseline {:>10.1f}us ratio {:.2f}'.format(baseline[name]['min'] * 1e6, ratio)
+            if ratio > args.threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print(line)
+    if args.save:
+        baseline.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.processor() or platform.machine(), 'torch': torch.__version__, 'num_threads': args.num_threads,
+                       'benchmarks': baseline}, f, indent=2)
+        print('baseline saved to {}'.format(args.baseline))
+    if args.check and regressions:
+        print('regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Load test the serving path at several concurrencies, streaming and non streaming, and write the results to json.
+
+    # tiny random CosyVoice2 in process, works offline on cpu
+    python benchmarks/bench_load.py --target model --concurrency 1 2 4 --output load.json
+    # AutoModel of a downloaded model dir in process
+    python benchmarks/bench_load.py --target automodel --model_dir pretrained_models/CosyVoice2-0.5B
+    # a running runtime/python/fastapi or runtime/python/grpc server
+    python benchmarks/bench_load.py --target fastapi --port 50000
+    python benchmarks/bench_load.py --target grpc --port 50000
+    # StreamInference of the grpc server, the prompt is registered as a speaker and the text sent in fragments
+    python benchmarks/bench_load.py --target grpc --grpc_rpc StreamInference --port 50000
+
+For every request the time to the first chunk, the gaps between chunks and the rtf are recorded, and for every
+run the throughput in seconds of audio per second.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'third_party/Matcha-TTS'))
+
+
+def make_model_sender(args):
+    from tiny_model import make_tiny_model, make_model_input, SAMPLE_RATE
+    model = make_tiny_model()
+
+    def send(stream):
+        model_input = make_model_input(num_text_tokens=args.num_text_tokens)
+        for model_output in model.tts(**model_input, stream=stream):
+            yield model_output['tts_speech'].shape[1]
+    return send, SAMPLE_RATE
+
+
+def make_automodel_sender(args):
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+
+    def send(stream):
+        for model_output in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav, stream=stream):
+            yield model_output['tts_speech'].shape[1]
+    return send, cosyvoice.sample_rate
+
+
+def make_fastapi_sender(args):
+    import requests
+    url = 'http://{}:{}/inference_zero_shot'.format(args.host, args.port)
+
+    def send(stream):
+        # the fastapi server always streams its response, stream only changes how the client reads it
+        with open(args.prompt_wav, 'rb') as f:
+            response = requests.request('GET', url, data={'tts_text': args.tts_text, 'prompt_text': args.prompt_text},
+                                        files=[('prompt_wav', ('prompt_wav', f, 'application/octet-stream'))], stream=True)
+        response.raise_for_status()
+        if stream:
+            for chunk in response.iter_content(chunk_size=None):
+                yield len(chunk) // 2
+        else:
+            yield len(response.content) // 2
+    return send, args.sample_rate
+
+
+def make_grpc_sender(args):
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'runtime/python/grpc'))
+    import grpc
+    import cosyvoice_pb2
+    import cosyvoice_pb2_grpc
+    from cosyvoice.utils.file_utils import load_wav
+    prompt_audio = (load_wav(args.prompt_wav, 16000).numpy() * (2 ** 15)).astype(np.int16).tobytes()
+    channel = grpc.insecure_channel('{}:{}'.format(args.host, args.port))
+    stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
+    if args.grpc_rpc == 'StreamInference':
+        spk_id = 'bench_load'
+        stub.RegisterSpeaker(cosyvoice_pb2.RegisterSpeakerRequest(spk_id=spk_id, prompt_text=args.prompt_text, prompt_audio=prompt_audio))
+
+    def stream_requests():
+        yield cosyvoice_pb2.StreamRequest(setup=cosyvoice_pb2.streamSetup(spk_id=spk_id))
+        for i in range(0, len(args.tts_text), 5):
+            yield cosyvoice_pb2.StreamRequest(tts_text=args.tts_text[i:i + 5])
+
+    def send(stream):
+        if args.grpc_rpc == 'StreamInference':
+            responses = stub.StreamInference(stream_requests())
+        else:
+            request = cosyvoice_pb2.Request()
+            request.zero_shot_request.CopyFrom(cosyvoice_pb2.zeroshotRequest(tts_text=args.tts_text, prompt_text=args.prompt_text,
+                                                                             prompt_audio=prompt_audio))
+            responses = stub.Inference(request)
+        if stream:
+            for response in responses:
+                yield len(response.tts_audio) // 2
+        else:
+            yield sum(len(response.tts_audio) for response in responses) // 2
+    return send, args.sample_rate
+
+
+def run_request(send, stream, sample_rate):
+    start_time = time.perf_counter()
+    chunk_times, num_samples = [], 0
+    for chunk_samples in send(stream):
+        chunk_times.append(time.perf_counter())
+        num_samples += chunk_samples
+    end_time = time.perf_counter()
+    audio_seconds = num_samples / sample_rate
+    return {'first_chunk_latency': chunk_times[0] - start_time,
+            'chunk_latencies': np.diff([start_time] + chunk_times).tolist(),
+            'audio_seconds': audio_seconds,
+            'rtf': (end_time - start_time) / audio_seconds if audio_seconds > 0 else float('nan'),
+            'start_time': start_time,
+            'end_time': end_time}
+
+
+def run_level(send, sample_rate, concurrency, stream, num_requests):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: run_request(send, stream, sample_rate), range(num_requests)))
+    wall_time = max(r['end_time'] for r in results) - min(r['start_time'] for r in results)
+    chunk_latencies = np.concatenate([r['chunk_latencies'] for r in results])
+    first_chunk_latencies = np.array([r['first_chunk_latency'] for r in results])
+    return {'concurrency': concurrency,
+            'stream': stream,
+            'num_requests': num_requests,
+            'first_chunk_latency_p50': float(np.percentile(first_chunk_latencies, 50)),
+            'first_chunk_latency_p99': float(np.percentile(first_chunk_latencies, 99)),
+            'chunk_latency_p50': float(np.percentile(chunk_latencies, 50)),
+            'chunk_latency_p99': float(np.percentile(chunk_latencies, 99)),
+            'rtf_mean': float(np.mean([r['rtf'] for r in results])),
+            'audio_seconds_per_second': sum(r['audio_seconds'] for r in results) / wall_time,
+            'requests_per_second': num_requests / wall_time}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test cosyvoice serving')
+    parser.add_argument('--target', default='model', choices=['model', 'automodel', 'fastapi', 'grpc'],
+                        help='model is a tiny random CosyVoice2 driven with synthetic frontend outputs')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--stream', type=str, nargs='+', default=['true', 'false'], choices=['true', 'false'])
+    parser.add_argument('--requests_per_worker', type=int, default=2)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--num_text_tokens', type=int, default=20, help='text length of the tiny model requests')
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50000)
+    parser.add_argument('--sample_rate', type=int, default=24000, help='sample rate of the audio returned by the server')
+    parser.add_argument('--grpc_rpc', type=str, default='Inference', choices=['Inference', 'StreamInference'])
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default=os.path.join(ROOT_DIR, 'asset/zero_shot_prompt.wav'))
+    parser.add_argument('--output', type=str, default='bench_load.json')
+    args = parser.parse_args()
+    torch.set_num_threads(args.num_threads)
+    send, sample_rate = {'model': make_model_sender, 'automodel': make_automodel_sender,
+                         'fastapi': make_fastapi_sender, 'grpc': make_grpc_sender}[args.target](args)
+    for _ in range(args.warmup):
+        run_request(send, True, sample_rate)
+    results = []
+    for stream in [s == 'true' for s in args.stream]:
+        for concurrency in args.concurrency:
+            result = run_level(send, sample_rate, concurrency, stream, concurrency * args.requests_per_worker)
+            print('stream {} concurrency {} first chunk p50 {:.3f}s p99 {:.3f}s chunk p50 {:.3f}s p99 {:.3f}s rtf {:.3f} throughput {:.2f} s/s'.format(
+                stream, concurrency, result['first_chunk_latency_p50'], result['first_chunk_latency_p99'], result['chunk_latency_p50'],
+                result['chunk_latency_p99'], result['rtf_mean'], result['audio_seconds_per_second']))
+            results.append(result)
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'target': args.target, 'num_threads': args.num_threads, 'results': results}, f, indent=2)
+    print('results saved to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark the padding stage of the data pipeline, in samples/s of one worker.
+
+    python benchmarks/bench_padding.py --batch_sizes 8 16 32 64
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.dataset.processor import padding  # noqa
+
+
+def make_batch(batch_size, min_frames, max_frames):
+    batch = []
+    for i in range(batch_size):
+        num_frames = np.random.randint(min_frames, max_frames)
+        batch.append({'utt': 'utt_{}'.format(i),
+                      'text': 'text',
+                      'speech_feat': torch.randn(num_frames, 80),
+                      'speech_token': np.random.randint(0, 6561, size=num_frames // 2),
+                      'text_token': np.random.randint(0, 151643, size=num_frames // 10),
+                      'instruct_token': np.zeros(0, dtype=np.int64),
+                      'utt_embedding': torch.randn(192),
+                      'spk_embedding': torch.randn(192)})
+    return batch
+
+
+def reference_padding(data):
+    # per sample torch.tensor + pad_sequence, the previous implementation
+    for sample in data:
+        out = {}
+        for k in ['speech_token', 'text_token', 'instruct_token']:
+            tokens = [torch.tensor(x[k]) for x in sample]
+            out[k + '_len'] = torch.tensor([i.size(0) for i in tokens], dtype=torch.int32)
+            out[k] = pad_sequence(tokens, batch_first=True, padding_value=0)
+        out['speech_feat'] = pad_sequence([x['speech_feat'] for x in sample], batch_first=True, padding_value=0)
+        out['utt_embedding'] = torch.stack([x['utt_embedding'] for x in sample], dim=0)
+        out['spk_embedding'] = torch.stack([x['spk_embedding'] for x in sample], dim=0)
+        yield out
+
+
+def run(fn, batches, **kwargs):
+    start_time = time.perf_counter()
+    for _ in fn(iter(batches), **kwargs):
+        pass
+    return sum(len(b) for b in batches) / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark padding stage')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32, 64])
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--min_frames', type=int, default=100)
+    parser.add_argument('--max_frames', type=int, default=1000)
+    args = parser.parse_args()
+    # one dataloader worker runs on one thread
+    torch.set_num_threads(1)
+    for batch_size in args.batch_sizes:
+        batches = [make_batch(batch_size, args.min_frames, args.max_frames) for _ in range(args.num_batches)]
+        reference = run(reference_padding, batches)
+        current = run(padding, batches, use_spk_embedding=False)
+        print('batch_size {} reference {:.1f} samples/s padding {:.1f} samples/s speedup {:.2f}x'.format(
+            batch_size, reference, current, current / reference))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Benchmark the share of the HiFT source module in streaming vocoding on cpu, per chunk of the CosyVoice2 token2wav.
+
+    python benchmarks/bench_source.py --num_chunks 20
+
+inference resynthesizes the source of the cached frames and overwrites it with cache_source, inference_chunk only
+synthesizes the source of the new frames and continues the sine phases, deterministic also skips the noise.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.hifigan.generator import HiFTGenerator  # noqa
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor  # noqa
+
+# CosyVoice2Model streaming, 25 tokens of 2 mel frames per chunk, 8 mel frames of hift cache, 480 samples per frame
+CHUNK_FRAMES = 50
+MEL_CACHE_LEN = 8
+SOURCE_CACHE_LEN = MEL_CACHE_LEN * 480
+
+
+def make_hift():
+    # cosyvoice2 hift with random weights, speed does not depend on the weights
+    hift = HiFTGenerator(sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                         source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                         f0_predictor=ConvRNNF0Predictor())
+    return hift.eval()
+
+
+def stream(hift, mels, mode):
+    """vocode the chunks like CosyVoice2Model.token2wav, returns the total and the source module time"""
+    forward_chunk, source_time = hift.m_source.forward_chunk, [0.0]
+
+    def timed_forward_chunk(*args, **kwargs):
+        # forward of the source module calls forward_chunk too
+        start_time = time.perf_counter()
+        result = forward_chunk(*args, **kwargs)
+        source_time[0] += time.perf_counter() - start_time
+        return result
+    hift.m_source.forward_chunk = timed_forward_chunk
+    cache_mel, cache_source, cache_phase = torch.zeros(1, 80, 0), torch.zeros(1, 1, 0), torch.zeros(0, 0, 0)
+    start_time = time.perf_counter()
+    for i, mel in enumerate(mels):
+        mel = torch.concat([cache_mel, mel], dim=2)
+        if mode == 'inference':
+            speech, source = hift.inference(speech_feat=mel, cache_source=cache_source)
+        else:
+            speech, source, cache_phase = hift.inference_chunk(speech_feat=mel, cache_source=cache_source, cache_phase=cache_phase,
+                                                               finalize=i == len(mels) - 1)
+        cache_mel, cache_source = mel[:, :, -MEL_CACHE_LEN:], source[:, :, -SOURCE_CACHE_LEN:]
+    total_time = time.perf_counter() - start_time
+    del hift.m_source.forward_chunk
+    return total_time, source_time[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the hift source module in streaming')
+    parser.add_argument('--num_chunks', type=int, default=20)
+    parser.add_argument('--num_runs', type=int, default=2)
+    parser.add_argument('--num_threads', type=int, default=4)
+    args = parser.parse_args()
+    torch.set_num_threads(args.num_threads)
+    hift = make_hift()
+    mels = [torch.randn(1, 80, CHUNK_FRAMES) for _ in range(args.num_chunks)]
+    for mode in ['inference', 'inference_chunk', 'deterministic']:
+        hift.m_source.set_deterministic(mode == 'deterministic')
+        stream(hift, mels[:2], mode)
+        total_time, source_time = 0, 0
+        for _ in range(args.num_runs):
+            run_total_time, run_source_time = stream(hift, mels, mode)
+            total_time, source_time = total_time + run_total_time, source_time + run_source_time
+        num_chunks = args.num_chunks * args.num_runs
+        print('{:<16} vocoder {:.2f}ms source {:.2f}ms per chunk, source share {:.1f}%'.format(
+            mode, total_time / num_chunks * 1e3, source_time / num_chunks * 1e3, source_time / total_time * 100))
+    hift.m_source.set_deterministic(False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Tiny randomly initialised CosyVoice2 model, so the serving path can be benchmarked offline on cpu.
+
+The modules and the streaming configuration follow examples/libritts/cosyvoice2/conf/cosyvoice2.yaml,
+only the widths and depths are scaled down. Speech from random weights is noise, but the llm decodes,
+the flow chunks and the vocoder cache follow the same code path as the released model.
+
+save_tiny_model_dir writes the tiny model as a model dir, so AutoModel and the fastapi and grpc servers can load it:
+
+    python benchmarks/tiny_model.py --model_dir /tmp/tiny_cosyvoice2
+"""
+import argparse
+import os
+import sys
+import tempfile
+from functools import partial
+
+import torch
+from omegaconf import DictConfig
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'third_party/Matcha-TTS'))
+from cosyvoice.cli.model import CosyVoice2Model  # noqa
+from cosyvoice.flow.decoder import CausalConditionalDecoder  # noqa
+from cosyvoice.flow.flow import CausalMaskedDiffWithXvec  # noqa
+from cosyvoice.flow.flow_matching import CausalConditionalCFM  # noqa
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor  # noqa
+from cosyvoice.hifigan.generator import HiFTGenerator  # noqa
+from cosyvoice.llm.llm import Qwen2Encoder, Qwen2LM  # noqa
+from cosyvoice.transformer.upsample_encoder import UpsampleConformerEncoder  # noqa
+from cosyvoice.utils.common import ras_sampling  # noqa
+
+TEXT_VOCAB_SIZE = 1000
+SPEECH_TOKEN_SIZE = 6561
+SAMPLE_RATE = 24000
+
+
+def make_tiny_llm(hidden_size=64, pretrain_path=None):
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    if pretrain_path is None:
+        # Qwen2Encoder loads a pretrained path, so the random qwen2 is saved to a temporary directory first
+        pretrain_path = tempfile.mkdtemp(prefix='tiny_qwen2_')
+        Qwen2ForCausalLM(Qwen2Config(vocab_size=TEXT_VOCAB_SIZE, hidden_size=hidden_size, intermediate_size=2 * hidden_size,
+                                     num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2)).save_pretrained(pretrain_path)
+    return Qwen2LM(llm_input_size=hidden_size,
+                   llm_output_size=hidden_size,
+                   speech_token_size=SPEECH_TOKEN_SIZE,
+                   llm=Qwen2Encoder(pretrain_path),
+                   sampling=partial(ras_sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1))
+
+
+def make_tiny_flow(hidden_size=64, chunk_size=25, token_mel_ratio=2):
+    # the lookahead and upsample layers of UpsampleConformerEncoder are built with 512 channels, only the depth is scaled down
+    encoder = UpsampleConformerEncoder(input_size=512, output_size=512, attention_heads=2, linear_units=512,
+                                       num_blocks=1, input_layer='linear', pos_enc_layer_type='rel_pos_espnet',
+                                       selfattention_layer_type='rel_selfattn', use_cnn_module=False, macaron_style=False,
+                                       static_chunk_size=chunk_size)
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[hidden_size], dropout=0.0, attention_head_dim=16,
+                                         n_blocks=1, num_mid_blocks=1, num_heads=2, act_fn='gelu',
+                                         static_chunk_size=chunk_size * token_mel_ratio, num_decoding_left_chunks=-1)
+    decoder = CausalConditionalCFM(in_channels=240, n_spks=1, spk_emb_dim=80, estimator=estimator,
+                                   cfm_params=DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine',
+                                                          'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'}))
+    return CausalMaskedDiffWithXvec(input_size=512, output_size=80, spk_embed_dim=192, vocab_size=SPEECH_TOKEN_SIZE,
+                                    input_frame_rate=25, token_mel_ratio=token_mel_ratio, pre_lookahead_len=3,
+                                    encoder=encoder, decoder=decoder)
+
+
+def make_tiny_hift(base_channels=64):
+    return HiFTGenerator(base_channels=base_channels, sampling_rate=SAMPLE_RATE, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                         source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                         f0_predictor=ConvRNNF0Predictor(cond_channels=base_channels))
+
+
+def make_tiny_model(seed=0):
+    torch.manual_seed(seed)
+    model = CosyVoice2Model(make_tiny_llm(), make_tiny_flow(), make_tiny_hift())
+    for module in [model.llm, model.flow, model.hift]:
+        module.to(model.device).eval()
+    return model
+
+
+def make_model_input(num_text_tokens=20, num_prompt_text_tokens=10, num_prompt_speech_tokens=50):
+    """synthetic frontend_zero_shot output, the prompt mel has token_mel_ratio frames per prompt speech token"""
+    prompt_speech_token = torch.randint(0, SPEECH_TOKEN_SIZE, (1, num_prompt_speech_tokens), dtype=torch.int32)
+    embedding = torch.randn(1, 192)
+    return {'text': torch.randint(0, TEXT_VOCAB_SIZE, (1, num_text_tokens), dtype=torch.int32),
+            'prompt_text': torch.randint(0, TEXT_VOCAB_SIZE, (1, num_prompt_text_tokens), dtype=torch.int32),
+            'llm_prompt_speech_token': prompt_speech_token,
+            'flow_prompt_speech_token': prompt_speech_token,
+            'prompt_speech_feat': torch.randn(1, 2 * num_prompt_speech_tokens, 80),
+            'llm_embedding': embedding,
+            'flow_embedding': embedding}
+
+
+TINY_YAML = """\
+sample_rate: 24000
+qwen_pretrain_path: ''
+llm: !apply:benchmarks.tiny_model.make_tiny_llm
+    pretrain_path: !ref <qwen_pretrain_path>
+flow: !apply:benchmarks.tiny_model.make_tiny_flow
+hift: !apply:benchmarks.tiny_model.make_tiny_hift
+get_tokenizer: !name:cosyvoice.tokenizer.tokenizer.get_qwen_tokenizer
+    token_path: !ref <qwen_pretrain_path>
+    skip_special_tokens: True
+allowed_special: 'all'
+feat_extractor: !name:matcha.utils.audio.mel_spectrogram
+    n_fft: 1920
+    num_mels: 80
+    sampling_rate: !ref <sample_rate>
+    hop_size: 480
+    win_size: 1920
+    fmin: 0
+    fmax: 8000
+    center: False
+"""
+
+
+class TinyCampplus(torch.nn.Module):
+    """fbank (batch, frames, 80) to a speaker embedding (batch, 192)"""
+
+    def __init__(self):
+        super().__init__()
+        self.proj = torch.nn.Linear(80, 192)
+
+    def forward(self, feat):
+        return self.proj(feat).mean(dim=1)
+
+
+class TinySpeechTokenizer(torch.nn.Module):
+    """whisper log mel (1, 128, frames) at 100Hz to speech tokens (1, frames / 4) at 25Hz"""
+
+    def __init__(self):
+        super().__init__()
+        self.proj = torch.nn.Conv1d(128, SPEECH_TOKEN_SIZE, kernel_size=4, stride=4)
+
+    def forward(self, feats, feats_length):
+        return self.proj(feats).argmax(dim=1)[:, :feats_length[0].long() // 4].to(torch.int32)
+
+
+def save_tiny_qwen(pretrain_path, hidden_size=64):
+    """the random qwen2 and a byte level tokenizer without merges, the special tokens of CosyVoice2Tokenizer stay in the text vocab"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+    Qwen2ForCausalLM(Qwen2Config(vocab_size=TEXT_VOCAB_SIZE, hidden_size=hidden_size, intermediate_size=2 * hidden_size,
+                                 num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2)).save_pretrained(pretrain_path)
+    tokenizer = Tokenizer(models.BPE(vocab={c: i for i, c in enumerate(sorted(pre_tokenizers.ByteLevel.alphabet()))}, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token='<|endoftext|>').save_pretrained(pretrain_path)
+
+
+def save_tiny_model_dir(model_dir, seed=0):
+    """cosyvoice2.yaml, the checkpoints, the onnx frontend models and spk2info.pt of the tiny model, in the layout of
+    pretrained_models/CosyVoice2-0.5B. The yaml builds the modules with the functions of this file, so loaders need the
+    repo root on sys.path"""
+    os.makedirs(model_dir, exist_ok=True)
+    pretrain_path = os.path.join(model_dir, 'CosyVoice-BlankEN')
+    save_tiny_qwen(pretrain_path)
+    torch.manual_seed(seed)
+    model = CosyVoice2Model(make_tiny_llm(pretrain_path=pretrain_path), make_tiny_flow(), make_tiny_hift())
+    # a random llm hardly ever samples eos, and may sample the fill token that a trained one only emits in turn in bistream
+    # mode, so eos is made likely once allowed and the other special tokens are never sampled
+    with torch.no_grad():
+        model.llm.llm_decoder.bias[model.llm.eos_token] = 3
+        model.llm.llm_decoder.bias[model.llm.eos_token + 1:] = -1e4
+    for name in ['llm', 'flow', 'hift']:
+        torch.save(getattr(model, name).state_dict(), os.path.join(model_dir, '{}.pt'.format(name)))
+    torch.onnx.export(TinyCampplus(), torch.randn(1, 200, 80), os.path.join(model_dir, 'campplus.onnx'),
+                      input_names=['input'], output_names=['output'], dynamic_axes={'input': {0: 'batch', 1: 'frames'}})
+    torch.onnx.export(TinySpeechTokenizer(), (torch.randn(1, 128, 400), torch.tensor([400], dtype=torch.int32)),
+                      os.path.join(model_dir, 'speech_tokenizer_v2.onnx'), input_names=['feats', 'feats_length'],
+                      output_names=['indices'], dynamic_axes={'feats': {2: 'frames'}})
+    torch.save({}, os.path.join(model_dir, 'spk2info.pt'))
+    with open(os.path.join(model_dir, 'cosyvoice2.yaml'), 'w') as f:
+        f.write(TINY_YAML)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write the tiny random CosyVoice2 as a model dir')
+    parser.add_argument('--model_dir', type=str, required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    save_tiny_model_dir(args.model_dir, args.seed)
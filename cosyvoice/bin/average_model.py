@@ -16,6 +16,7 @@
 import os
 import argparse
 import glob
+import re
 
 import yaml
 import torch
@@ -29,62 +30,98 @@ def get_args():
                         help='src model path for average')
     parser.add_argument('--val_best',
                         action="store_true",
-                        help='averaged model')
+                        help='average top num checkpoints by cv loss, otherwise average last num checkpoints')
     parser.add_argument('--num',
                         default=5,
                         type=int,
                         help='nums for averaged model')
+    parser.add_argument('--mode',
+                        default='uniform',
+                        choices=['uniform', 'weighted', 'ema'],
+                        help='uniform average, weighted average by --weights, or ema style average of checkpoints in training order')
+    parser.add_argument('--weights',
+                        default=None,
+                        type=float,
+                        nargs='+',
+                        help='weight of each checkpoint in training order, used in weighted mode')
+    parser.add_argument('--ema_decay',
+                        default=0.9,
+                        type=float,
+                        help='decay of older checkpoints, used in ema mode')
 
     args = parser.parse_args()
     print(args)
     return args
 
 
+def get_checkpoints(src_path):
+    """ Read (epoch, step, loss, path) of every checkpoint from its yaml """
+    yamls = glob.glob('{}/*.yaml'.format(src_path))
+    yamls = [
+        f for f in yamls
+        if not (os.path.basename(f).startswith('train')
+                or os.path.basename(f).startswith('init'))
+    ]
+    checkpoints = []
+    for y in yamls:
+        path = re.sub('.yaml$', '.pt', y)
+        if not os.path.exists(path):
+            continue
+        with open(y, 'r') as f:
+            dic_yaml = yaml.load(f, Loader=yaml.BaseLoader)
+            loss = float(dic_yaml['loss_dict']['loss'])
+            epoch = int(dic_yaml['epoch'])
+            step = int(dic_yaml['step'])
+            checkpoints += [[epoch, step, loss, path]]
+    return checkpoints
+
+
+def get_weights(args, num):
+    if args.mode == 'uniform':
+        weights = [1.0] * num
+    elif args.mode == 'weighted':
+        assert args.weights is not None and len(args.weights) == num, 'weighted mode needs {} weights'.format(num)
+        weights = args.weights
+    else:
+        # newest checkpoint has largest weight
+        weights = [args.ema_decay ** (num - 1 - i) for i in range(num)]
+    return [w / sum(weights) for w in weights]
+
+
 def main():
     args = get_args()
-    val_scores = []
+    checkpoints = get_checkpoints(args.src_path)
     if args.val_best:
-        yamls = glob.glob('{}/*.yaml'.format(args.src_path))
-        yamls = [
-            f for f in yamls
-            if not (os.path.basename(f).startswith('train')
-                    or os.path.basename(f).startswith('init'))
-        ]
-        for y in yamls:
-            with open(y, 'r') as f:
-                dic_yaml = yaml.load(f, Loader=yaml.BaseLoader)
-                loss = float(dic_yaml['loss_dict']['loss'])
-                epoch = int(dic_yaml['epoch'])
-                step = int(dic_yaml['step'])
-                tag = dic_yaml['tag']
-                val_scores += [[epoch, step, loss, tag]]
-        sorted_val_scores = sorted(val_scores,
-                                   key=lambda x: x[2],
-                                   reverse=False)
-        print("best val (epoch, step, loss, tag) = " +
-              str(sorted_val_scores[:args.num]))
-        path_list = [
-            args.src_path + '/epoch_{}_whole.pt'.format(score[0])
-            for score in sorted_val_scores[:args.num]
-        ]
-    print(path_list)
-    avg = {}
-    num = args.num
-    assert num == len(path_list)
-    for path in path_list:
+        checkpoints = sorted(checkpoints, key=lambda x: x[2])[:args.num]
+        print("best val (epoch, step, loss, path) = " + str(checkpoints))
+    else:
+        checkpoints = sorted(checkpoints, key=lambda x: (x[0], x[1]))[-args.num:]
+    assert args.num == len(checkpoints), 'found {} checkpoints, less than {}'.format(len(checkpoints), args.num)
+    # weights follow training order
+    checkpoints = sorted(checkpoints, key=lambda x: (x[0], x[1]))
+    path_list = [c[3] for c in checkpoints]
+    weights = get_weights(args, len(path_list))
+    print(path_list, weights)
+    # accumulate tensor by tensor from memory mapped checkpoints, so memory
+    # is bounded by the averaged model plus the tensors being read
+    avg, dtypes = {}, {}
+    for path, weight in zip(path_list, weights):
         print('Processing {}'.format(path))
-        states = torch.load(path, map_location=torch.device('cpu'))
+        states = torch.load(path, map_location=torch.device('cpu'), mmap=True)
         for k in states.keys():
-            if k not in ['step', 'epoch']:
-                if k not in avg.keys():
-                    avg[k] = states[k].clone()
+            if k in ['step', 'epoch']:
+                continue
+            if k not in avg.keys():
+                dtypes[k] = states[k].dtype
+                if states[k].is_floating_point():
+                    avg[k] = states[k].to(torch.float32, copy=True).mul_(weight)
                 else:
-                    avg[k] += states[k]
-    # average
+                    avg[k] = states[k].clone()
+            elif avg[k].is_floating_point():
+                avg[k].add_(states[k], alpha=weight)
+        del states
     for k in avg.keys():
-        if avg[k] is not None:
-            # pytorch 1.6 use true_divide instead of /=
-            avg[k] = torch.true_divide(avg[k], num)
+        avg[k] = avg[k].to(dtypes[k])
     print('Saving to {}'.format(args.dst_model))
     torch.save(avg, args.dst_model)
 
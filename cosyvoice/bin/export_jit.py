@@ -70,9 +70,9 @@ def main():
 
         # 2. export llm llm
         llm_llm = model.model.llm.llm
-        script = get_optimized_script(llm_llm, ['forward_chunk'])
+        script = get_optimized_script(llm_llm, ['forward_chunk', 'forward_chunk_inplace'])
         script.save('{}/llm.llm.fp32.zip'.format(args.model_dir))
-        script = get_optimized_script(llm_llm.half(), ['forward_chunk'])
+        script = get_optimized_script(llm_llm.half(), ['forward_chunk', 'forward_chunk_inplace'])
         script.save('{}/llm.llm.fp16.zip'.format(args.model_dir))
         logging.info('successfully export llm_llm')
 
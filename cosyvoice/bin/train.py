@@ -34,7 +34,8 @@ from cosyvoice.utils.train_utils import (
     init_dataset_and_dataloader,
     init_optimizer_and_scheduler,
     init_summarywriter, save_model,
-    wrap_cuda_model, check_modify_and_save_config)
+    wrap_cuda_model, check_modify_and_save_config,
+    AsyncCheckpointWriter)
 
 
 def get_args():
@@ -84,6 +85,10 @@ def get_args():
                         default='model_only',
                         choices=['model_only', 'model+optimizer'],
                         help='save model/optimizer states')
+    parser.add_argument('--async_checkpoint',
+                        action='store_true',
+                        default=False,
+                        help='Write torch_ddp checkpoint in background thread, the cv pass before each save still blocks')
     parser.add_argument('--timeout',
                         default=60,
                         type=int,
@@ -170,7 +175,8 @@ def main():
         ref_model, dpo_loss = None, None
 
     # Get executor
-    executor = Executor(gan=gan, ref_model=ref_model, dpo_loss=dpo_loss)
+    checkpoint_writer = AsyncCheckpointWriter() if args.async_checkpoint is True else None
+    executor = Executor(gan=gan, ref_model=ref_model, dpo_loss=dpo_loss, checkpoint_writer=checkpoint_writer)
     executor.step = start_step
 
     # Init scaler, used for pytorch amp mixed precision training
@@ -189,6 +195,8 @@ def main():
         else:
             executor.train_one_epoc(model, optimizer, scheduler, train_data_loader, cv_data_loader, writer, info_dict, scaler, group_join, ref_model=ref_model)
         dist.destroy_process_group(group_join)
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
 
 
 if __name__ == '__main__':
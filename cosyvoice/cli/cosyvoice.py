@@ -13,54 +13,73 @@
 # limitations under the License.
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
-from modelscope import snapshot_download
 import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model
-from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.file_utils import logging, log_time, timed_init, skip_weight_init
 from cosyvoice.utils.class_utils import get_model_type
 
 
+def download_model(model_id):
+    # modelscope takes seconds to import, only model ids that are not local dirs need it
+    from modelscope import snapshot_download
+    return snapshot_download(model_id)
+
+
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, mmap=False, snapshot=False, deterministic=False):
+        start_time = time.time()
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
-            model_dir = snapshot_download(model_dir)
+            model_dir = download_model(model_dir)
         hyper_yaml_path = '{}/cosyvoice.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f)
+        # every module weight is loaded from the checkpoints below, constructing them skips the random init
+        with log_time('parse {}'.format(hyper_yaml_path)), skip_weight_init():
+            with open(hyper_yaml_path, 'r') as f:
+                configs = load_hyperpyyaml(f)
         assert get_model_type(configs) == CosyVoiceModel, 'do not use {} for CosyVoice initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v1.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        # the frontend loads while the models are read
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            frontend = executor.submit(timed_init, 'frontend', CosyVoiceFrontEnd,
+                                       configs['get_tokenizer'],
+                                       configs['feat_extractor'],
+                                       '{}/campplus.onnx'.format(model_dir),
+                                       '{}/speech_tokenizer_v1.onnx'.format(model_dir),
+                                       '{}/spk2info.pt'.format(model_dir),
+                                       configs['allowed_special'])
+            self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
+            self.model.load('{}/llm.pt'.format(model_dir),
+                            '{}/flow.pt'.format(model_dir),
+                            '{}/hift.pt'.format(model_dir),
+                            mmap,
+                            '{}/snapshot.pt'.format(model_dir) if snapshot is True else None)
+            self.frontend = frontend.result()
+        self.model.set_deterministic(deterministic)
         if load_jit:
-            self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
+            with log_time('load jit'):
+                self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with log_time('load trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
         del configs
+        logging.info('{} ready in {:.2f}s'.format(self.__class__.__name__, time.time() - start_time))
 
     def list_available_spks(self):
         spks = list(self.frontend.spk2info.keys())
@@ -140,41 +159,59 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, mmap=False, load_compiled=False,
+                 snapshot=False, deterministic=False):
+        start_time = time.time()
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
-            model_dir = snapshot_download(model_dir)
+            model_dir = download_model(model_dir)
         hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+        # every module weight is loaded from the checkpoints below, constructing them skips the random init and the qwen weights
+        with log_time('parse {}'.format(hyper_yaml_path)), skip_weight_init():
+            with open(hyper_yaml_path, 'r') as f:
+                configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice2Model, 'do not use {} for CosyVoice2 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v2.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or load_vllm is True or fp16 is True):
             load_jit, load_trt, load_vllm, fp16 = False, False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/load_vllm/fp16 to False')
-        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        # the frontend loads while the models are read
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            frontend = executor.submit(timed_init, 'frontend', CosyVoiceFrontEnd,
+                                       configs['get_tokenizer'],
+                                       configs['feat_extractor'],
+                                       '{}/campplus.onnx'.format(model_dir),
+                                       '{}/speech_tokenizer_v2.onnx'.format(model_dir),
+                                       '{}/spk2info.pt'.format(model_dir),
+                                       configs['allowed_special'])
+            self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
+            self.model.load('{}/llm.pt'.format(model_dir),
+                            '{}/flow.pt'.format(model_dir),
+                            '{}/hift.pt'.format(model_dir),
+                            mmap,
+                            '{}/snapshot.pt'.format(model_dir) if snapshot is True else None)
+            self.frontend = frontend.result()
+        self.model.set_deterministic(deterministic)
         if load_vllm:
-            self.model.load_vllm('{}/vllm'.format(model_dir))
+            with log_time('load vllm'):
+                self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_jit:
-            self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
+            with log_time('load jit'):
+                self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with log_time('load trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
+        if load_compiled:
+            with log_time('load compiled'):
+                self.model.load_compiled('{}/compile_cache'.format(model_dir), warmup=True)
         del configs
+        logging.info('{} ready in {:.2f}s'.format(self.__class__.__name__, time.time() - start_time))
 
     def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
@@ -190,46 +227,63 @@ class CosyVoice2(CosyVoice):
 
 class CosyVoice3(CosyVoice2):
 
-    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, mmap=False, load_compiled=False, snapshot=False,
+                 deterministic=False):
+        start_time = time.time()
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
-            model_dir = snapshot_download(model_dir)
+            model_dir = download_model(model_dir)
         hyper_yaml_path = '{}/cosyvoice3.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+        # every module weight is loaded from the checkpoints below, constructing them skips the random init and the qwen weights
+        with log_time('parse {}'.format(hyper_yaml_path)), skip_weight_init():
+            with open(hyper_yaml_path, 'r') as f:
+                configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice3Model, 'do not use {} for CosyVoice3 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v3.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_trt is True or fp16 is True):
             load_trt, fp16 = False, False
             logging.warning('no cuda device, set load_trt/fp16 to False')
-        self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        # the frontend loads while the models are read
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            frontend = executor.submit(timed_init, 'frontend', CosyVoiceFrontEnd,
+                                       configs['get_tokenizer'],
+                                       configs['feat_extractor'],
+                                       '{}/campplus.onnx'.format(model_dir),
+                                       '{}/speech_tokenizer_v3.onnx'.format(model_dir),
+                                       '{}/spk2info.pt'.format(model_dir),
+                                       configs['allowed_special'])
+            self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16)
+            self.model.load('{}/llm.pt'.format(model_dir),
+                            '{}/flow.pt'.format(model_dir),
+                            '{}/hift.pt'.format(model_dir),
+                            mmap,
+                            '{}/snapshot.pt'.format(model_dir) if snapshot is True else None)
+            self.frontend = frontend.result()
+        self.model.set_deterministic(deterministic)
         if load_vllm:
-            self.model.load_vllm('{}/vllm'.format(model_dir))
+            with log_time('load vllm'):
+                self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_trt:
             if self.fp16 is True:
                 logging.warning('DiT tensorRT fp16 engine have some performance issue, use at caution!')
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with log_time('load trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
+        if load_compiled:
+            with log_time('load compiled'):
+                self.model.load_compiled('{}/compile_cache'.format(model_dir), warmup=True)
         del configs
+        logging.info('{} ready in {:.2f}s'.format(self.__class__.__name__, time.time() - start_time))
 
 
 def AutoModel(**kwargs):
     if not os.path.exists(kwargs['model_dir']):
-        kwargs['model_dir'] = snapshot_download(kwargs['model_dir'])
+        kwargs['model_dir'] = download_model(kwargs['model_dir'])
     if os.path.exists('{}/cosyvoice.yaml'.format(kwargs['model_dir'])):
         return CosyVoice(**kwargs)
     elif os.path.exists('{}/cosyvoice2.yaml'.format(kwargs['model_dir'])):
@@ -11,19 +11,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, cached_property
 from typing import Generator
 import json
-import onnxruntime
 import torch
 import numpy as np
-import whisper
 from typing import Callable
 import torchaudio.compliance.kaldi as kaldi
 import os
 import re
-import inflect
-from cosyvoice.utils.file_utils import logging, load_wav
+from cosyvoice.utils.file_utils import logging, load_wav, log_time, timed_init
+from cosyvoice.utils import metrics
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
@@ -36,22 +35,51 @@ class CosyVoiceFrontEnd:
                  speech_tokenizer_model: str,
                  spk2info: str = '',
                  allowed_special: str = 'all'):
-        self.tokenizer = get_tokenizer()
-        self.feat_extractor = feat_extractor
+        import onnxruntime
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
-                                                                                "CPUExecutionProvider"])
-        if os.path.exists(spk2info):
-            self.spk2info = torch.load(spk2info, map_location=self.device)
-        else:
-            self.spk2info = {}
-        self.allowed_special = allowed_special
-        self.inflect_parser = inflect.engine()
+        # the onnx sessions and the text frontend load their resources independently, in parallel
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            campplus_session = executor.submit(timed_init, 'campplus session', onnxruntime.InferenceSession, campplus_model,
+                                               sess_options=option, providers=["CPUExecutionProvider"])
+            speech_tokenizer_session = executor.submit(timed_init, 'speech tokenizer session', onnxruntime.InferenceSession,
+                                                       speech_tokenizer_model, sess_options=option,
+                                                       providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
+                                                                  "CPUExecutionProvider"])
+            text_frontend = executor.submit(timed_init, 'text frontend', self.load_text_frontend)
+            # built ahead of the first english text
+            inflect_parser = executor.submit(timed_init, 'inflect', getattr, self, 'inflect_parser')
+            # imported ahead of the first prompt wav
+            whisper = executor.submit(timed_init, 'whisper', getattr, self, 'whisper')
+            with log_time('tokenizer'):
+                self.tokenizer = get_tokenizer()
+            self.feat_extractor = feat_extractor
+            if os.path.exists(spk2info):
+                self.spk2info = torch.load(spk2info, map_location=self.device)
+            else:
+                self.spk2info = {}
+            self.allowed_special = allowed_special
+            self.campplus_session = campplus_session.result()
+            self.speech_tokenizer_session = speech_tokenizer_session.result()
+            text_frontend.result()
+            inflect_parser.result()
+            whisper.result()
+
+    @cached_property
+    def inflect_parser(self):
+        # inflect takes seconds to import, the module imports without it
+        import inflect
+        return inflect.engine()
+
+    @cached_property
+    def whisper(self):
+        # whisper imports its transcription stack with it, only log_mel_spectrogram is used
+        import whisper
+        return whisper
+
+    def load_text_frontend(self):
         # NOTE compatible when no text frontend tool is avaliable
         try:
             import ttsfrd
@@ -74,7 +102,7 @@ class CosyVoiceFrontEnd:
                 self.text_frontend = ''
                 logging.info('no frontend is avaliable')
 
-
+    @metrics.timed('cosyvoice_frontend_seconds', 'text_token')
     def _extract_text_token(self, text):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will return _extract_text_token_generator!')
@@ -92,10 +120,11 @@ class CosyVoiceFrontEnd:
             for i in range(text_token.shape[1]):
                 yield text_token[:, i: i + 1]
 
+    @metrics.timed('cosyvoice_frontend_seconds', 'speech_token')
     def _extract_speech_token(self, prompt_wav):
         speech = load_wav(prompt_wav, 16000)
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
-        feat = whisper.log_mel_spectrogram(speech, n_mels=128)
+        feat = self.whisper.log_mel_spectrogram(speech, n_mels=128)
         speech_token = self.speech_tokenizer_session.run(None,
                                                          {self.speech_tokenizer_session.get_inputs()[0].name:
                                                           feat.detach().cpu().numpy(),
@@ -105,6 +134,7 @@ class CosyVoiceFrontEnd:
         speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
         return speech_token, speech_token_len
 
+    @metrics.timed('cosyvoice_frontend_seconds', 'spk_embedding')
     def _extract_spk_embedding(self, prompt_wav):
         speech = load_wav(prompt_wav, 16000)
         feat = kaldi.fbank(speech,
@@ -117,6 +147,7 @@ class CosyVoiceFrontEnd:
         embedding = torch.tensor([embedding]).to(self.device)
         return embedding
 
+    @metrics.timed('cosyvoice_frontend_seconds', 'speech_feat')
     def _extract_speech_feat(self, prompt_wav):
         speech = load_wav(prompt_wav, 24000)
         speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
@@ -124,6 +155,7 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    @metrics.timed('cosyvoice_frontend_seconds', 'text_normalize')
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will skip text_normalize!')
@@ -21,9 +21,16 @@ import time
 from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
-from cosyvoice.utils.common import fade_in_out
+from cosyvoice.utils.common import overlap_add
 from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.common import TrtContextWrapper, CacheManager
+from cosyvoice.utils.compile_utils import length_buckets, enable_compile_cache, CompiledEstimator, CompiledDecodeSpec
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.transformer.convolution import ConvolutionModule
+from cosyvoice.utils import metrics
+
+# bump when prepare_inference changes the structure of the prepared modules
+SNAPSHOT_VERSION = 1
 
 
 class CosyVoiceModel:
@@ -43,34 +50,122 @@ class CosyVoiceModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        # speech fade in out, hamming by default, equal power keeps the loudness of uncorrelated chunks
+        self.equal_power_fade = False
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # session not accessed for 600s is treated as abandoned, e.g. the tts generator is not fully consumed
+        self.hift_cache_dict = CacheManager(ttl=600, on_evict=self.drop_session, keep=self.job_running)
 
-    def load(self, llm_model, flow_model, hift_model):
-        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
+    def load(self, llm_model, flow_model, hift_model, mmap=False, snapshot_model=None):
+        """load the llm, flow and hift checkpoints, with snapshot_model the prepared modules are also saved to it in one
+        file, later loads read that snapshot instead while it is newer than the checkpoints"""
+        # with mmap on cpu, parameters stay backed by the checkpoint files, so processes serving the same model share their pages
+        mmap = mmap and self.device.type == 'cpu'
+        start_time = time.time()
+        if snapshot_model is not None and self.load_snapshot(snapshot_model, [llm_model, flow_model, hift_model], mmap) is True:
+            logging.info('models loaded from snapshot {} in {:.2f}s'.format(snapshot_model, time.time() - start_time))
+            return
+        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device, mmap=mmap), strict=True, assign=mmap)
         self.llm.to(self.device).eval()
-        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device), strict=True)
+        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device, mmap=mmap), strict=True, assign=mmap)
         self.flow.to(self.device).eval()
-        # in case hift_model is a hifigan model
-        hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device).items()}
-        self.hift.load_state_dict(hift_state_dict, strict=True)
+        for module in list(self.llm.modules()) + list(self.flow.modules()):
+            if isinstance(module, ConvolutionModule):
+                module.fold_batch_norm()
+        self.load_hift(hift_model, mmap)
+        logging.info('models loaded in {:.2f}s'.format(time.time() - start_time))
+        if snapshot_model is not None:
+            self.save_snapshot(snapshot_model)
+
+    def prepare_inference(self):
+        """the structural rewrites of load, batch norm folded into the conformer convs and hift weight norm removed"""
+        self.llm.eval()
+        self.flow.eval()
+        for module in list(self.llm.modules()) + list(self.flow.modules()):
+            if isinstance(module, ConvolutionModule):
+                module.fold_batch_norm()
+        self.hift.remove_weight_norm()
+
+    def load_snapshot(self, snapshot_model, source_models, mmap=False):
+        """load the prepared state dicts of save_snapshot, returns False when the snapshot is missing, older than one of
+        source_models or of another version. The snapshot is always memory mapped, without mmap it is copied into the modules"""
+        if not os.path.exists(snapshot_model) or any(os.path.getmtime(snapshot_model) < os.path.getmtime(i) for i in source_models):
+            return False
+        snapshot = torch.load(snapshot_model, map_location=self.device, mmap=True)
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logging.info('snapshot {} is of version {}, expected {}'.format(snapshot_model, snapshot.get('version'), SNAPSHOT_VERSION))
+            return False
+        # the fresh modules get the same structure as the prepared ones, their uninitialized values are overwritten
+        self.prepare_inference()
+        for name in ['llm', 'flow', 'hift']:
+            module = getattr(self, name)
+            module.load_state_dict(snapshot[name], strict=True, assign=mmap)
+            module.to(self.device).eval()
+        return True
+
+    def save_snapshot(self, snapshot_model):
+        """save the prepared llm, flow and hift in one file for load_snapshot"""
+        try:
+            # write then rename, a concurrent load never reads a partial snapshot
+            tmp_snapshot_model = '{}.{}.tmp'.format(snapshot_model, os.getpid())
+            torch.save({'version': SNAPSHOT_VERSION, 'llm': self.llm.state_dict(), 'flow': self.flow.state_dict(),
+                        'hift': self.hift.state_dict()}, tmp_snapshot_model)
+            os.replace(tmp_snapshot_model, snapshot_model)
+        except OSError as e:
+            logging.warning('failed to save the model snapshot to {}, {}'.format(snapshot_model, e))
+
+    def load_hift(self, hift_model, mmap=False):
+        """load hift with its weight norm folded into the conv weights, the folded state dict is cached next to hift_model,
+        later loads skip the folding and with mmap share the pages of the cache file"""
+        prepared_hift_model = '{}.inference.pt'.format(os.path.splitext(hift_model)[0])
+        if os.path.exists(prepared_hift_model) and os.path.getmtime(prepared_hift_model) >= os.path.getmtime(hift_model):
+            self.hift.remove_weight_norm()
+            self.hift.load_state_dict(torch.load(prepared_hift_model, map_location=self.device, mmap=mmap), strict=True, assign=mmap)
+        else:
+            # in case hift_model is a hifigan model
+            hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device, mmap=mmap).items()}
+            self.hift.load_state_dict(hift_state_dict, strict=True, assign=mmap)
+            self.hift.remove_weight_norm()
+            try:
+                # write then rename, a concurrent load never reads a partial cache
+                tmp_hift_model = '{}.{}.tmp'.format(prepared_hift_model, os.getpid())
+                torch.save(self.hift.state_dict(), tmp_hift_model)
+                os.replace(tmp_hift_model, prepared_hift_model)
+            except OSError as e:
+                logging.warning('failed to cache the inference hift to {}, {}'.format(prepared_hift_model, e))
         self.hift.to(self.device).eval()
 
+    def set_deterministic(self, deterministic=True):
+        """synthesize the vocoder source without random noise and phases. With the fixed flow noise of CosyVoice2/3 the same
+        speech tokens then always give the same waveform, the llm still samples the tokens and the CosyVoice1 flow its noise"""
+        self.hift.m_source.set_deterministic(deterministic)
+
+    def job_running(self, this_uuid):
+        """keep of hift_cache_dict, a session is not reaped while its llm job runs, however long it takes"""
+        # no lock, it is called under the lock of hift_cache_dict
+        return self.llm_end_dict.get(this_uuid) is False
+
+    def drop_session(self, this_uuid, hift_cache=None):
+        """on_evict of hift_cache_dict, drops the state of an abandoned session. While its llm job is still running
+        the job appends to the shared dicts, then the job drops the session when it ends"""
+        with self.lock:
+            if self.llm_end_dict.get(this_uuid) is not True:
+                return
+            for session_dict in [self.tts_speech_token_dict, self.llm_end_dict, getattr(self, 'mel_overlap_dict', {}), getattr(self, 'flow_cache_dict', {})]:
+                session_dict.pop(this_uuid, None)
+
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
         self.llm.text_encoder = llm_text_encoder
@@ -101,31 +196,39 @@ class CosyVoiceModel:
         with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
             if isinstance(text, Generator):
                 assert (self.__class__.__name__ != 'CosyVoiceModel') and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2/3 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
+                token_generator = self.llm.inference_bistream(text=text,
+                                                              prompt_text=prompt_text.to(self.device),
+                                                              prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                                              prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                              prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                              embedding=llm_embedding.to(self.device))
+            else:
+                token_generator = self.llm.inference(text=text.to(self.device),
+                                                     text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
                                                      prompt_text=prompt_text.to(self.device),
                                                      prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
                                                      prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
-            else:
-                for i in self.llm.inference(text=text.to(self.device),
-                                            text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_text=prompt_text.to(self.device),
-                                            prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                            prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                            prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                            embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+                                                     embedding=llm_embedding.to(self.device),
+                                                     uuid=uuid)
+            for i in metrics.track_tokens(token_generator):
+                self.tts_speech_token_dict[uuid].append(i)
+                self.hift_cache_dict.touch(uuid)
+        self.end_job(uuid)
 
     def vc_job(self, source_speech_token, uuid):
         self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
+        self.end_job(uuid)
+
+    def end_job(self, uuid):
+        with self.lock:
+            self.llm_end_dict[uuid] = True
+            # the session expired while the job was running, nothing consumes its tokens any more
+            if uuid not in self.hift_cache_dict:
+                self.drop_session(uuid)
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
+        with torch.cuda.amp.autocast(self.fp16), metrics.timer('cosyvoice_flow_seconds', uuid=uuid):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                                                       prompt_token=prompt_token.to(self.device),
@@ -137,33 +240,40 @@ class CosyVoiceModel:
 
         # mel overlap fade in out
         if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+            tts_mel = overlap_add(tts_mel, self.mel_overlap_dict[uuid], self.mel_overlap_len)
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+            hift_cache_phase = self.hift_cache_dict[uuid]['phase']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
-            hift_cache_source = torch.zeros(1, 1, 0)
+            hift_cache_source, hift_cache_phase = torch.zeros(1, 1, 0), torch.zeros(0, 0, 0)
         # keep overlap mel and hift cache
         if finalize is False:
             self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with metrics.timer('cosyvoice_hift_seconds', uuid=uuid):
+                tts_speech, tts_source, tts_phase = self.hift.inference_chunk(speech_feat=tts_mel, cache_source=hift_cache_source,
+                                                                              cache_phase=hift_cache_phase)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = overlap_add(tts_speech, self.hift_cache_dict[uuid]['speech'], self.source_cache_len, self.equal_power_fade)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
                                           'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+                                          'speech': tts_speech[:, -self.source_cache_len:],
+                                          'phase': tts_phase}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with metrics.timer('cosyvoice_hift_seconds', uuid=uuid):
+                tts_speech, tts_source, _ = self.hift.inference_chunk(speech_feat=tts_mel, cache_source=hift_cache_source,
+                                                                      cache_phase=hift_cache_phase, finalize=True)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = overlap_add(tts_speech, self.hift_cache_dict[uuid]['speech'], self.source_cache_len, self.equal_power_fade)
         return tts_speech
 
+    @metrics.track_session
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
@@ -181,54 +291,58 @@ class CosyVoiceModel:
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+        try:
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                while True:
+                    time.sleep(0.1)
+                    # the stream is being consumed, keep the session fresh while it waits for tokens
+                    self.hift_cache_dict.touch(this_uuid)
+                    if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         uuid=this_uuid,
+                                                         finalize=False)
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        with self.lock:
+                            self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                        break
+                p.join()
+                self.hift_cache_dict.touch(this_uuid)
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                self.hift_cache_dict.touch(this_uuid)
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            with self.lock:
+                self.hift_cache_dict.pop(this_uuid, None)
+                # also reached when the generator is closed early, a job still running drops the session in end_job
+                self.drop_session(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -251,20 +365,49 @@ class CosyVoice2Model(CosyVoiceModel):
         # hift cache
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        # speech fade in out, hamming by default, equal power keeps the loudness of uncorrelated chunks
+        self.equal_power_fade = False
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        # session not accessed for 600s is treated as abandoned, e.g. the tts generator is not fully consumed
+        self.hift_cache_dict = CacheManager(ttl=600, on_evict=self.drop_session, keep=self.job_running)
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
 
+    def load_compiled(self, compile_cache_dir, max_mel_len=500, warmup=True):
+        """torch.compile the flow estimator and the hift convs with static shapes, inputs are padded to buckets of one
+        token_hop_len chunk of mel frames, inductor artifacts are kept in compile_cache_dir for warm starts.
+        With warmup every bucket is compiled here and requests never compile, longer mels than max_mel_len (prompt and
+        speech, 10s by default) run eagerly. Without warmup a bucket compiles in the first request that needs it."""
+        mel_hop_len = self.token_hop_len * self.flow.token_mel_ratio
+        estimator_buckets = length_buckets(mel_hop_len, max_mel_len)
+        hift_decode_spec, hift_channels = self.compile_hift(mel_hop_len, max_mel_len)
+        # the estimator has a streaming and a full context graph per bucket
+        enable_compile_cache(compile_cache_dir, 2 * len(estimator_buckets) + len(hift_decode_spec.buckets))
+        # a tensorrt estimator is already compiled, only hift is left
+        compile_estimator = isinstance(self.flow.decoder.estimator, torch.nn.Module)
+        if compile_estimator:
+            self.flow.decoder.estimator = CompiledEstimator(self.flow.decoder.estimator, estimator_buckets)
+        self.hift.decode_spec = hift_decode_spec
+        if warmup:
+            start_time = time.time()
+            if compile_estimator:
+                with torch.cuda.amp.autocast(self.fp16):
+                    self.flow.decoder.estimator.warmup(self.device, torch.float16 if self.fp16 is True else torch.float32)
+            self.hift.decode_spec.warmup(hift_channels, self.device)
+            logging.info('{} estimator and {} hift buckets compiled in {:.2f}s'.format(
+                len(estimator_buckets), len(hift_decode_spec.buckets), time.time() - start_time))
+
+    def compile_hift(self, mel_hop_len, max_mel_len):
+        # decode_spec is not causal, only a steady streaming chunk is compiled, the mel cache followed by one chunk of new frames
+        return CompiledDecodeSpec(self.hift, [self.mel_cache_len + mel_hop_len], pad=False), self.hift.conv_pre.in_channels
+
     def load_vllm(self, model_dir):
         export_cosyvoice2_vllm(self.llm, model_dir, self.device)
         from vllm import EngineArgs, LLMEngine
@@ -277,7 +420,7 @@ class CosyVoice2Model(CosyVoiceModel):
         del self.llm.llm.model.model.layers
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
+        with torch.cuda.amp.autocast(self.fp16), metrics.timer('cosyvoice_flow_seconds', uuid=uuid):
             tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                              prompt_token=prompt_token.to(self.device),
@@ -291,27 +434,34 @@ class CosyVoice2Model(CosyVoiceModel):
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+            hift_cache_phase = self.hift_cache_dict[uuid]['phase']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
-            hift_cache_source = torch.zeros(1, 1, 0)
+            hift_cache_source, hift_cache_phase = torch.zeros(1, 1, 0), torch.zeros(0, 0, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with metrics.timer('cosyvoice_hift_seconds', uuid=uuid):
+                tts_speech, tts_source, tts_phase = self.hift.inference_chunk(speech_feat=tts_mel, cache_source=hift_cache_source,
+                                                                              cache_phase=hift_cache_phase)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = overlap_add(tts_speech, self.hift_cache_dict[uuid]['speech'], self.source_cache_len, self.equal_power_fade)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
                                           'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+                                          'speech': tts_speech[:, -self.source_cache_len:],
+                                          'phase': tts_phase}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with metrics.timer('cosyvoice_hift_seconds', uuid=uuid):
+                tts_speech, tts_source, _ = self.hift.inference_chunk(speech_feat=tts_mel, cache_source=hift_cache_source,
+                                                                      cache_phase=hift_cache_phase, finalize=True)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = overlap_add(tts_speech, self.hift_cache_dict[uuid]['speech'], self.source_cache_len, self.equal_power_fade)
         return tts_speech
 
+    @metrics.track_session
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
@@ -327,54 +477,61 @@ class CosyVoice2Model(CosyVoiceModel):
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+        try:
+            if stream is True:
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    time.sleep(0.1)
+                    # the stream is being consumed, keep the session fresh while it waits for tokens
+                    self.hift_cache_dict.touch(this_uuid)
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                    if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=token_offset,
+                                                         uuid=this_uuid,
+                                                         stream=stream,
+                                                         finalize=False)
+                        token_offset += this_token_hop_len
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                self.hift_cache_dict.touch(this_uuid)
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=token_offset,
+                                                 uuid=this_uuid,
+                                                 finalize=True)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                self.hift_cache_dict.touch(this_uuid)
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            with self.lock:
+                self.hift_cache_dict.pop(this_uuid, None)
+                # also reached when the generator is closed early, a job still running drops the session in end_job
+                self.drop_session(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -396,23 +553,29 @@ class CosyVoice3Model(CosyVoice2Model):
         self.token_hop_len = 25
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        # session not accessed for 600s is treated as abandoned, e.g. the tts generator is not fully consumed
+        self.hift_cache_dict = CacheManager(ttl=600, on_evict=self.drop_session, keep=self.job_running)
+
+    def compile_hift(self, mel_hop_len, max_mel_len):
+        # every chunk vocodes the whole mel so far, the causal decode_spec is padded to buckets and takes the output of conv_pre
+        return CompiledDecodeSpec(self.hift, length_buckets(mel_hop_len, max_mel_len)), self.hift.conv_pre.out_channels
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
+            with metrics.timer('cosyvoice_flow_seconds', uuid=uuid):
+                tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                 token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_token=prompt_token.to(self.device),
+                                                 prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=prompt_feat.to(self.device),
+                                                 prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                 embedding=embedding.to(self.device),
+                                                 streaming=stream,
+                                                 finalize=finalize)
             tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
             # append mel cache
             if self.hift_cache_dict[uuid] is not None:
@@ -424,7 +587,8 @@ class CosyVoice3Model(CosyVoice2Model):
             if speed != 1.0:
                 assert token_offset == 0 and finalize is True, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
+            with metrics.timer('cosyvoice_hift_seconds', uuid=uuid):
+                tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
             tts_speech = tts_speech[:, self.hift_cache_dict[uuid]['speech_offset']:]
             self.hift_cache_dict[uuid]['speech_offset'] += tts_speech.shape[1]
         return tts_speech
@@ -15,10 +15,17 @@
 
 import random
 import math
+import inspect
+import json
+import logging
+import os
+from io import BytesIO
 from functools import partial
 
+import pyarrow.parquet as pq
 import torch
 import torch.distributed as dist
+import torchaudio
 from torch.utils.data import IterableDataset
 from cosyvoice.utils.file_utils import read_lists
 
@@ -51,7 +58,9 @@ class Processor(IterableDataset):
 class DistributedSampler:
 
     def __init__(self, shuffle=True, partition=True):
-        self.epoch = -1
+        # epoch lives in shared memory, so that set_epoch in main process
+        # also takes effect in persistent DataLoader workers
+        self._epoch = torch.full((1,), -1, dtype=torch.int64).share_memory_()
         self.update()
         self.shuffle = shuffle
         self.partition = partition
@@ -76,8 +85,12 @@ class DistributedSampler:
                     worker_id=self.worker_id,
                     num_workers=self.num_workers)
 
+    @property
+    def epoch(self):
+        return int(self._epoch.item())
+
     def set_epoch(self, epoch):
-        self.epoch = epoch
+        self._epoch.fill_(epoch)
 
     def sample(self, data):
         """ Sample data according to rank/world_size/num_workers
@@ -104,6 +117,148 @@ class DistributedSampler:
         return data
 
 
+class LengthBucketSampler(DistributedSampler):
+
+    def __init__(self, shuffle=True, partition=True, max_frames_in_batch=12000, feat_frame_rate=50, drop_uneven=True,
+                 max_length=float('inf'), min_length=0):
+        super().__init__(shuffle, partition)
+        self.max_frames_in_batch = max_frames_in_batch
+        self.feat_frame_rate = feat_frame_rate
+        self.drop_uneven = drop_uneven
+        # length limits of processor.filter in 10ms frames, applied before planning so no planned batch is emptied later
+        self.max_length = max_length
+        self.min_length = min_length
+
+    def bucket(self, durations, rng):
+        """ Pack the utterances of one shard into length sorted batches,
+            utterances out of [min_length, max_length] are left out
+
+            Args:
+                durations(List[float]): utterance durations in seconds
+                rng(random.Random): epoch seeded random generator
+
+            Returns:
+                List[List[int]]: row indexes of each batch
+                int: total frames
+                int: total frames after padding
+        """
+        frames = [int(d * self.feat_frame_rate) for d in durations]
+        rows = [i for i, d in enumerate(durations) if self.min_length <= d * 100 <= self.max_length]
+        if self.shuffle:
+            # shuffle before the stable sort, so utts with same length do not always share a batch
+            rng.shuffle(rows)
+        rows.sort(key=lambda i: frames[i])
+        batches, buf, longest_frames = [], [], 0
+        total_frames, padded_frames = 0, 0
+        for i in rows:
+            new_longest_frames = max(longest_frames, frames[i])
+            if len(buf) > 0 and new_longest_frames * (len(buf) + 1) > self.max_frames_in_batch:
+                batches.append(buf)
+                padded_frames += longest_frames * len(buf)
+                buf, new_longest_frames = [], frames[i]
+            buf.append(i)
+            longest_frames = new_longest_frames
+            total_frames += frames[i]
+        if len(buf) > 0:
+            batches.append(buf)
+            padded_frames += longest_frames * len(buf)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches, total_frames, padded_frames
+
+    def sample_batches(self, lists, length_index):
+        """ Plan length bucketed batches according to rank/world_size/num_workers.
+            Every rank/worker computes the same global plan from the epoch seed,
+            so no communication is needed. Shards are assigned to ranks greedily by
+            padded frames, then all ranks keep the same number of batches, so that
+            cosyvoice_join does not wait on uneven ranks.
+
+            Args:
+                lists(List[str]): shard list
+                length_index(Dict[str, List[float]]): utterance durations of each shard
+
+            Returns:
+                List[Tuple[int, List[List[int]]]]: shard index and its batches for this worker
+                Dict: padding efficiency statistics of this epoch
+        """
+        rng = random.Random(self.epoch)
+        shards = list(range(len(lists)))
+        if self.partition and len(shards) < self.world_size:
+            shards = shards * math.ceil(self.world_size / len(shards))
+            shards = shards[:self.world_size]
+        plans = [(index, *self.bucket(length_index[lists[index]], rng)) for index in shards]
+        if self.shuffle:
+            rng.shuffle(plans)
+        # longest processing time first, balance padded frames across ranks
+        world_size = self.world_size if self.partition else 1
+        rank = self.rank if self.partition else 0
+        rank_plans, rank_frames = [[] for _ in range(world_size)], [0] * world_size
+        for plan in sorted(plans, key=lambda x: x[3], reverse=True):
+            i = min(range(world_size), key=lambda j: rank_frames[j])
+            rank_plans[i].append(plan)
+            rank_frames[i] += plan[3]
+        rank_num_batches = [sum(len(x[1]) for x in p) for p in rank_plans]
+        num_batches = min(rank_num_batches) if self.drop_uneven is True else rank_num_batches[rank]
+        # keep first num_batches batches of this rank in planned order
+        this_plans, kept = [], 0
+        for index, batches, _, _ in rank_plans[rank]:
+            batches = batches[:max(num_batches - kept, 0)]
+            kept += len(batches)
+            if len(batches) > 0:
+                this_plans.append((index, batches))
+        # assign shards of this rank to workers, also balance by number of batches
+        worker_plans, worker_batches = [[] for _ in range(self.num_workers)], [0] * self.num_workers
+        for plan in sorted(this_plans, key=lambda x: len(x[1]), reverse=True):
+            i = min(range(self.num_workers), key=lambda j: worker_batches[j])
+            worker_plans[i].append(plan)
+            worker_batches[i] += len(plan[1])
+        if self.shuffle:
+            rng.shuffle(worker_plans[self.worker_id])
+        stats = dict(num_batches=sum(len(x[1]) for x in plans),
+                     num_dropped_batches=sum(rank_num_batches) - num_batches * world_size if self.drop_uneven is True else 0,
+                     padding_efficiency=sum(x[2] for x in plans) / max(sum(x[3] for x in plans), 1),
+                     rank_frames=rank_frames)
+        return worker_plans[self.worker_id], stats
+
+
+def load_length_index(lists, cache_file=''):
+    """ Load utterance durations of every parquet shard, the index is
+        cached in cache_file so that it is only computed once.
+
+        Args:
+            lists(List[str]): shard list
+            cache_file(str): json file to cache the index
+
+        Returns:
+            Dict[str, List[float]]: utterance durations of each shard, in seconds
+    """
+    length_index = {}
+    if cache_file != '' and os.path.exists(cache_file):
+        with open(cache_file, 'r', encoding='utf8') as fin:
+            length_index = json.load(fin)
+    missing = [url for url in lists if url not in length_index]
+    for url in missing:
+        schema = pq.read_schema(url)
+        if 'duration' in schema.names:
+            length_index[url] = pq.read_table(url, columns=['duration']).column('duration').to_pylist()
+        else:
+            # old parquet without duration column, parse audio header once
+            durations = []
+            for audio_data in pq.read_table(url, columns=['audio_data']).column('audio_data').to_pylist():
+                info = torchaudio.info(BytesIO(audio_data))
+                durations.append(info.num_frames / info.sample_rate)
+            length_index[url] = durations
+    if cache_file != '' and len(missing) > 0:
+        try:
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w', encoding='utf8') as fout:
+                json.dump(length_index, fout)
+            os.replace(tmp_file, cache_file)
+        except OSError as ex:
+            logging.warning('Failed to save length index {}, ex info {}'.format(cache_file, ex))
+    return length_index
+
+
 class DataList(IterableDataset):
 
     def __init__(self, lists, shuffle=True, partition=True):
@@ -122,6 +277,29 @@ class DataList(IterableDataset):
             yield data
 
 
+class BucketDataList(IterableDataset):
+
+    def __init__(self, lists, length_index, shuffle=True, partition=True, max_frames_in_batch=12000, feat_frame_rate=50, drop_uneven=True,
+                 max_length=float('inf'), min_length=0):
+        self.lists = lists
+        self.length_index = length_index
+        self.sampler = LengthBucketSampler(shuffle, partition, max_frames_in_batch, feat_frame_rate, drop_uneven, max_length, min_length)
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        sampler_info = self.sampler.update()
+        plans, stats = self.sampler.sample_batches(self.lists, self.length_index)
+        if sampler_info['rank'] == 0 and sampler_info['worker_id'] == 0:
+            logging.info('Epoch {} bucket sampler: {} batches, {} dropped for even ranks, padding efficiency {:.4f}, rank frames {}'.format(
+                self.sampler.epoch, stats['num_batches'], stats['num_dropped_batches'], stats['padding_efficiency'], stats['rank_frames']))
+        for index, batches in plans:
+            data = dict(src=self.lists[index], batches=[((index, i), rows) for i, rows in enumerate(batches)])
+            data.update(sampler_info)
+            yield data
+
+
 def Dataset(data_list_file,
             data_pipeline,
             mode='train',
@@ -141,9 +319,26 @@ def Dataset(data_list_file,
             partition(bool): whether to do data partition in terms of rank
     """
     lists = read_lists(data_list_file)
-    dataset = DataList(lists,
-                       shuffle=shuffle,
-                       partition=partition)
+    # use length bucketed batches planned over all shards if bucket_batch is in pipeline
+    bucket_conf, length_conf = None, {}
+    for func in data_pipeline:
+        if func.func.__name__ == 'bucket_batch':
+            bucket_conf = {k: v for k, v in func.keywords.items() if k in ['max_frames_in_batch', 'feat_frame_rate', 'drop_uneven']}
+        if func.func.__name__ == 'filter':
+            # the signature of the partial holds the configured limits or the defaults of filter
+            length_conf = {k: inspect.signature(func).parameters[k].default for k in ['max_length', 'min_length']}
+    if bucket_conf is not None:
+        bucket_conf.update(length_conf)
+        length_index = load_length_index(lists, '{}.len.json'.format(data_list_file))
+        dataset = BucketDataList(lists,
+                                 length_index,
+                                 shuffle=shuffle,
+                                 partition=partition,
+                                 **bucket_conf)
+    else:
+        dataset = DataList(lists,
+                           shuffle=shuffle,
+                           partition=partition)
     # map partial arg to padding func
     for i in range(1, len(data_pipeline)):
         if data_pipeline[i].func.__name__ == 'compute_fbank':
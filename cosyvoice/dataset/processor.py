@@ -16,9 +16,9 @@ import random
 
 import pyarrow.parquet as pq
 from io import BytesIO
+import numpy as np
 import torch
 import torchaudio
-from torch.nn.utils.rnn import pad_sequence
 import torch.nn.functional as F
 import pyworld as pw
 
@@ -40,6 +40,17 @@ def parquet_opener(data, mode='train'):
         assert 'src' in sample
         url = sample['src']
         try:
+            if 'batches' in sample:
+                # batches planned by LengthBucketSampler, read the shard once and take rows of each batch
+                batches = sample.pop('batches')
+                table = pq.read_table(url)
+                for batch_id, rows in batches:
+                    df = table.take(rows).to_pandas()
+                    for i in range(len(df)):
+                        sample.update(dict(df.loc[i]))
+                        sample['batch_id'] = batch_id
+                        yield {**sample}
+                continue
             for df in pq.ParquetFile(url).iter_batches(batch_size=64):
                 df = df.to_pandas()
                 for i in range(len(df)):
@@ -84,10 +95,13 @@ def filter(data,
         del sample['audio_data']
         # sample['wav'] is torch.Tensor, we have 100 frames every second
         num_frames = sample['speech'].size(1) / sample['sample_rate'] * 100
-        if num_frames < min_length:
-            continue
-        if num_frames > max_length:
-            continue
+        # LengthBucketSampler already applied the length limits to the planned batches,
+        # dropping a planned utterance here could leave its batch empty on one rank only
+        if 'batch_id' not in sample:
+            if num_frames < min_length:
+                continue
+            if num_frames > max_length:
+                continue
         if len(sample['text_token']) < token_min_length:
             continue
         if len(sample['text_token']) > token_max_length:
@@ -237,11 +251,11 @@ def tokenize(data, get_tokenizer, allowed_special, mode='train'):
     tokenizer = get_tokenizer()
     for sample in data:
         assert 'text' in sample
-        sample['text_token'] = tokenizer.encode(sample['text'], allowed_special=allowed_special)
+        sample['text_token'] = np.array(tokenizer.encode(sample['text'], allowed_special=allowed_special), dtype=np.int64)
         if 'instruct' in sample:
-            sample['instruct_token'] = tokenizer.encode(sample['instruct'], allowed_special=allowed_special)
+            sample['instruct_token'] = np.array(tokenizer.encode(sample['instruct'], allowed_special=allowed_special), dtype=np.int64)
         else:
-            sample['instruct_token'] = tokenizer.encode('', allowed_special=allowed_special)
+            sample['instruct_token'] = np.array(tokenizer.encode('', allowed_special=allowed_special), dtype=np.int64)
         yield sample
 
 
@@ -357,6 +371,65 @@ def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000, m
         logging.fatal('Unsupported batch type {}'.format(batch_type))
 
 
+def bucket_batch(data, max_frames_in_batch=12000, feat_frame_rate=50, drop_uneven=True, mode='train'):
+    """ Group samples of the same batch planned by LengthBucketSampler.
+        The planned batches are kept as they are, so that every rank
+        yields the number of batches the sampler planned for it.
+
+        Args:
+            data: Iterable[{key, feat, label, batch_id}]
+            max_frames_in_batch: max_frames in one batch, used by LengthBucketSampler
+            feat_frame_rate: speech_feat frames per second, used by LengthBucketSampler
+            drop_uneven: keep same number of batches for all ranks, used by LengthBucketSampler
+
+        Returns:
+            Iterable[List[{key, feat, label}]]
+    """
+    buf = []
+    for sample in data:
+        assert 'batch_id' in sample, 'bucket_batch should be used with LengthBucketSampler'
+        if len(buf) > 0 and sample['batch_id'] != buf[-1]['batch_id']:
+            yield buf
+            buf = []
+        buf.append(sample)
+    if len(buf) > 0:
+        yield buf
+
+
+def pad_tokens(tokens, padding_value=0):
+    """ Pad token arrays into one preallocated (B, T) tensor,
+        numpy token arrays from parquet are copied in directly
+        without building a tensor for each sample
+
+        Args:
+            tokens: List[np.ndarray or List[int]]
+
+        Returns:
+            Tuple(torch.Tensor(B, T), torch.Tensor(B))
+    """
+    lengths = np.array([len(x) for x in tokens], dtype=np.int32)
+    padded = np.full((len(tokens), lengths.max(initial=0)), padding_value, dtype=np.int64)
+    for i, x in enumerate(tokens):
+        padded[i, :lengths[i]] = x
+    return torch.from_numpy(padded), torch.from_numpy(lengths)
+
+
+def pad_feats(feats, padding_value=0):
+    """ Pad feature tensors into one preallocated (B, T, *) tensor
+
+        Args:
+            feats: List[torch.Tensor(T, *)]
+
+        Returns:
+            Tuple(torch.Tensor(B, T, *), torch.Tensor(B))
+    """
+    lengths = torch.tensor([x.size(0) for x in feats], dtype=torch.int32)
+    padded = feats[0].new_full((len(feats), int(lengths.max()), *feats[0].shape[1:]), padding_value)
+    for i, x in enumerate(feats):
+        padded[i, :x.size(0)] = x
+    return padded, lengths
+
+
 def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
     """ Padding the data into training data
 
@@ -368,37 +441,20 @@ def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
     """
     for sample in data:
         assert isinstance(sample, list)
-        speech_feat_len = torch.tensor([x['speech_feat'].size(1) for x in sample],
-                                       dtype=torch.int32)
-        order = torch.argsort(speech_feat_len, descending=True)
-
-        utts = [sample[i]['utt'] for i in order]
-        speech = [sample[i]['speech'].squeeze(dim=0) for i in order]
-        speech_len = torch.tensor([i.size(0) for i in speech], dtype=torch.int32)
-        speech = pad_sequence(speech, batch_first=True, padding_value=0)
-        speech_token = [torch.tensor(sample[i]['speech_token']) for i in order]
-        speech_token_len = torch.tensor([i.size(0) for i in speech_token], dtype=torch.int32)
-        speech_token = pad_sequence(speech_token,
-                                    batch_first=True,
-                                    padding_value=0)
-        speech_feat = [sample[i]['speech_feat'] for i in order]
-        speech_feat_len = torch.tensor([i.size(0) for i in speech_feat], dtype=torch.int32)
-        speech_feat = pad_sequence(speech_feat,
-                                   batch_first=True,
-                                   padding_value=0)
-        text = [sample[i]['text'] for i in order]
-        text_token = [torch.tensor(sample[i]['text_token']) for i in order]
-        text_token_len = torch.tensor([i.size(0) for i in text_token], dtype=torch.int32)
-        text_token = pad_sequence(text_token, batch_first=True, padding_value=0)
-        instruct_token = [torch.tensor(sample[i]['instruct_token']) for i in order]
-        instruct_token_len = torch.tensor([i.size(0) for i in instruct_token], dtype=torch.int32)
-        instruct_token = pad_sequence(instruct_token, batch_first=True, padding_value=0)
-        utt_embedding = torch.stack([sample[i]['utt_embedding'] for i in order], dim=0)
-        spk_embedding = torch.stack([sample[i]['spk_embedding'] for i in order], dim=0)
+        speech_feat_len = [x['speech_feat'].size(0) for x in sample]
+        order = sorted(range(len(sample)), key=lambda i: speech_feat_len[i], reverse=True)
+        sample = [sample[i] for i in order]
+
+        utts = [x['utt'] for x in sample]
+        speech_token, speech_token_len = pad_tokens([x['speech_token'] for x in sample])
+        speech_feat, speech_feat_len = pad_feats([x['speech_feat'] for x in sample])
+        text = [x['text'] for x in sample]
+        text_token, text_token_len = pad_tokens([x['text_token'] for x in sample])
+        instruct_token, instruct_token_len = pad_tokens([x['instruct_token'] for x in sample])
+        utt_embedding = torch.stack([x['utt_embedding'] for x in sample], dim=0)
+        spk_embedding = torch.stack([x['spk_embedding'] for x in sample], dim=0)
         batch = {
             "utts": utts,
-            "speech": speech,
-            "speech_len": speech_len,
             "speech_token": speech_token,
             "speech_token_len": speech_token_len,
             "speech_feat": speech_feat,
@@ -412,24 +468,15 @@ def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
             "spk_embedding": spk_embedding,
         }
         if gan is True:
-            # in gan train, we need pitch_feat
-            pitch_feat = [sample[i]['pitch_feat'] for i in order]
-            pitch_feat_len = torch.tensor([i.size(0) for i in pitch_feat], dtype=torch.int32)
-            pitch_feat = pad_sequence(pitch_feat,
-                                      batch_first=True,
-                                      padding_value=0)
+            # in gan train, we need speech and pitch_feat, other train does not pad speech to save memory
+            speech, speech_len = pad_feats([x['speech'].squeeze(dim=0) for x in sample])
+            pitch_feat, pitch_feat_len = pad_feats([x['pitch_feat'] for x in sample])
+            batch["speech"] = speech
+            batch["speech_len"] = speech_len
             batch["pitch_feat"] = pitch_feat
             batch["pitch_feat_len"] = pitch_feat_len
-        else:
-            # only gan train needs speech, delete it to save memory
-            del batch["speech"]
-            del batch["speech_len"]
         if dpo is True:
-            reject_speech_token = [torch.tensor(sample[i]['reject_speech_token']) for i in order]
-            reject_speech_token_len = torch.tensor([i.size(0) for i in reject_speech_token], dtype=torch.int32)
-            reject_speech_token = pad_sequence(reject_speech_token,
-                                               batch_first=True,
-                                               padding_value=0)
+            reject_speech_token, reject_speech_token_len = pad_tokens([x['reject_speech_token'] for x in sample])
             batch['reject_speech_token'] = reject_speech_token
             batch['reject_speech_token_len'] = reject_speech_token_len
         if use_spk_embedding is True:
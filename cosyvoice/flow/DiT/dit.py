@@ -77,6 +77,7 @@ class InputEmbedding(nn.Module):
     def __init__(self, mel_dim, text_dim, out_dim, spk_dim=None):
         super().__init__()
         spk_dim = 0 if spk_dim is None else spk_dim
+        self.mel_dim = mel_dim
         self.spk_dim = spk_dim
         self.proj = nn.Linear(mel_dim * 2 + text_dim + spk_dim, out_dim)
         self.conv_pos_embed = CausalConvPositionEmbedding(dim=out_dim)
@@ -87,16 +88,32 @@ class InputEmbedding(nn.Module):
             cond: float["b n d"],
             text_embed: float["b n d"],
             spks: float["b d"],
+            cond_proj: float["b n d"] | None = None,
     ):
-        to_cat = [x, cond, text_embed]
-        if self.spk_dim > 0:
-            spks = repeat(spks, "b c -> b t c", t=x.shape[1])
-            to_cat.append(spks)
-
-        x = self.proj(torch.cat(to_cat, dim=-1))
+        if cond_proj is None:
+            to_cat = [x, cond, text_embed]
+            if self.spk_dim > 0:
+                spks = repeat(spks, "b c -> b t c", t=x.shape[1])
+                to_cat.append(spks)
+            x = self.proj(torch.cat(to_cat, dim=-1))
+        else:
+            x = F.linear(x, self.proj.weight[:, :self.mel_dim]) + cond_proj
         x = self.conv_pos_embed(x) + x
         return x
 
+    def project_cond(
+            self,
+            cond: float["b n d"],
+            text_embed: float["b n d"],
+            spks: float["b d"],
+    ):
+        # proj of everything but x, it does not change between solver steps
+        to_cat = [cond, text_embed]
+        if self.spk_dim > 0:
+            spks = repeat(spks, "b c -> b t c", t=cond.shape[1])
+            to_cat.append(spks)
+        return F.linear(torch.cat(to_cat, dim=-1), self.proj.weight[:, self.mel_dim:], self.proj.bias)
+
 
 # Transformer backbone using DiT blocks
 
@@ -142,31 +159,37 @@ class DiT(nn.Module):
         self.static_chunk_size = static_chunk_size
         self.num_decoding_left_chunks = num_decoding_left_chunks
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def attention_mask(self, mask, streaming=False):
+        # full context only masks padded keys, sdpa broadcasts it over the queries so no (time, time) mask is built
+        if streaming is True:
+            return add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
+        return add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, 0, -1).unsqueeze(dim=1)
+
+    def prepare_cond(self, mask, mu, spks=None, cond=None, streaming=False):
+        """inputs of forward that do not depend on x and t, an ode solver computes them once for all timesteps"""
+        cond_proj = self.input_embed.project_cond(cond.transpose(1, 2), mu.transpose(1, 2), spks)
+        return cond_proj, self.rotary_embed.forward_from_seq_len(mu.shape[2]), self.attention_mask(mask, streaming)
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, prepared=None):
         x = x.transpose(1, 2)
-        mu = mu.transpose(1, 2)
-        cond = cond.transpose(1, 2)
-        spks = spks.unsqueeze(dim=1)
-        batch, seq_len = x.shape[0], x.shape[1]
+        batch = x.shape[0]
         if t.ndim == 0:
             t = t.repeat(batch)
 
         # t: conditioning time, c: context (text + masked cond audio), x: noised input audio
         t = self.time_embed(t)
-        x = self.input_embed(x, cond, mu, spks.squeeze(1))
-
-        rope = self.rotary_embed.forward_from_seq_len(seq_len)
+        if prepared is None:
+            x = self.input_embed(x, cond.transpose(1, 2), mu.transpose(1, 2), spks)
+            rope, attn_mask = self.rotary_embed.forward_from_seq_len(x.shape[1]), self.attention_mask(mask, streaming)
+        else:
+            cond_proj, rope, attn_mask = prepared
+            x = self.input_embed(x, None, None, None, cond_proj=cond_proj)
 
         if self.long_skip_connection is not None:
             residual = x
 
-        if streaming is True:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
-        else:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1).unsqueeze(dim=1)
-
         for block in self.transformer_blocks:
-            x = block(x, t, mask=attn_mask.bool(), rope=rope)
+            x = block(x, t, mask=attn_mask, rope=rope)
 
         if self.long_skip_connection is not None:
             x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
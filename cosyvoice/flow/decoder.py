@@ -85,6 +85,29 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
 
+class BroadcastMaskAttnProcessor:
+    """Self attention of the flow decoder with the attention mask handed to sdpa as it is.
+
+    AttnProcessor2_0 of diffusers copies the mask for every head, here it only has to broadcast to
+    (batch, heads, query, key), so a key padding mask stays (batch, 1, 1, key) and a chunk mask is shared by the heads.
+    """
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        batch_size = hidden_states.shape[0]
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+        head_dim = key.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+        return hidden_states
+
+
 class ConditionalDecoder(nn.Module):
     def __init__(
         self,
@@ -192,6 +215,7 @@ class ConditionalDecoder(nn.Module):
         self.final_block = Block1D(channels[-1], channels[-1])
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
+        self.set_attention_processor()
 
     def initialize_weights(self):
         for m in self.modules():
@@ -207,7 +231,34 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def set_attention_processor(self):
+        processor = BroadcastMaskAttnProcessor()
+        for blocks in [self.down_blocks, self.mid_blocks, self.up_blocks]:
+            for block in blocks:
+                for transformer_block in block[1]:
+                    transformer_block.attn1.set_processor(processor)
+
+    def attention_mask(self, mask, streaming=False):
+        """attention bias of one unet level, full context only masks padded keys so no (time, time) mask is built"""
+        attn_mask = add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, 0, -1)
+        return mask_to_bias(attn_mask, mask.dtype).unsqueeze(dim=1)
+
+    def prepare_cond(self, mask, mu, spks=None, cond=None, streaming=False):
+        """Inputs of forward that do not depend on x and t, so an ode solver computes them once for all timesteps.
+
+        Returns:
+            mu, spks and cond packed along the channels, and the attention bias of every down block level,
+            the mid and up blocks reuse the bias of the level with the same length.
+        """
+        mu = pack([mu, repeat(spks, "b c -> b c t", t=mu.shape[-1])], "b * t")[0] if spks is not None else mu
+        mu = pack([mu, cond], "b * t")[0] if cond is not None else mu
+        attn_masks = []
+        for _ in self.down_blocks:
+            attn_masks.append(self.attention_mask(mask, streaming))
+            mask = mask[:, :, ::2]
+        return mu, attn_masks
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, prepared=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -216,6 +267,7 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            prepared (tuple, optional): prepare_cond output of the same mask, mu, spks and cond. Defaults to None.
 
         Raises:
             ValueError: _description_
@@ -224,26 +276,21 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        if prepared is None:
+            prepared = self.prepare_cond(mask, mu, spks, cond, streaming)
+        mu, attn_masks = prepared
 
         t = self.time_embeddings(t).to(t.dtype)
         t = self.time_mlp(t)
 
         x = pack([x, mu], "b * t")[0]
 
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
-
         hiddens = []
         masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
+        for (resnet, transformer_blocks, downsample), attn_mask in zip(self.down_blocks, attn_masks):
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -260,24 +307,21 @@ class ConditionalDecoder(nn.Module):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
-                    attention_mask=attn_mask,
+                    attention_mask=attn_masks[-1],
                     timestep=t,
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
         for resnet, transformer_blocks, upsample in self.up_blocks:
             mask_up = masks.pop()
+            attn_mask = attn_masks[len(masks)]
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -401,94 +445,11 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_block = CausalBlock1D(channels[-1], channels[-1])
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
-
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
-        """Forward pass of the UNet1DConditional model.
-
-        Args:
-            x (torch.Tensor): shape (batch_size, in_channels, time)
-            mask (_type_): shape (batch_size, 1, time)
-            t (_type_): shape (batch_size)
-            spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
-            cond (_type_, optional): placeholder for future use. Defaults to None.
-
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
-
-        Returns:
-            _type_: _description_
-        """
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
-
-        hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            hiddens.append(x)  # Save hidden states for skip connections
-            x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
-
-        for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
-            skip = hiddens.pop()
-            x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
-        output = self.final_proj(x * mask_up)
-        return output * mask
+        self.set_attention_processor()
+
+    def attention_mask(self, mask, streaming=False):
+        """attention bias of one unet level, chunk causal when streaming"""
+        if streaming is True:
+            attn_mask = add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, self.static_chunk_size, -1)
+            return mask_to_bias(attn_mask, mask.dtype).unsqueeze(dim=1)
+        return super().attention_mask(mask, streaming)
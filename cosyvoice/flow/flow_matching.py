@@ -98,20 +98,22 @@ class ConditionalCFM(BASECFM):
         t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
         spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
         cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        # Classifier-Free Guidance inference introduced in VoiceBox, only x and t change between steps
+        mask_in[:] = mask
+        mu_in[0] = mu
+        spks_in[0] = spks
+        cond_in[0] = cond
+        prepared = self.prepare_estimator(mask_in, mu_in, spks_in, cond_in, streaming)
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
             x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
             t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
             dphi_dt = self.forward_estimator(
                 x_in, mask_in,
                 mu_in, t_in,
                 spks_in,
                 cond_in,
-                streaming
+                streaming,
+                prepared
             )
             dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
             dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
@@ -123,8 +125,16 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1].float()
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
+    def prepare_estimator(self, mask, mu, spks, cond, streaming=False):
+        # masks and conditioning of the estimator are the same at every solver step, a trt engine recomputes them
+        if isinstance(self.estimator, torch.nn.Module) and hasattr(self.estimator, 'prepare_cond'):
+            return self.estimator.prepare_cond(mask, mu, spks, cond, streaming=streaming)
+        return None
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False, prepared=None):
         if isinstance(self.estimator, torch.nn.Module):
+            if prepared is not None:
+                return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming, prepared=prepared)
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
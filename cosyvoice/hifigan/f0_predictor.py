@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import Optional
 import torch
 import torch.nn as nn
 try:
@@ -53,8 +54,13 @@ class ConvRNNF0Predictor(nn.Module):
         )
         self.classifier = nn.Linear(in_features=cond_channels, out_features=self.num_class)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = self.condnet(x)
+    def forward(self, x: torch.Tensor, x_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if x_mask is None:
+            x = self.condnet(x)
+        else:
+            # zero the padded frames of a batch before every layer, the same as padding each item alone
+            for layer in self.condnet:
+                x = layer(x * x_mask)
         x = x.transpose(1, 2)
         return torch.abs(self.classifier(x).squeeze(-1))
 
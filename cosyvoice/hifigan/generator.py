@@ -14,15 +14,14 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 import numpy as np
-from scipy.signal import get_window
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize
 try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
@@ -32,6 +31,16 @@ from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSamp
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.mask import make_pad_mask
+
+
+def remove_weight_norm(module):
+    """fold weight norm into the plain weight, for both the parametrization and the legacy hook implementation,
+    modules without weight norm are left as they are"""
+    if parametrize.is_parametrized(module, 'weight'):
+        parametrize.remove_parametrizations(module, 'weight')
+    elif hasattr(module, 'weight_g'):
+        torch.nn.utils.remove_weight_norm(module)
 
 
 """hifigan based generator implementation.
@@ -107,13 +116,18 @@ class ResBlock(torch.nn.Module):
             for _ in range(len(self.convs2))
         ])
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, x_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # x_mask (B, 1, T) zeros the padded frames before every conv, as snake(0) == 0 masking conv outputs is enough
         for idx in range(len(self.convs1)):
             xt = self.activations1[idx](x)
             xt = self.convs1[idx](xt)
+            if x_mask is not None:
+                xt = xt * x_mask
             xt = self.activations2[idx](xt)
             xt = self.convs2[idx](xt)
             x = xt + x
+            if x_mask is not None:
+                x = x * x_mask
         return x
 
     def remove_weight_norm(self):
@@ -147,6 +161,10 @@ class SineGen(torch.nn.Module):
         self.harmonic_num = harmonic_num
         self.sampling_rate = samp_rate
         self.voiced_threshold = voiced_threshold
+        # fundamental tone and overtones, multiplied with f0 in one broadcast
+        self.register_buffer('harmonics', torch.arange(1, harmonic_num + 2, dtype=torch.float32), persistent=False)
+        # no additive noise in inference, the same f0 always gives the same source
+        self.deterministic = False
 
     def _f02uv(self, f0):
         # generate uv signal
@@ -161,15 +179,34 @@ class SineGen(torch.nn.Module):
         output sine_tensor: tensor(batchsize=1, length, dim)
         output uv: tensor(batchsize=1, length, 1)
         """
+        sine_waves, uv, noise, _ = self.forward_chunk(f0)
+        return sine_waves, uv, noise
+
+    @torch.no_grad()
+    def forward_chunk(self, f0, cache=torch.zeros(0, 0, 0), finalize: bool = False):
+        """ sine_tensor, uv, noise, cache = forward_chunk(f0, cache, finalize)
+        streaming version of forward, the sines continue the phases of the previous chunk,
+        the phase is integrated per step, so the last chunk needs no special handling
+        input cache: tensor(batchsize, 2, dim), phase in cycles at the last step of the previous
+                     chunk and the random initial phase of every harmonic, (0, 0, 0) for the first chunk
+        output cache: tensor(batchsize, 2, dim) for the next chunk
+        """
         f0 = f0.transpose(1, 2)
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
+        F_mat = f0 * self.harmonics.unsqueeze(1) / self.sampling_rate
 
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        if cache.size(0) == 0:
+            if self.deterministic is True and self.training is False:
+                phase_vec = torch.zeros(f0.size(0), self.harmonic_num + 1, 1, device=F_mat.device)
+            else:
+                u_dist = Uniform(low=-np.pi, high=np.pi)
+                phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+                phase_vec[:, 0, :] = 0
+            cycles = torch.cumsum(F_mat, dim=-1) % 1
+        else:
+            phase_vec = cache[:, 1].unsqueeze(2)
+            cycles = (torch.cumsum(F_mat, dim=-1) + cache[:, 0].unsqueeze(2)) % 1
+        cache = torch.stack([cycles[:, :, -1], phase_vec[:, :, 0]], dim=1)
+        theta_mat = 2 * np.pi * cycles
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -177,6 +214,9 @@ class SineGen(torch.nn.Module):
         # generate uv signal
         uv = self._f02uv(f0)
 
+        if self.deterministic is True and self.training is False:
+            return sine_waves.mul_(uv).transpose(1, 2), uv.transpose(1, 2), torch.zeros_like(uv).transpose(1, 2), cache
+
         # noise: for unvoiced should be similar to sine_amp
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
@@ -185,8 +225,8 @@ class SineGen(torch.nn.Module):
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
-        sine_waves = sine_waves * uv + noise
-        return sine_waves.transpose(1, 2), uv.transpose(1, 2), noise
+        sine_waves = sine_waves.mul_(uv).add_(noise)
+        return sine_waves.transpose(1, 2), uv.transpose(1, 2), noise, cache
 
 
 class SineGen2(torch.nn.Module):
@@ -224,15 +264,57 @@ class SineGen2(torch.nn.Module):
             self.rand_ini = torch.rand(1, 9)
             self.rand_ini[:, 0] = 0
             self.sine_waves = torch.rand(1, 300 * 24000, 9)
+        # fundamental tone and overtones, multiplied with f0 in one broadcast
+        self.register_buffer('harmonics', torch.arange(1, harmonic_num + 2, dtype=torch.float32), persistent=False)
+        # no additive noise in inference, the same f0 always gives the same source
+        self.deterministic = False
 
     def _f02uv(self, f0):
         # generate uv signal
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
+    def _f02phase(self, f0, cache=torch.zeros(0, 0, 0), finalize: bool = True):
+        """ f0: (batchsize, length, 1), upsampled from frames with nearest
+            cache: (batchsize, 1, dim) phase of the last frame of the previous chunk,
+                   (0, 0, 0) for the first chunk
+            finalize: False means more chunks follow, the phase after the last frame is extrapolated
+                      with its f0 instead of held
+            returns the phase (batchsize, length, dim) and the cache of the next chunk
+        """
+        # the phase is integrated per frame, the linear interpolation takes the middle of every frame, where f0 is
+        # constant, so f0 is downsampled before it is multiplied with the harmonics. The initial phase noise of the
+        # first step never reached a frame in the interpolation and is not drawn.
+        f0 = torch.nn.functional.interpolate(f0.transpose(1, 2), scale_factor=1 / self.upsample_scale, mode="linear").transpose(1, 2)
+        # convert to F0 in rad. The interger part n can be ignored
+        # because 2 * np.pi * n doesn't affect phase
+        rad_values = (f0 * self.harmonics / self.sampling_rate) % 1
+
+        # instantanouse phase sine[t] = sin(2*pi \sum_i=1 ^{t} rad)
+        phase = torch.cumsum(rad_values, dim=1) * 2 * np.pi
+        phase = phase * self.upsample_scale
+        if cache.size(0) != 0:
+            phase = phase + cache
+        # wrapped, so the cache does not lose precision over long streams
+        new_cache = phase[:, -1:] % (2 * np.pi)
+        if self.causal is True:
+            phase = torch.nn.functional.interpolate(phase.transpose(1, 2), scale_factor=self.upsample_scale, mode="nearest").transpose(1, 2)
+        elif cache.size(0) == 0 and finalize is True:
+            phase = torch.nn.functional.interpolate(phase.transpose(1, 2), scale_factor=self.upsample_scale, mode='linear').transpose(1, 2)
+        else:
+            # interpolate from the last frame of the previous chunk, and towards a frame extrapolated with the f0 of the
+            # last one when more chunks follow, only the samples of this chunk are kept
+            num_frames = phase.shape[1]
+            phase = torch.concat([phase[:, :1] if cache.size(0) == 0 else cache, phase,
+                                  phase[:, -1:] if finalize is True else phase[:, -1:] + rad_values[:, -1:] * 2 * np.pi * self.upsample_scale], dim=1)
+            phase = torch.nn.functional.interpolate(phase.transpose(1, 2), scale_factor=self.upsample_scale, mode='linear').transpose(1, 2)
+            phase = phase[:, self.upsample_scale: (num_frames + 1) * self.upsample_scale]
+        return phase, new_cache
+
     def _f02sine(self, f0_values):
         """ f0_values: (batchsize, length, dim)
             where dim indicates fundamental tone and overtones
+            pulse train version, when flag_for_pulse is True
         """
         # convert to F0 in rad. The interger part n can be ignored
         # because 2 * np.pi * n doesn't affect phase
@@ -246,44 +328,33 @@ class SineGen2(torch.nn.Module):
             rand_ini[:, 0] = 0
             rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
 
-        # instantanouse phase sine[t] = sin(2*pi \sum_i=1 ^{t} rad)
-        if not self.flag_for_pulse:
-            rad_values = torch.nn.functional.interpolate(rad_values.transpose(1, 2),
-                                                         scale_factor=1 / self.upsample_scale,
-                                                         mode="linear").transpose(1, 2)
-
-            phase = torch.cumsum(rad_values, dim=1) * 2 * np.pi
-            phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * self.upsample_scale,
-                                                    scale_factor=self.upsample_scale, mode="nearest" if self.causal is True else 'linear').transpose(1, 2)
-            sines = torch.sin(phase)
-        else:
-            # If necessary, make sure that the first time step of every
-            # voiced segments is sin(pi) or cos(0)
-            # This is used for pulse-train generation
-
-            # identify the last time step in unvoiced segments
-            uv = self._f02uv(f0_values)
-            uv_1 = torch.roll(uv, shifts=-1, dims=1)
-            uv_1[:, -1, :] = 1
-            u_loc = (uv < 1) * (uv_1 > 0)
-
-            # get the instantanouse phase
-            tmp_cumsum = torch.cumsum(rad_values, dim=1)
-            # different batch needs to be processed differently
-            for idx in range(f0_values.shape[0]):
-                temp_sum = tmp_cumsum[idx, u_loc[idx, :, 0], :]
-                temp_sum[1:, :] = temp_sum[1:, :] - temp_sum[0:-1, :]
-                # stores the accumulation of i.phase within
-                # each voiced segments
-                tmp_cumsum[idx, :, :] = 0
-                tmp_cumsum[idx, u_loc[idx, :, 0], :] = temp_sum
-
-            # rad_values - tmp_cumsum: remove the accumulation of i.phase
-            # within the previous voiced segment.
-            i_phase = torch.cumsum(rad_values - tmp_cumsum, dim=1)
-
-            # get the sines
-            sines = torch.cos(i_phase * 2 * np.pi)
+        # If necessary, make sure that the first time step of every
+        # voiced segments is sin(pi) or cos(0)
+        # This is used for pulse-train generation
+
+        # identify the last time step in unvoiced segments
+        uv = self._f02uv(f0_values)
+        uv_1 = torch.roll(uv, shifts=-1, dims=1)
+        uv_1[:, -1, :] = 1
+        u_loc = (uv < 1) * (uv_1 > 0)
+
+        # get the instantanouse phase
+        tmp_cumsum = torch.cumsum(rad_values, dim=1)
+        # different batch needs to be processed differently
+        for idx in range(f0_values.shape[0]):
+            temp_sum = tmp_cumsum[idx, u_loc[idx, :, 0], :]
+            temp_sum[1:, :] = temp_sum[1:, :] - temp_sum[0:-1, :]
+            # stores the accumulation of i.phase within
+            # each voiced segments
+            tmp_cumsum[idx, :, :] = 0
+            tmp_cumsum[idx, u_loc[idx, :, 0], :] = temp_sum
+
+        # rad_values - tmp_cumsum: remove the accumulation of i.phase
+        # within the previous voiced segment.
+        i_phase = torch.cumsum(rad_values - tmp_cumsum, dim=1)
+
+        # get the sines
+        sines = torch.cos(i_phase * 2 * np.pi)
         return sines
 
     def forward(self, f0):
@@ -293,15 +364,30 @@ class SineGen2(torch.nn.Module):
         output sine_tensor: tensor(batchsize=1, length, dim)
         output uv: tensor(batchsize=1, length, 1)
         """
-        # fundamental component
-        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        sine_waves, uv, noise, _ = self.forward_chunk(f0, finalize=True)
+        return sine_waves, uv, noise
 
+    def forward_chunk(self, f0, cache=torch.zeros(0, 0, 0), finalize: bool = False):
+        """ sine_tensor, uv, noise, cache = forward_chunk(f0, cache, finalize)
+        streaming version of forward, the sines continue the phase of the previous chunk, finalize is True
+        for the last chunk
+        input cache: tensor(batchsize, 1, dim), phase of the last frame of the previous chunk,
+                     (0, 0, 0) for the first chunk
+        output cache: tensor(batchsize, 1, dim) for the next chunk
+        """
         # generate sine waveforms
-        sine_waves = self._f02sine(fn) * self.sine_amp
+        if self.flag_for_pulse:
+            sine_waves = self._f02sine(f0 * self.harmonics) * self.sine_amp
+        else:
+            phase, cache = self._f02phase(f0, cache, finalize=finalize)
+            sine_waves = torch.sin(phase).mul_(self.sine_amp)
 
         # generate uv signal
         uv = self._f02uv(f0)
 
+        if self.deterministic is True and self.training is False:
+            return sine_waves.mul_(uv), uv, torch.zeros_like(uv), cache
+
         # noise: for unvoiced should be similar to sine_amp
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
@@ -313,8 +399,8 @@ class SineGen2(torch.nn.Module):
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
-        sine_waves = sine_waves * uv + noise
-        return sine_waves, uv, noise
+        sine_waves = sine_waves.mul_(uv).add_(noise)
+        return sine_waves, uv, noise, cache
 
 
 class SourceModuleHnNSF(torch.nn.Module):
@@ -355,6 +441,10 @@ class SourceModuleHnNSF(torch.nn.Module):
         if causal is True:
             self.uv = torch.rand(1, 300 * 24000, 1)
 
+    def set_deterministic(self, deterministic=True):
+        """skip the additive noise of the sines, their random initial phases and the noise branch in inference"""
+        self.l_sin_gen.deterministic = deterministic
+
     def forward(self, x):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
@@ -362,17 +452,27 @@ class SourceModuleHnNSF(torch.nn.Module):
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
         """
+        sine_merge, noise, uv, _ = self.forward_chunk(x, finalize=True)
+        return sine_merge, noise, uv
+
+    def forward_chunk(self, x, cache=torch.zeros(0, 0, 0), finalize: bool = False):
+        """
+        Sine_source, noise_source, uv, cache = SourceModuleHnNSF.forward_chunk(F0_sampled, cache, finalize)
+        streaming version of forward, cache is the phase state of the sine generator
+        """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x)
+            sine_wavs, uv, _, cache = self.l_sin_gen.forward_chunk(x, cache, finalize)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
 
         # source for noise branch, in the same shape as uv
-        if self.training is False and self.causal is True:
+        if self.l_sin_gen.deterministic is True and self.training is False:
+            noise = torch.zeros_like(uv)
+        elif self.training is False and self.causal is True:
             noise = self.uv[:, :uv.shape[1]] * self.sine_amp / 3
         else:
             noise = torch.randn_like(uv) * self.sine_amp / 3
-        return sine_merge, noise, uv
+        return sine_merge, noise, uv, cache
 
 
 class HiFTGenerator(nn.Module):
@@ -411,6 +511,7 @@ class HiFTGenerator(nn.Module):
 
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
+        self.upsample_rates = upsample_rates
         # NOTE in CosyVoice2, we use the original SineGen implementation
         self.m_source = SourceModuleHnNSF(
             sampling_rate=sampling_rate,
@@ -471,22 +572,14 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        self.stft_window = torch.hann_window(istft_params["n_fft"], periodic=True, dtype=torch.float64).float()
         self.f0_predictor = f0_predictor
 
     def remove_weight_norm(self):
-        print('Removing weight norm...')
-        for l in self.ups:
-            remove_weight_norm(l)
-        for l in self.resblocks:
-            l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
-        for l in self.source_resblocks:
-            l.remove_weight_norm()
+        """weight norm is a training reparametrization, without it every conv uses its weight as is,
+        the f0 predictor included"""
+        for module in self.modules():
+            remove_weight_norm(module)
 
     def _stft(self, x):
         spec = torch.stft(
@@ -508,35 +601,58 @@ class HiFTGenerator(nn.Module):
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
+        magnitude, phase = self.decode_spec(x, s_stft)
+        x = self._istft(magnitude, phase)
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    def decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor, x_lens: Optional[torch.Tensor] = None):
+        """mel + source stft -> istft magnitude and phase
+
+        With x_lens, x and s_stft are zero padded batches and the frames beyond every item are masked
+        before each conv, so that the valid frames are the same as decoding each item alone.
+        """
+        x_mask = None if x_lens is None else (~make_pad_mask(x_lens, x.shape[2])).unsqueeze(1).to(x.dtype)
+        if x_mask is not None:
+            x = x * x_mask
         x = self.conv_pre(x)
         for i in range(self.num_upsamples):
+            if x_mask is not None:
+                x_lens = x_lens * self.upsample_rates[i]
+                x = x * x_mask
             x = F.leaky_relu(x, self.lrelu_slope)
             x = self.ups[i](x)
 
             if i == self.num_upsamples - 1:
                 x = self.reflection_pad(x)
+                if x_mask is not None:
+                    x_lens = x_lens + 1
+            if x_mask is not None:
+                x_mask = (~make_pad_mask(x_lens, x.shape[2])).unsqueeze(1).to(x.dtype)
+                x = x * x_mask
 
             # fusion
             si = self.source_downs[i](s_stft)
-            si = self.source_resblocks[i](si)
+            if x_mask is not None:
+                si = si * x_mask
+            si = self.source_resblocks[i](si, x_mask)
             x = x + si
 
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
 
+        if x_mask is not None:
+            x = x * x_mask
         x = F.leaky_relu(x)
         x = self.conv_post(x)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
-
-        x = self._istft(magnitude, phase)
-        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
-        return x
+        return magnitude, phase
 
     def forward(
             self,
@@ -555,7 +671,16 @@ class HiFTGenerator(nn.Module):
         return generated_speech, f0
 
     @torch.inference_mode()
-    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0),
+                  speech_feat_lens: Optional[torch.Tensor] = None, batched: Optional[bool] = None) -> torch.Tensor:
+        """with speech_feat_lens, speech_feat is a zero padded batch, batched vocodes it in one pass instead of item by item,
+        by default only on gpu, on cpu the padded convs cost more than the loop"""
+        if speech_feat_lens is not None:
+            if batched is None:
+                batched = speech_feat.is_cuda
+            if batched is True:
+                return self.batch_inference(speech_feat, speech_feat_lens, cache_source)
+            return self.looped_inference(speech_feat, speech_feat_lens, cache_source)
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
@@ -568,6 +693,70 @@ class HiFTGenerator(nn.Module):
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
 
+    @torch.inference_mode()
+    def inference_chunk(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0),
+                        cache_phase: torch.Tensor = torch.zeros(0, 0, 0), finalize: bool = False) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """streaming inference, the source of the frames covered by cache_source is reused and only the source of
+        the following frames is synthesized, continuing the sine phases of cache_phase. Returns speech, source and
+        the phase cache of the next chunk. Without caches and with finalize it is the same as inference.
+        """
+        upsample_scale = int(np.prod(self.upsample_rates) * self.istft_params["hop_len"])
+        # mel->f0
+        f0 = self.f0_predictor(speech_feat)
+        # f0->source of the new frames
+        s = self.f0_upsamp(f0[:, None, cache_source.shape[2] // upsample_scale:]).transpose(1, 2)  # bs,n,t
+        s, _, _, cache_phase = self.m_source.forward_chunk(s, cache_phase, finalize)
+        s = s.transpose(1, 2)
+        if cache_source.shape[2] != 0:
+            s = torch.concat([cache_source, s], dim=2)
+        generated_speech = self.decode(x=speech_feat, s=s)
+        return generated_speech, s, cache_phase
+
+    def looped_inference(self, speech_feat: torch.Tensor, speech_feat_lens: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)):
+        """batch_inference one item at a time, with the same zero padded outputs"""
+        upsample_scale = int(np.prod(self.upsample_rates) * self.istft_params["hop_len"])
+        generated_speech = torch.zeros(speech_feat.shape[0], speech_feat.shape[2] * upsample_scale, device=speech_feat.device)
+        s = torch.zeros(speech_feat.shape[0], 1, speech_feat.shape[2] * upsample_scale, device=speech_feat.device)
+        for i, speech_feat_len in enumerate(speech_feat_lens.tolist()):
+            speech, source = self.inference(speech_feat[i:i + 1, :, :speech_feat_len], cache_source[i:i + 1])
+            generated_speech[i, :speech.shape[1]] = speech[0]
+            s[i, :, :source.shape[2]] = source[0]
+        return generated_speech, s
+
+    def batch_inference(self, speech_feat: torch.Tensor, speech_feat_lens: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)):
+        """vocode a zero padded batch of mels, returns zero padded speech and source,
+        item i is valid for speech_feat_lens[i] * prod(upsample_rates) * hop_len samples
+        """
+        upsample_scale = int(np.prod(self.upsample_rates) * self.istft_params["hop_len"])
+        x_mask = (~make_pad_mask(speech_feat_lens, speech_feat.shape[2])).unsqueeze(1).to(speech_feat.dtype)
+        # mel->f0, the f0 predictor and the decoder convs run on the batch with padded frames masked
+        f0 = self.f0_predictor(speech_feat, x_mask=x_mask)
+        # f0->source, a zero f0 behind every item holds its sine phases, so the source of the valid samples is the
+        # same as for the item alone, the source of the padded samples is zeroed
+        s = self.f0_upsamp((f0 * x_mask[:, 0])[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _ = self.m_source(s)
+        s = s.transpose(1, 2) * self.f0_upsamp(x_mask)
+        if cache_source.shape[2] != 0:
+            s[:, :, :cache_source.shape[2]] = cache_source
+        # the stft reflects the last samples of an item, so they are reflected into the padding behind it
+        num_samples = speech_feat_lens.to(s.device).unsqueeze(1) * upsample_scale
+        t = torch.arange(s.shape[2] + self.istft_params["n_fft"] // 2, device=s.device).unsqueeze(0)
+        index = torch.where(t < num_samples, t, 2 * (num_samples - 1) - t).clamp(0, s.shape[2] - 1)
+        s_reflected = torch.gather(s.squeeze(1), 1, index) * (t < num_samples + self.istft_params["n_fft"] // 2)
+        s_stft_real, s_stft_imag = self._stft(s_reflected)
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)[:, :, :s.shape[2] // self.istft_params["hop_len"] + 1]
+        # the frames behind an item are zero, like the conv padding of the item alone
+        s_stft_lens = speech_feat_lens.to(s.device) * upsample_scale // self.istft_params["hop_len"] + 1
+        s_stft = s_stft * (~make_pad_mask(s_stft_lens, s_stft.shape[2])).unsqueeze(1)
+        magnitude, phase = self.decode_spec(speech_feat, s_stft, speech_feat_lens)
+        # the istft edges depend on the item length, it runs per item
+        generated_speech = torch.zeros(speech_feat.shape[0], speech_feat.shape[2] * upsample_scale, device=speech_feat.device)
+        for i, speech_feat_len in enumerate(speech_feat_lens.tolist()):
+            num_frames = speech_feat_len * upsample_scale // self.istft_params["hop_len"] + 1
+            x = self._istft(magnitude[i:i + 1, :, :num_frames], phase[i:i + 1, :, :num_frames])
+            generated_speech[i, :x.shape[1]] = torch.clamp(x[0], -self.audio_limit, self.audio_limit)
+        return generated_speech, s
+
 
 class CausalHiFTGenerator(HiFTGenerator):
     """
@@ -665,7 +854,7 @@ class CausalHiFTGenerator(HiFTGenerator):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        self.stft_window = torch.hann_window(istft_params["n_fft"], periodic=True, dtype=torch.float64).float()
         self.conv_pre_look_right = conv_pre_look_right
         self.f0_predictor = f0_predictor
 
@@ -679,6 +868,18 @@ class CausalHiFTGenerator(HiFTGenerator):
             s_stft_imag = s_stft_imag[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
+        magnitude, phase = self.decode_spec(x, s_stft)
+        x = self._istft(magnitude, phase)
+        if finalize is False:
+            x = x[:, :-int(np.prod(self.upsample_rates) * self.istft_params['hop_len'])]
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    def decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor):
+        """conv_pre output + source stft -> istft magnitude and phase
+
+        Every conv is causal, frames appended on the right never change the frames before them.
+        """
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
             x = self.ups[i](x)
@@ -703,12 +904,7 @@ class CausalHiFTGenerator(HiFTGenerator):
         x = self.conv_post(x)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
-
-        x = self._istft(magnitude, phase)
-        if finalize is False:
-            x = x[:, :-int(np.prod(self.upsample_rates) * self.istft_params['hop_len'])]
-        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
-        return x
+        return magnitude, phase
 
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
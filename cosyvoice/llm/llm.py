@@ -21,12 +21,11 @@ import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
-from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.file_utils import logging, weight_init_skipped
 from cosyvoice.utils.mask import make_pad_mask
 
 
@@ -211,11 +210,20 @@ class TransformerLM(torch.nn.Module):
         out_tokens = []
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # jit models exported before forward_chunk_inplace existed keep concatenating the caches every step
+        inplace = hasattr(self.llm, 'forward_chunk_inplace')
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            if inplace and i > 0:
+                # one token attends to all history, no mask is needed and the caches are updated in place
+                y_pred = self.llm.forward_chunk_inplace(lm_input, offset, att_cache, cnn_cache)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                                     device=lm_input.device)).to(torch.bool))
+                if inplace:
+                    # room for max_len more tokens behind the prompt, allocated once
+                    att_cache = torch.concat([att_cache, att_cache.new_zeros(att_cache.size(0), att_cache.size(1), max_len, att_cache.size(3))], dim=2)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
             if top_ids == self.eos_token:
@@ -230,7 +238,13 @@ class TransformerLM(torch.nn.Module):
 class Qwen2Encoder(torch.nn.Module):
     def __init__(self, pretrain_path):
         super().__init__()
-        self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+        # transformers takes seconds to import, only the qwen2 llms need it
+        from transformers import AutoConfig, Qwen2ForCausalLM
+        if weight_init_skipped():
+            # llm.pt overwrites the pretrained weights, only the config is read
+            self.model = Qwen2ForCausalLM(AutoConfig.from_pretrained(pretrain_path))
+        else:
+            self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
 
     def forward(self, xs: torch.Tensor, xs_lens: torch.Tensor):
         T = xs.size(1)
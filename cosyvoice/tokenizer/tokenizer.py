@@ -169,10 +169,11 @@ TTS_Vocal_Token = {
 @lru_cache(maxsize=None)
 def get_encoding(name: str = "gpt2", num_languages: int = 99):
     vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
-    ranks = {
-        base64.b64decode(token): int(rank)
-        for token, rank in (line.split() for line in open(vocab_path) if line)
-    }
+    with open(vocab_path) as fin:
+        ranks = {
+            base64.b64decode(token): int(rank)
+            for token, rank in (line.split() for line in fin if line)
+        }
     n_vocab = len(ranks)
     special_tokens = {}
 
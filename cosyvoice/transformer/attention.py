@@ -17,10 +17,11 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 
 class MultiHeadedAttention(nn.Module):
@@ -30,6 +31,8 @@ class MultiHeadedAttention(nn.Module):
         n_head (int): The number of heads.
         n_feat (int): The number of features.
         dropout_rate (float): Dropout rate.
+        key_bias (bool): whether use bias in linear_k.
+        use_sdpa (bool): compute attention with torch scaled_dot_product_attention.
 
     """
 
@@ -37,9 +40,11 @@ class MultiHeadedAttention(nn.Module):
                  n_head: int,
                  n_feat: int,
                  dropout_rate: float,
-                 key_bias: bool = True):
+                 key_bias: bool = True,
+                 use_sdpa: bool = False):
         """Construct an MultiHeadedAttention object."""
         super().__init__()
+        self.use_sdpa = use_sdpa
         assert n_feat % n_head == 0
         # We assume d_v always equals d_k
         self.d_k = n_feat // n_head
@@ -126,6 +131,113 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def forward_sdpa(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        bias: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Compute attention context vector with scaled_dot_product_attention.
+
+        Same result as forward_attention on the scores
+        query @ key^T / sqrt(d_k) + bias, except that a query which masks out
+        every key gets nan instead of zeros, add_optional_chunk_mask never
+        builds such a mask.
+
+        Args:
+            query (torch.Tensor): Transformed query, size
+                (#batch, n_head, time1, d_k).
+            key (torch.Tensor): Transformed key, size
+                (#batch, n_head, time2, d_k).
+            value (torch.Tensor): Transformed value, size
+                (#batch, n_head, time2, d_k).
+            mask (torch.Tensor): Mask, size (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            bias (torch.Tensor): Additive score bias, size
+                (#batch, n_head, time1, time2), None means no bias.
+
+        Returns:
+            torch.Tensor: Transformed value (#batch, time1, d_model).
+
+        """
+        n_batch = query.size(0)
+        attn_mask = bias
+        if mask.size(2) > 0:  # time2 > 0
+            # For last chunk, time2 might be larger than key.size(2)
+            mask = mask.unsqueeze(1)[:, :, :, :key.size(2)]  # (batch, 1, *, time2)
+            if bias is None:
+                attn_mask = mask
+            else:
+                # bias of the positional encoding may have batch 1, where broadcasts it to the mask
+                attn_mask = torch.where(mask, bias, -float('inf'))
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask,
+                                           dropout_p=self.dropout.p if self.training else 0.0)
+        x = (x.transpose(1, 2).contiguous().view(n_batch, -1,
+                                                 self.h * self.d_k)
+             )  # (batch, time1, d_model)
+
+        return self.linear_out(x)  # (batch, time1, d_model)
+
+    def forward_cache(
+        self,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        cache: torch.Tensor,
+        cache_len: int = -1
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Prepend the cached KEY & VALUE to k and v.
+
+        Args:
+            k (torch.Tensor): Transformed key (1, head, time1, d_k).
+            v (torch.Tensor): Transformed value (1, head, time1, d_k).
+            cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2).
+            cache_len (int): <0: cache holds exactly the history and a new
+                cache is concatenated, >=0: cache is a preallocated buffer
+                whose first cache_len frames are the history, k and v are
+                written in place behind them, so no memory is allocated.
+
+        Returns:
+            torch.Tensor: key (1, head, cache_t + time1, d_k).
+            torch.Tensor: value (1, head, cache_t + time1, d_k).
+            torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2),
+                a view of cache when it is preallocated.
+
+        """
+        if cache_len >= 0:
+            end = cache_len + k.size(2)
+            cache[:, :, cache_len:end, :self.d_k] = k
+            cache[:, :, cache_len:end, self.d_k:] = v
+            new_cache = cache[:, :, :end]
+            return new_cache[:, :, :, :self.d_k], new_cache[:, :, :, self.d_k:], new_cache
+        # NOTE(xcsong):
+        #   when export onnx model, for 1st chunk, we feed
+        #       cache(1, head, 0, d_k * 2) (16/-1, -1/-1, 16/0 mode)
+        #       or cache(1, head, real_cache_t, d_k * 2) (16/4 mode).
+        #       In all modes, `if cache.size(0) > 0` will alwayse be `True`
+        #       and we will always do splitting and
+        #       concatnation(this will simplify onnx export). Note that
+        #       it's OK to concat & split zero-shaped tensors(see code below).
+        #   when export jit  model, for 1st chunk, we always feed
+        #       cache(0, 0, 0, 0) since jit supports dynamic if-branch.
+        # >>> a = torch.ones((1, 2, 0, 4))
+        # >>> b = torch.ones((1, 2, 3, 4))
+        # >>> c = torch.cat((a, b), dim=2)
+        # >>> torch.equal(b, c)        # True
+        # >>> d = torch.split(a, 2, dim=-1)
+        # >>> torch.equal(d[0], d[1])  # True
+        if cache.size(0) > 0:
+            key_cache, value_cache = torch.split(cache,
+                                                 cache.size(-1) // 2,
+                                                 dim=-1)
+            k = torch.cat([key_cache, k], dim=2)
+            v = torch.cat([value_cache, v], dim=2)
+        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+        #   non-trivial to calculate `next_cache_start` here.
+        new_cache = torch.cat((k, v), dim=-1)
+        return k, v, new_cache
+
     def forward(
         self,
         query: torch.Tensor,
@@ -133,7 +245,8 @@ class MultiHeadedAttention(nn.Module):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_len: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute scaled dot product attention.
 
@@ -156,6 +269,8 @@ class MultiHeadedAttention(nn.Module):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_len (int): >=0 means cache is preallocated and holds
+                cache_len frames, see forward_cache.
 
 
         Returns:
@@ -167,32 +282,10 @@ class MultiHeadedAttention(nn.Module):
         """
         q, k, v = self.forward_qkv(query, key, value)
 
-        # NOTE(xcsong):
-        #   when export onnx model, for 1st chunk, we feed
-        #       cache(1, head, 0, d_k * 2) (16/-1, -1/-1, 16/0 mode)
-        #       or cache(1, head, real_cache_t, d_k * 2) (16/4 mode).
-        #       In all modes, `if cache.size(0) > 0` will alwayse be `True`
-        #       and we will always do splitting and
-        #       concatnation(this will simplify onnx export). Note that
-        #       it's OK to concat & split zero-shaped tensors(see code below).
-        #   when export jit  model, for 1st chunk, we always feed
-        #       cache(0, 0, 0, 0) since jit supports dynamic if-branch.
-        # >>> a = torch.ones((1, 2, 0, 4))
-        # >>> b = torch.ones((1, 2, 3, 4))
-        # >>> c = torch.cat((a, b), dim=2)
-        # >>> torch.equal(b, c)        # True
-        # >>> d = torch.split(a, 2, dim=-1)
-        # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        k, v, new_cache = self.forward_cache(k, v, cache, cache_len)
 
+        if self.use_sdpa:
+            return self.forward_sdpa(q, k, v, mask), new_cache
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
@@ -210,9 +303,10 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
                  n_head: int,
                  n_feat: int,
                  dropout_rate: float,
-                 key_bias: bool = True):
+                 key_bias: bool = True,
+                 use_sdpa: bool = False):
         """Construct an RelPositionMultiHeadedAttention object."""
-        super().__init__(n_head, n_feat, dropout_rate, key_bias)
+        super().__init__(n_head, n_feat, dropout_rate, key_bias, use_sdpa)
         # linear transformation for positional encoding
         self.linear_pos = nn.Linear(n_feat, n_feat, bias=False)
         # these two learnable bias are used in matrix c and matrix d
@@ -253,7 +347,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_len: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -267,6 +362,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_len (int): >=0 means cache is preallocated and holds
+                cache_len frames, see forward_cache.
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -276,31 +373,7 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         q, k, v = self.forward_qkv(query, key, value)
         q = q.transpose(1, 2)  # (batch, time1, head, d_k)
 
-        # NOTE(xcsong):
-        #   when export onnx model, for 1st chunk, we feed
-        #       cache(1, head, 0, d_k * 2) (16/-1, -1/-1, 16/0 mode)
-        #       or cache(1, head, real_cache_t, d_k * 2) (16/4 mode).
-        #       In all modes, `if cache.size(0) > 0` will alwayse be `True`
-        #       and we will always do splitting and
-        #       concatnation(this will simplify onnx export). Note that
-        #       it's OK to concat & split zero-shaped tensors(see code below).
-        #   when export jit  model, for 1st chunk, we always feed
-        #       cache(0, 0, 0, 0) since jit supports dynamic if-branch.
-        # >>> a = torch.ones((1, 2, 0, 4))
-        # >>> b = torch.ones((1, 2, 3, 4))
-        # >>> c = torch.cat((a, b), dim=2)
-        # >>> torch.equal(b, c)        # True
-        # >>> d = torch.split(a, 2, dim=-1)
-        # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        k, v, new_cache = self.forward_cache(k, v, cache, cache_len)
 
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
@@ -311,19 +384,24 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # (batch, head, time1, d_k)
         q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
 
-        # compute attention score
-        # first compute matrix a and matrix c
-        # as described in https://arxiv.org/abs/1901.02860 Section 3.3
-        # (batch, head, time1, time2)
-        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
-
         # compute matrix b and matrix d
         # (batch, head, time1, time2)
         matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
         # NOTE(Xiang Lyu): Keep rel_shift since espnet rel_pos_emb is used
-        if matrix_ac.shape != matrix_bd.shape:
+        # matrix_ac is (batch, head, time1, time2), it is computed after the sdpa branch
+        if matrix_bd.size(0) != q_with_bias_u.size(0) or matrix_bd.size(-1) != k.size(2):
             matrix_bd = self.rel_shift(matrix_bd)
 
+        if self.use_sdpa:
+            # matrix b and d is the score bias of matrix a and c, which sdpa computes fused with the softmax
+            return self.forward_sdpa(q_with_bias_u, k, v, mask, matrix_bd / math.sqrt(self.d_k)), new_cache
+
+        # compute attention score
+        # first compute matrix a and matrix c
+        # as described in https://arxiv.org/abs/1901.02860 Section 3.3
+        # (batch, head, time1, time2)
+        matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
+
         scores = (matrix_ac + matrix_bd) / math.sqrt(
             self.d_k)  # (batch, head, time1, time2)
 
@@ -88,6 +88,23 @@ class ConvolutionModule(nn.Module):
         )
         self.activation = activation
 
+    @torch.no_grad()
+    def fold_batch_norm(self):
+        """fold the running statistics of the eval batch norm into the depthwise conv, the norm becomes an identity"""
+        if self.use_layer_norm or not isinstance(self.norm, nn.BatchNorm1d):
+            return
+        assert not self.training, 'batch norm can only be folded for inference'
+        scale = torch.rsqrt(self.norm.running_var + self.norm.eps)
+        if self.norm.affine:
+            scale = scale * self.norm.weight
+        bias = self.depthwise_conv.bias if self.depthwise_conv.bias is not None else torch.zeros_like(scale)
+        bias = (bias - self.norm.running_mean) * scale
+        if self.norm.affine:
+            bias = bias + self.norm.bias
+        self.depthwise_conv.weight = nn.Parameter(self.depthwise_conv.weight * scale[:, None, None])
+        self.depthwise_conv.bias = nn.Parameter(bias)
+        self.norm = nn.Identity()
+
     def forward(
         self,
         x: torch.Tensor,
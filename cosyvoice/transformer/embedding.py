@@ -116,6 +116,12 @@ class PositionalEncoding(torch.nn.Module):
             pos_emb = self.dropout(pos_emb)
         return pos_emb
 
+    def history_position_encoding(self, offset: int, size: int) -> torch.Tensor:
+        """ Encoding of a chunk of size frames that attends to the offset
+            frames of history and itself, see forward_chunk_inplace
+        """
+        return self.position_encoding(0, offset + size)
+
 
 class RelPositionalEncoding(PositionalEncoding):
     """Relative positional encoding module.
@@ -197,6 +203,9 @@ class NoPositionalEncoding(torch.nn.Module):
                           size: int) -> torch.Tensor:
         return torch.zeros(1, size, self.d_model)
 
+    def history_position_encoding(self, offset: int, size: int) -> torch.Tensor:
+        return torch.zeros(1, offset + size, self.d_model)
+
 
 class EspnetRelPositionalEncoding(torch.nn.Module):
     """Relative positional encoding module (new implementation).
@@ -300,3 +309,16 @@ class EspnetRelPositionalEncoding(torch.nn.Module):
                 self.pe.size(1) // 2 - size - offset + 1: self.pe.size(1) // 2 + size + offset,
             ]
         return pos_emb
+
+    def history_position_encoding(self, offset: int, size: int) -> torch.Tensor:
+        """ Encoding of a chunk of size frames that attends to the offset
+            frames of history and itself, see forward_chunk_inplace
+
+        A single frame at position offset only needs the relative positions
+        offset..0, which are sliced from the table as they are, so the
+        attention projects offset + 1 positions instead of 2 * offset + 1
+        and skips rel_shift.
+        """
+        if size == 1:
+            return self.pe[:, self.pe.size(1) // 2 - offset: self.pe.size(1) // 2 + 1]
+        return self.position_encoding(0, offset + size)
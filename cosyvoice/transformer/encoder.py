@@ -271,6 +271,56 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.export
+    def forward_chunk_inplace(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+        cnn_cache: torch.Tensor,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ Forward just one chunk with preallocated caches, the same as
+            forward_chunk with required_cache_size < 0, but the caches are
+            updated in place instead of being concatenated into new tensors.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim).
+            offset (int): current offset in encoder output time stamp, all
+                offset frames of history are in att_cache.
+            att_cache (torch.Tensor): preallocated cache tensor for KEY &
+                VALUE, with shape (elayers, head, capacity, d_k * 2), where
+                `capacity >= offset + chunk_size`, the frames of this chunk
+                are written behind the history.
+            cnn_cache (torch.Tensor): cache tensor for cnn_module in conformer,
+                (elayers, b=1, hidden-dim, cache_t2), overwritten in place.
+            att_mask (torch.Tensor): mask of the chunk, (0, 0, 0) means every
+                frame attends to all history and the chunk, e.g. one token.
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, chunk_size, hidden-dim).
+
+        """
+        assert xs.size(0) == 1
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, att_mask, offset)
+        pos_emb = self.embed.history_position_encoding(offset, xs.size(1))
+        for i, layer in enumerate(self.encoders):
+            xs, _, _, new_cnn_cache = layer(
+                xs,
+                att_mask,
+                pos_emb,
+                att_cache=att_cache[i:i + 1],
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache,
+                att_cache_len=offset)
+            if new_cnn_cache.size(0) > 0:
+                cnn_cache[i].copy_(new_cnn_cache)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
@@ -359,6 +409,7 @@ class TransformerEncoder(BaseEncoder):
         selfattention_layer_type: str = "selfattn",
         activation_type: str = "relu",
         gradient_checkpointing: bool = False,
+        use_sdpa: bool = False,
     ):
         """ Construct TransformerEncoder
 
@@ -377,7 +428,8 @@ class TransformerEncoder(BaseEncoder):
                 COSYVOICE_ATTENTION_CLASSES[selfattention_layer_type](attention_heads,
                                                                       output_size,
                                                                       attention_dropout_rate,
-                                                                      key_bias),
+                                                                      key_bias,
+                                                                      use_sdpa),
                 PositionwiseFeedForward(output_size, linear_units,
                                         dropout_rate, activation),
                 dropout_rate, normalize_before) for _ in range(num_blocks)
@@ -414,6 +466,7 @@ class ConformerEncoder(BaseEncoder):
         cnn_module_norm: str = "batch_norm",
         key_bias: bool = True,
         gradient_checkpointing: bool = False,
+        use_sdpa: bool = False,
     ):
         """Construct ConformerEncoder
 
@@ -431,6 +484,7 @@ class ConformerEncoder(BaseEncoder):
             cnn_module_kernel (int): Kernel size of convolution module.
             causal (bool): whether to use causal convolution or not.
             key_bias: whether use bias in attention.linear_k, False for whisper models.
+            use_sdpa: compute attention with torch scaled_dot_product_attention.
         """
         super().__init__(input_size, output_size, attention_heads,
                          linear_units, num_blocks, dropout_rate,
@@ -446,6 +500,7 @@ class ConformerEncoder(BaseEncoder):
             output_size,
             attention_dropout_rate,
             key_bias,
+            use_sdpa,
         )
         # feed-forward module definition
         positionwise_layer_args = (
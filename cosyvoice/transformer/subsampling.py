@@ -31,6 +31,9 @@ class BaseSubsampling(torch.nn.Module):
                           size: int) -> torch.Tensor:
         return self.pos_enc.position_encoding(offset, size)
 
+    def history_position_encoding(self, offset: int, size: int) -> torch.Tensor:
+        return self.pos_enc.history_position_encoding(offset, size)
+
 
 class EmbedinigNoSubsampling(BaseSubsampling):
     """Embedding input without subsampling
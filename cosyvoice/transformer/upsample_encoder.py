@@ -132,6 +132,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
         cnn_module_norm: str = "batch_norm",
         key_bias: bool = True,
         gradient_checkpointing: bool = False,
+        use_sdpa: bool = False,
     ):
         """
         Args:
@@ -163,6 +164,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
             key_bias: whether use bias in attention.linear_k, False for whisper models.
             gradient_checkpointing: rerunning a forward-pass segment for each
                 checkpointed segment during backward.
+            use_sdpa: compute attention with torch scaled_dot_product_attention.
         """
         super().__init__()
         self._output_size = output_size
@@ -189,6 +191,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
             output_size,
             attention_dropout_rate,
             key_bias,
+            use_sdpa,
         )
         # feed-forward module definition
         positionwise_layer_args = (
@@ -0,0 +1,167 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Admission control and priority scheduling shared by the serving front ends."""
+
+import itertools
+import threading
+import time
+from cosyvoice.utils import metrics
+
+PRIORITIES = ['interactive', 'batch']
+
+
+def parse_tenant_priorities(items):
+    """['tenant_a:interactive', 'tenant_b:batch'] -> {'tenant_a': 'interactive', 'tenant_b': 'batch'}"""
+    tenant_priorities = {}
+    for item in items:
+        tenant, priority = item.rsplit(':', 1)
+        assert priority in PRIORITIES, 'unknown priority {}'.format(priority)
+        tenant_priorities[tenant] = priority
+    return tenant_priorities
+
+
+class AdmissionError(Exception):
+    """request rejected before running, reason is 'queue_full' or 'deadline'"""
+
+    def __init__(self, reason, message):
+        super().__init__(reason, message)
+        self.reason = reason
+
+    def __str__(self):
+        return self.args[1]
+
+
+class Ticket:
+    def __init__(self, scheduler, priority, work, seq):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.work = work
+        self.seq = seq
+        self.enqueue_time = time.monotonic()
+        self.start_time = None
+
+    def release(self, audio_seconds=0.0):
+        self.scheduler.release(self, audio_seconds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RequestScheduler:
+    """Run at most max_concurrency requests, queue at most max_queue_size per priority class.
+
+    Waiting requests are served interactive first, then batch, fifo inside a class. The work of a request is
+    the number of characters to synthesize, its service time is estimated from ema of seconds of audio per
+    character and of rtf measured on finished requests, and a request whose estimated completion misses its
+    deadline is rejected at once instead of timing out in the queue.
+    """
+
+    def __init__(self, max_concurrency=1, max_queue_size=16, tenant_priorities=None,
+                 audio_seconds_per_char=0.2, rtf=1.0, ema_decay=0.9):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.tenant_priorities = tenant_priorities or {}
+        self.audio_seconds_per_char = audio_seconds_per_char
+        self.rtf = rtf
+        self.ema_decay = ema_decay
+        self.cond = threading.Condition()
+        self.seq = itertools.count()
+        self.waiting = []
+        self.running = []
+        self.admitted = dict.fromkeys(PRIORITIES, 0)
+        self.rejected = {'queue_full': 0, 'deadline': 0}
+        self.wait_time_sum = dict.fromkeys(PRIORITIES, 0.0)
+        self.wait_time_max = dict.fromkeys(PRIORITIES, 0.0)
+
+    def priority_of(self, tenant='', stream=False):
+        return self.tenant_priorities.get(tenant, 'interactive' if stream else 'batch')
+
+    def estimate_seconds(self, work):
+        return work * self.audio_seconds_per_char * self.rtf
+
+    def acquire(self, work, priority='batch', deadline=None):
+        """block until the request may run, deadline is a time.monotonic() timestamp, returns a Ticket"""
+        assert priority in PRIORITIES, 'unknown priority {}'.format(priority)
+        with self.cond:
+            if sum(t.priority == priority for t in self.waiting) >= self.max_queue_size:
+                self.rejected['queue_full'] += 1
+                metrics.inc('cosyvoice_scheduler_rejected_total', label='queue_full')
+                raise AdmissionError('queue_full', '{} queue is full'.format(priority))
+            ticket = Ticket(self, priority, work, next(self.seq))
+            if deadline is not None:
+                # work running and queued ahead is shared by max_concurrency slots
+                ahead = sum(t.work for t in self.running) + \
+                    sum(t.work for t in self.waiting if PRIORITIES.index(t.priority) <= PRIORITIES.index(priority))
+                eta = ticket.enqueue_time + self.estimate_seconds(ahead) / self.max_concurrency + self.estimate_seconds(work)
+                if eta > deadline:
+                    self.rejected['deadline'] += 1
+                    metrics.inc('cosyvoice_scheduler_rejected_total', label='deadline')
+                    raise AdmissionError('deadline', 'estimated completion in {:.2f}s misses the deadline in {:.2f}s'.format(
+                        eta - ticket.enqueue_time, deadline - ticket.enqueue_time))
+            self.waiting.append(ticket)
+            self.waiting.sort(key=lambda t: (PRIORITIES.index(t.priority), t.seq))
+            self.update_queue_depth(priority)
+            try:
+                while len(self.running) >= self.max_concurrency or self.waiting[0] is not ticket:
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        self.rejected['deadline'] += 1
+                        metrics.inc('cosyvoice_scheduler_rejected_total', label='deadline')
+                        raise AdmissionError('deadline', 'deadline passed after {:.2f}s in queue'.format(time.monotonic() - ticket.enqueue_time))
+                    self.cond.wait(timeout)
+            except BaseException:
+                self.waiting.remove(ticket)
+                self.update_queue_depth(priority)
+                self.cond.notify_all()
+                raise
+            self.waiting.remove(ticket)
+            self.update_queue_depth(priority)
+            self.running.append(ticket)
+            ticket.start_time = time.monotonic()
+            wait_time = ticket.start_time - ticket.enqueue_time
+            self.admitted[priority] += 1
+            self.wait_time_sum[priority] += wait_time
+            self.wait_time_max[priority] = max(self.wait_time_max[priority], wait_time)
+            metrics.observe('cosyvoice_scheduler_wait_seconds', wait_time, label=priority)
+            # the head changed, let the next waiter check whether a slot is still free
+            self.cond.notify_all()
+            return ticket
+
+    def update_queue_depth(self, priority):
+        metrics.set_gauge('cosyvoice_scheduler_queue_depth', sum(t.priority == priority for t in self.waiting), label=priority)
+
+    def release(self, ticket, audio_seconds=0.0):
+        with self.cond:
+            if ticket not in self.running:
+                return
+            self.running.remove(ticket)
+            if audio_seconds > 0 and ticket.work > 0:
+                d = self.ema_decay
+                self.audio_seconds_per_char = d * self.audio_seconds_per_char + (1 - d) * audio_seconds / ticket.work
+                self.rtf = d * self.rtf + (1 - d) * (time.monotonic() - ticket.start_time) / audio_seconds
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {'running': len(self.running),
+                    'queue_depth': {p: sum(t.priority == p for t in self.waiting) for p in PRIORITIES},
+                    'admitted': dict(self.admitted),
+                    'rejected': dict(self.rejected),
+                    'wait_time_avg': {p: self.wait_time_sum[p] / max(self.admitted[p], 1) for p in PRIORITIES},
+                    'wait_time_max': dict(self.wait_time_max),
+                    'rtf': self.rtf,
+                    'audio_seconds_per_char': self.audio_seconds_per_char}
@@ -16,8 +16,12 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Unility functions for Transformer."""
 
+import math
 import queue
 import random
+import threading
+import time
+from collections import OrderedDict
 from typing import List
 
 import numpy as np
@@ -177,6 +181,33 @@ def fade_in_out(fade_in_mel, fade_out_mel, window):
     return fade_in_mel.to(device)
 
 
+_fade_windows = {}
+
+
+def fade_windows(overlap_len, dtype=torch.float32, device=torch.device('cpu'), equal_power=False):
+    """fade in and fade out halves of the crossfade window, cached per length, dtype, device and shape.
+    hamming as in fade_in_out by default, equal_power uses sin and cos halves whose squares sum to one"""
+    key = (overlap_len, dtype, device, equal_power)
+    if key not in _fade_windows:
+        if equal_power:
+            phase = (torch.arange(overlap_len, dtype=torch.float64) + 0.5) / overlap_len * math.pi / 2
+            window = torch.concat([torch.sin(phase), torch.cos(phase)])
+        else:
+            window = torch.from_numpy(np.hamming(2 * overlap_len))
+        window = window.to(device=device, dtype=dtype)
+        _fade_windows[key] = (window[:overlap_len], window[overlap_len:])
+    return _fade_windows[key]
+
+
+@torch.inference_mode()
+def overlap_add(fade_in_speech, fade_out_speech, overlap_len, equal_power=False):
+    """crossfade the last overlap_len frames of fade_out_speech into the first ones of fade_in_speech.
+    fade_in_speech is updated in place on its device and returned, nothing is copied to cpu"""
+    fade_in_window, fade_out_window = fade_windows(overlap_len, fade_in_speech.dtype, fade_in_speech.device, equal_power)
+    fade_in_speech[..., :overlap_len].mul_(fade_in_window).addcmul_(fade_out_speech[..., -overlap_len:], fade_out_window)
+    return fade_in_speech
+
+
 def set_all_random_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -211,3 +242,159 @@ class TrtContextWrapper:
 
     def release_estimator(self, context, stream):
         self.trt_context_pool.put([context, stream])
+
+
+def nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+class CacheManager:
+    """Thread safe dict like cache for speaker and session variables.
+
+    Entries are kept in lru order and sized by the bytes of the tensors they hold. When max_bytes is set,
+    least recently used entries are evicted until the cache fits, when ttl is set, entries not accessed
+    for ttl seconds are reaped on every insert, get and stats, except those for which keep(key) is true, e.g.
+    sessions whose job is still running. on_evict(key, value) is called for evicted and
+    expired entries, but not for pop/cancel, so that related session state can be dropped together. It is
+    called after the cache lock is released, so it may take locks of its own.
+    """
+
+    def __init__(self, max_bytes=None, ttl=None, on_evict=None, keep=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        # called under the cache lock, it must not take locks that are held while accessing this cache
+        self.keep = keep
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # evicted and expired entries waiting for their on_evict call
+        self.dropped = []
+        self.hits, self.misses, self.evictions, self.expirations, self.cancellations = 0, 0, 0, 0, 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __getitem__(self, key):
+        try:
+            with self.lock:
+                self._reap()
+                if key not in self.entries:
+                    self.misses += 1
+                    raise KeyError(key)
+                self.hits += 1
+                self.entries.move_to_end(key)
+                value, size, _ = self.entries[key]
+                self.entries[key] = (value, size, time.monotonic())
+                return value
+        finally:
+            self._notify()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            else:
+                self._reap()
+            size = nbytes(value)
+            self.entries[key] = (value, size, time.monotonic())
+            self.bytes += size
+            # never evict the entry just inserted, even if it alone exceeds max_bytes
+            while self.max_bytes is not None and self.bytes > self.max_bytes and len(self.entries) > 1:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        self._notify()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self.entries:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            value, size, _ = self.entries.pop(key)
+            self.bytes -= size
+            return value
+
+    def touch(self, key):
+        """refresh the access time of key without counting a hit, return whether it exists"""
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+            value, size, _ = self.entries[key]
+            self.entries[key] = (value, size, time.monotonic())
+            return True
+
+    def cancel(self, key):
+        """drop the entry of an aborted session, return whether it existed"""
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.pop(key)
+            self.cancellations += 1
+            return True
+
+    def reap(self):
+        """drop entries not accessed for ttl seconds, return their keys"""
+        with self.lock:
+            expired = self._reap()
+        self._notify()
+        return expired
+
+    def _reap(self):
+        if self.ttl is None:
+            return []
+        now = time.monotonic()
+        # entries are in access order, so stop at the first one still alive
+        expired = []
+        for key, (_, _, access_time) in self.entries.items():
+            if now - access_time < self.ttl:
+                break
+            if self.keep is None or not self.keep(key):
+                expired.append(key)
+        for key in expired:
+            self._drop(key)
+            self.expirations += 1
+        return expired
+
+    def _drop(self, key):
+        value, size, _ = self.entries.pop(key)
+        self.bytes -= size
+        self.dropped.append((key, value))
+
+    def _notify(self):
+        # on_evict runs outside the lock, a callback taking another lock can not deadlock with a thread that holds
+        # that lock and waits for this cache
+        with self.lock:
+            dropped, self.dropped = self.dropped, []
+        if self.on_evict is not None:
+            for key, value in dropped:
+                self.on_evict(key, value)
+
+    def stats(self):
+        try:
+            with self.lock:
+                self._reap()
+                return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                        'evictions': self.evictions, 'expirations': self.expirations, 'cancellations': self.cancellations}
+        finally:
+            self._notify()
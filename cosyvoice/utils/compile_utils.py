@@ -0,0 +1,138 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""torch.compile of the flow estimator and the hift convs with static shapes, one graph per length bucket.
+
+Inputs are zero padded on the time axis to the next bucket, so a stream compiles every bucket once instead of
+recompiling for every new length. Lengths beyond the last bucket run eagerly. After the warmup the graphs only run,
+an input none of them fits runs eagerly instead of compiling inside a live request.
+"""
+
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def length_buckets(hop_len, max_len):
+    """multiples of hop_len up to max_len, streaming grows the flow mel by one token_hop_len chunk at a time"""
+    return list(range(hop_len, max_len + hop_len, hop_len))
+
+
+def bucket_length(length, buckets):
+    """smallest bucket that fits length, None beyond the last bucket"""
+    for bucket in buckets:
+        if bucket >= length:
+            return bucket
+    return None
+
+
+def enable_compile_cache(cache_dir, num_graphs):
+    """keep the inductor artifacts in cache_dir, a warm start then reuses the compiled kernels and only traces again,
+    TORCHINDUCTOR_CACHE_DIR takes precedence and has to be set before the first compilation of the process"""
+    import torch._dynamo.config
+    import torch._inductor.config
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    # einops patterns are traced through otherwise, with a graph break at every pack and rearrange
+    from einops._torch_specific import allow_ops_in_compiled_graph
+    allow_ops_in_compiled_graph()
+    torch._inductor.config.fx_graph_cache = True
+    # every bucket is one more graph of the same code, dynamo falls back to eager beyond the cache size limit
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, num_graphs)
+    torch._dynamo.config.accumulated_cache_size_limit = max(torch._dynamo.config.accumulated_cache_size_limit, num_graphs)
+
+
+class CompiledEstimator(torch.nn.Module):
+    """flow estimator compiled per bucket, the padded frames have a zero mask, attention ignores them and the convs are
+    causal or masked, so the valid frames are the same as without padding.
+
+    prepare_cond stays eager, the attention masks are checked on the host, only the forward of every solver step is compiled.
+    """
+
+    def __init__(self, estimator, buckets):
+        super().__init__()
+        self.estimator = estimator
+        self.buckets = buckets
+        self.compiled_forward = torch.compile(estimator.forward, dynamic=False)
+
+    def pad(self, *tensors):
+        length = tensors[0].size(2)
+        bucket = bucket_length(length, self.buckets)
+        if bucket is None:
+            return tensors
+        return [F.pad(i, (0, bucket - length)) for i in tensors]
+
+    def prepare_cond(self, mask, mu, spks=None, cond=None, streaming=False):
+        mask, mu, cond = self.pad(mask, mu, cond)
+        return self.estimator.prepare_cond(mask, mu, spks, cond, streaming=streaming)
+
+    def forward(self, x, mask, mu, t, spks, cond, streaming=False, prepared=None):
+        length = x.size(2)
+        if bucket_length(length, self.buckets) is None:
+            return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming, prepared=prepared)
+        if prepared is None:
+            prepared = self.prepare_cond(mask, mu, spks, cond, streaming=streaming)
+        x, mask, mu, cond = self.pad(x, mask, mu, cond)
+        return self.compiled_forward(x, mask, mu, t, spks, cond, streaming=streaming, prepared=prepared)[:, :, :length]
+
+    @torch.inference_mode()
+    def warmup(self, device, dtype=torch.float32):
+        """compile every bucket ahead of the first request, in streaming and in full context mode"""
+        for bucket in self.buckets:
+            for streaming in [False, True]:
+                x = torch.zeros(2, 80, bucket, device=device, dtype=dtype)
+                mask, t, spks = torch.ones_like(x[:, :1]), torch.zeros(2, device=device, dtype=dtype), torch.zeros(2, 80, device=device, dtype=dtype)
+                self.forward(x, mask, x, t, spks, x, streaming=streaming, prepared=self.prepare_cond(mask, x, spks, x, streaming=streaming))
+        self.compiled_forward = torch._dynamo.run(self.estimator.forward)
+
+
+class CompiledDecodeSpec:
+    """decode_spec of a hift compiled per bucket, hift.decode calls it in place of the method, stft and istft stay eager.
+
+    Only a causal decode_spec is padded to the buckets, the convs of a non causal one would read the padded frames, so
+    there the buckets are the exact lengths to compile and other lengths run eagerly.
+    """
+
+    def __init__(self, hift, buckets, pad=True):
+        self.decode_spec = hift.decode_spec
+        self.upsample_scale = int(np.prod(hift.upsample_rates))
+        self.stft_channels = hift.istft_params['n_fft'] + 2
+        self.buckets = buckets
+        self.pad = pad
+        self.compiled_decode_spec = torch.compile(hift.decode_spec, dynamic=False)
+
+    def __call__(self, x, s_stft, x_lens=None):
+        length = x.size(2)
+        if self.pad is True:
+            bucket = bucket_length(length, self.buckets)
+        else:
+            bucket = length if length in self.buckets else None
+        # a batch of padded items is masked by its own x_lens
+        if bucket is None or x_lens is not None:
+            return self.decode_spec(x, s_stft, x_lens)
+        if bucket == length:
+            return self.compiled_decode_spec(x, s_stft)
+        x = F.pad(x, (0, bucket - length))
+        s_stft = F.pad(s_stft, (0, (bucket - length) * self.upsample_scale))
+        magnitude, phase = self.compiled_decode_spec(x, s_stft)
+        # the last upsample adds one reflection padded frame
+        num_frames = length * self.upsample_scale + 1
+        return magnitude[:, :, :num_frames], phase[:, :, :num_frames]
+
+    @torch.inference_mode()
+    def warmup(self, channels, device, dtype=torch.float32):
+        """compile every bucket ahead of the first request, channels is the width of the x that decode_spec takes"""
+        for bucket in self.buckets:
+            self.compiled_decode_spec(torch.zeros(1, channels, bucket, device=device, dtype=dtype),
+                                      torch.zeros(1, self.stft_channels, bucket * self.upsample_scale + 1, device=device, dtype=dtype))
+        self.compiled_decode_spec = torch._dynamo.run(self.decode_spec)
@@ -16,19 +16,23 @@
 import logging
 from contextlib import nullcontext
 import os
+import time
 
 import torch
 import torch.distributed as dist
 
-from cosyvoice.utils.train_utils import update_parameter_and_lr, log_per_step, log_per_save, batch_forward, batch_backward, save_model, cosyvoice_join
+from cosyvoice.utils.train_utils import update_parameter_and_lr, log_per_step, log_per_save, batch_forward, batch_backward, save_model, cosyvoice_join, \
+    AsyncCheckpointWriter
 
 
 class Executor:
 
-    def __init__(self, gan: bool = False, ref_model: torch.nn.Module = None, dpo_loss: torch.nn.Module = None):
+    def __init__(self, gan: bool = False, ref_model: torch.nn.Module = None, dpo_loss: torch.nn.Module = None,
+                 checkpoint_writer: AsyncCheckpointWriter = None):
         self.gan = gan
         self.ref_model = ref_model
         self.dpo_loss = dpo_loss
+        self.checkpoint_writer = checkpoint_writer
         self.step = 0
         self.epoch = 0
         self.rank = int(os.environ.get('RANK', 0))
@@ -50,7 +54,10 @@ class Executor:
             self.ref_model.eval()
         model_context = model.join if info_dict['train_engine'] == 'torch_ddp' else nullcontext
         with model_context():
+            start_time = time.time()
             for batch_idx, batch_dict in enumerate(train_data_loader):
+                if batch_idx == 0:
+                    logging.info('Epoch {} TRAIN first batch ready in {:.3f}s rank {}'.format(self.epoch, time.time() - start_time, self.rank))
                 info_dict["tag"] = "TRAIN"
                 info_dict["step"] = self.step
                 info_dict["epoch"] = self.epoch
@@ -77,7 +84,8 @@ class Executor:
                 # NOTE specify save_per_step in cosyvoice.yaml if you want to enable step save
                 if info_dict['save_per_step'] > 0 and (self.step + 1) % info_dict['save_per_step'] == 0 and \
                    (batch_idx + 1) % info_dict["accum_grad"] == 0:
-                    dist.barrier()
+                    # no barrier here, every rank saves at the same step and runs the same cv set, so their
+                    # collectives stay in order, a slower rank is only waited for at its next collective
                     self.cv(model, cv_data_loader, writer, info_dict, on_batch_end=False)
                     model.train()
                 if (batch_idx + 1) % info_dict["accum_grad"] == 0:
@@ -100,7 +108,10 @@ class Executor:
         model.train()
         model_context = model.join if info_dict['train_engine'] == 'torch_ddp' else nullcontext
         with model_context():
+            start_time = time.time()
             for batch_idx, batch_dict in enumerate(train_data_loader):
+                if batch_idx == 0:
+                    logging.info('Epoch {} TRAIN first batch ready in {:.3f}s rank {}'.format(self.epoch, time.time() - start_time, self.rank))
                 info_dict["tag"] = "TRAIN"
                 info_dict["step"] = self.step
                 info_dict["epoch"] = self.epoch
@@ -135,7 +146,8 @@ class Executor:
                 # NOTE specify save_per_step in cosyvoice.yaml if you want to enable step save
                 if info_dict['save_per_step'] > 0 and (self.step + 1) % info_dict['save_per_step'] == 0 and \
                    (batch_idx + 1) % info_dict["accum_grad"] == 0:
-                    dist.barrier()
+                    # no barrier here, every rank saves at the same step and runs the same cv set, so their
+                    # collectives stay in order, a slower rank is only waited for at its next collective
                     self.cv(model, cv_data_loader, writer, info_dict, on_batch_end=False)
                     model.train()
                 if (batch_idx + 1) % info_dict["accum_grad"] == 0:
@@ -150,7 +162,10 @@ class Executor:
         logging.info('Epoch {} Step {} on_batch_end {} CV rank {}'.format(self.epoch, self.step + 1, on_batch_end, self.rank))
         model.eval()
         total_num_utts, total_loss_dict = 0, {}  # avoid division by 0
+        start_time = time.time()
         for batch_idx, batch_dict in enumerate(cv_data_loader):
+            if batch_idx == 0:
+                logging.info('Epoch {} CV first batch ready in {:.3f}s rank {}'.format(self.epoch, time.time() - start_time, self.rank))
             info_dict["tag"] = "CV"
             info_dict["step"] = self.step
             info_dict["epoch"] = self.epoch
@@ -173,4 +188,4 @@ class Executor:
         info_dict['loss_dict'] = total_loss_dict
         log_per_save(writer, info_dict)
         model_name = 'epoch_{}_whole'.format(self.epoch) if on_batch_end else 'epoch_{}_step_{}'.format(self.epoch, self.step + 1)
-        save_model(model, model_name, info_dict)
+        save_model(model, model_name, info_dict, checkpoint_writer=self.checkpoint_writer)
@@ -16,7 +16,11 @@
 
 import os
 import json
+import threading
+import time
+from contextlib import contextmanager
 import torch
+from torch.overrides import TorchFunctionMode
 import torchaudio
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
@@ -41,7 +45,63 @@ def read_json_lists(list_file):
     return results
 
 
+@contextmanager
+def log_time(stage):
+    """log the wall time of a startup stage"""
+    start_time = time.time()
+    yield
+    logging.info('{} in {:.2f}s'.format(stage, time.time() - start_time))
+
+
+def timed_init(stage, init, *args, **kwargs):
+    """init(*args, **kwargs) under log_time, to submit a startup stage to an executor"""
+    with log_time(stage):
+        return init(*args, **kwargs)
+
+
+# random fills of weight initialization, the other init functions only fill constants and are cheap
+SKIPPED_INIT_FUNCTIONS = {torch.Tensor.uniform_, torch.Tensor.normal_, torch.nn.init.uniform_, torch.nn.init.normal_,
+                          torch.nn.init.trunc_normal_, torch.nn.init.kaiming_uniform_, torch.nn.init.kaiming_normal_,
+                          torch.nn.init.xavier_uniform_, torch.nn.init.xavier_normal_, torch.nn.init.orthogonal_,
+                          torch.nn.init.sparse_}
+_weight_init = threading.local()
+
+
+class SkipWeightInit(TorchFunctionMode):
+    """modules constructed inside only allocate their parameters, the random init of their constructors does nothing,
+    for modules whose whole state dict is loaded right after. Buffers computed in constructors, like windows and
+    positional encodings, are unchanged. Torch function modes are thread local, modules constructed on other threads
+    at the same time are initialized as usual."""
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if func in SKIPPED_INIT_FUNCTIONS:
+            # the tensor to fill, torch.nn.init passes it by keyword
+            return args[0] if len(args) > 0 else kwargs['tensor']
+        return func(*args, **(kwargs or {}))
+
+    def __enter__(self):
+        self.skipped = weight_init_skipped()
+        _weight_init.skipped = True
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        _weight_init.skipped = self.skipped
+        return super().__exit__(*args)
+
+
+def skip_weight_init():
+    return SkipWeightInit()
+
+
+def weight_init_skipped():
+    """whether this thread constructs modules under skip_weight_init"""
+    return getattr(_weight_init, 'skipped', False)
+
+
 def load_wav(wav, target_sr, min_sr=16000):
+    if hasattr(wav, 'seek'):
+        # a file object is read from its start, the frontend loads the same prompt at several sample rates
+        wav.seek(0)
     speech, sample_rate = torchaudio.load(wav, backend='soundfile')
     speech = speech.mean(dim=0, keepdim=True)
     if sample_rate != target_sr:
@@ -0,0 +1,230 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Prometheus text format metrics and optional opentelemetry spans of the inference stages.
+
+Everything is a no-op until enable() is called, so library users pay one flag check per stage.
+"""
+
+import functools
+import threading
+import time
+from contextlib import nullcontext
+import torch
+from cosyvoice.utils.file_utils import logging
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RATE_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+
+enabled = False
+tracer = None
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelname=None):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labelname = labelname
+        self.lock = threading.Lock()
+        # label value -> [bucket counts, sum, count]
+        self.values = {}
+
+    def observe(self, value, label=None):
+        with self.lock:
+            if label not in self.values:
+                self.values[label] = [[0] * len(self.buckets), 0.0, 0]
+            counts = self.values[label]
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for label, (buckets, total, count) in sorted(self.values.items(), key=lambda i: str(i[0])):
+                prefix = '{}="{}",'.format(self.labelname, label) if label is not None else ''
+                for bucket, bucket_count in zip(self.buckets, buckets):
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(self.name, prefix, bucket, bucket_count))
+                lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(self.name, prefix, count))
+                suffix = '{{{}}}'.format(prefix[:-1]) if prefix else ''
+                lines.append('{}_sum{} {}'.format(self.name, suffix, total))
+                lines.append('{}_count{} {}'.format(self.name, suffix, count))
+        return lines
+
+
+class Gauge:
+    """gauge, or counter when kind is counter"""
+
+    def __init__(self, name, documentation, kind='gauge', labelname=None):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelname = labelname
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, value=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + value
+
+    def set(self, value, label=None):
+        with self.lock:
+            self.values[label] = value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for label, value in sorted(self.values.items(), key=lambda i: str(i[0])):
+                lines.append('{}{} {}'.format(self.name, '{{{}="{}"}}'.format(self.labelname, label) if label is not None else '', value))
+        return lines
+
+
+METRICS = {m.name: m for m in [
+    Histogram('cosyvoice_frontend_seconds', 'prompt and text feature extraction time', labelname='stage'),
+    Histogram('cosyvoice_llm_prefill_seconds', 'time until the llm yields the first speech token'),
+    Histogram('cosyvoice_llm_decode_token_seconds', 'time between two speech tokens of the llm'),
+    Histogram('cosyvoice_llm_tokens_per_second', 'speech tokens per second of every llm job', RATE_BUCKETS),
+    Histogram('cosyvoice_flow_seconds', 'flow inference time of every token2wav chunk'),
+    Histogram('cosyvoice_hift_seconds', 'vocoder inference time of every token2wav chunk'),
+    Histogram('cosyvoice_time_to_first_audio_seconds', 'time from the start of a tts session to its first audio chunk'),
+    Histogram('cosyvoice_rtf', 'real time factor of every tts session', RTF_BUCKETS),
+    Gauge('cosyvoice_active_sessions', 'tts sessions in progress'),
+    Histogram('cosyvoice_scheduler_wait_seconds', 'time requests wait in the admission queue', labelname='priority'),
+    Gauge('cosyvoice_scheduler_queue_depth', 'requests waiting in the admission queue', labelname='priority'),
+    Gauge('cosyvoice_scheduler_rejected_total', 'requests rejected by admission control', kind='counter', labelname='reason'),
+]}
+
+
+def enable(tracing=False):
+    """start collecting metrics, with tracing also emit an opentelemetry span per stage if it is installed"""
+    global enabled, tracer
+    enabled = True
+    if tracing:
+        try:
+            from opentelemetry import trace
+            tracer = trace.get_tracer('cosyvoice')
+        except ImportError:
+            logging.warning('opentelemetry is not installed, tracing is disabled')
+
+
+def observe(name, value, label=None):
+    if enabled:
+        METRICS[name].observe(value, label)
+
+
+def inc(name, value=1, label=None):
+    if enabled:
+        METRICS[name].inc(value, label)
+
+
+def set_gauge(name, value, label=None):
+    if enabled:
+        METRICS[name].set(value, label)
+
+
+class Timer:
+    def __init__(self, name, label, uuid):
+        self.name = name
+        self.label = label
+        self.uuid = uuid
+
+    def __enter__(self):
+        self.span = tracer.start_span(self.name, attributes={'cosyvoice.uuid': self.uuid or '', 'cosyvoice.stage': self.label or ''}) \
+            if tracer is not None else None
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        # cuda kernels run asynchronously, wait for them so the stage is not under counted
+        if torch.cuda.is_available():
+            torch.cuda.current_stream().synchronize()
+        METRICS[self.name].observe(time.perf_counter() - self.start_time, self.label)
+        if self.span is not None:
+            self.span.end()
+
+
+_null_timer = nullcontext()
+
+
+def timer(name, label=None, uuid=None):
+    """time a stage into histogram name, with tracing enabled it is also a span tagged with the session uuid"""
+    return Timer(name, label, uuid) if enabled else _null_timer
+
+
+def timed(name, label=None):
+    """decorator version of timer"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def track_session(tts):
+    """decorator of model tts generators, records time to first audio, rtf and active sessions"""
+    @functools.wraps(tts)
+    def wrapper(self, *args, **kwargs):
+        if not enabled:
+            yield from tts(self, *args, **kwargs)
+            return
+        start_time = time.perf_counter()
+        speech_len = 0
+        METRICS['cosyvoice_active_sessions'].inc()
+        try:
+            for model_output in tts(self, *args, **kwargs):
+                if speech_len == 0:
+                    METRICS['cosyvoice_time_to_first_audio_seconds'].observe(time.perf_counter() - start_time)
+                speech_len += model_output['tts_speech'].shape[1]
+                yield model_output
+            if speech_len > 0:
+                # time spent by the caller between chunks is included, as in the rtf of the inference log
+                METRICS['cosyvoice_rtf'].observe((time.perf_counter() - start_time) / (speech_len / self.hift.sampling_rate))
+        finally:
+            METRICS['cosyvoice_active_sessions'].inc(-1)
+    return wrapper
+
+
+def track_tokens(token_generator):
+    """wrap a llm token generator, the wait for the first token is prefill, the following ones are decode steps"""
+    if not enabled:
+        return token_generator
+    return _track_tokens(token_generator)
+
+
+def _track_tokens(token_generator):
+    start_time = last_time = time.perf_counter()
+    num_tokens = 0
+    for token in token_generator:
+        now = time.perf_counter()
+        METRICS['cosyvoice_llm_prefill_seconds' if num_tokens == 0 else 'cosyvoice_llm_decode_token_seconds'].observe(now - last_time)
+        last_time = now
+        num_tokens += 1
+        yield token
+    if num_tokens > 0:
+        METRICS['cosyvoice_llm_tokens_per_second'].observe(num_tokens / (time.perf_counter() - start_time))
+
+
+def render():
+    lines = []
+    for metric in METRICS.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
@@ -0,0 +1,152 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""int16 pcm output helpers, in place float conversion and a shared memory ring buffer for co-located clients."""
+
+import mmap
+import os
+import tempfile
+import time
+import uuid
+import numpy as np
+import torch
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+RING_PREFIX = 'cosyvoice_pcm_'
+
+
+def float_to_int16(speech, out=None):
+    """(speech * 2 ** 15).astype(np.int16) in one pass without temporaries, written into out when it is given"""
+    if isinstance(speech, torch.Tensor):
+        speech = speech.numpy()
+    speech = speech.reshape(-1)
+    if out is None:
+        out = np.empty(speech.shape[0], dtype=np.int16)
+    np.multiply(speech, 2 ** 15, out=out, casting='unsafe')
+    return out
+
+
+class Int16Buffer:
+    """preallocated int16 buffer reused for every chunk of a stream, grows to the longest chunk"""
+
+    def __init__(self, size=0):
+        self.buffer = np.empty(size, dtype=np.int16)
+
+    def convert(self, speech):
+        """int16 view of speech, valid until the next convert"""
+        num_samples = speech.shape[-1] if speech.ndim > 1 else speech.shape[0]
+        if self.buffer.shape[0] < num_samples:
+            self.buffer = np.empty(num_samples, dtype=np.int16)
+        return float_to_int16(speech, self.buffer[:num_samples])
+
+
+def is_ring_path(path):
+    """servers only write into ring buffers created by PcmRingBuffer, never into an arbitrary file of a request"""
+    path = os.path.realpath(path)
+    return os.path.dirname(path) == os.path.realpath(SHM_DIR) and os.path.basename(path).startswith(RING_PREFIX) and os.path.isfile(path)
+
+
+class PcmRingBuffer:
+    """Single producer single consumer int16 pcm ring in a memory mapped file.
+
+    The file lives in /dev/shm by default, so the pages are shared memory. The header keeps the sample rate,
+    the capacity, the total number of samples written and read, and an end of stream flag. The producer
+    converts float speech straight into the ring and waits while it is full, the consumer waits for new
+    samples. Counters only grow and are written after the samples they publish.
+    """
+
+    HEADER_SIZE = 64
+    SAMPLE_RATE, CAPACITY, WRITE_POS, READ_POS, CLOSED = range(5)
+
+    def __init__(self, path=None, capacity=None, sample_rate=None, create=False, poll_interval=0.001):
+        if create:
+            if path is None:
+                path = os.path.join(SHM_DIR, '{}{}'.format(RING_PREFIX, uuid.uuid4().hex))
+            with open(path, 'wb') as f:
+                f.truncate(self.HEADER_SIZE + capacity * 2)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.header = np.ndarray((self.HEADER_SIZE // 8,), dtype=np.int64, buffer=self.mm)
+        if create:
+            self.header[:] = 0
+            self.header[self.SAMPLE_RATE] = sample_rate
+            self.header[self.CAPACITY] = capacity
+        self.sample_rate = int(self.header[self.SAMPLE_RATE])
+        self.capacity = int(self.header[self.CAPACITY])
+        self.data = np.ndarray((self.capacity,), dtype=np.int16, buffer=self.mm, offset=self.HEADER_SIZE)
+
+    def write(self, speech, timeout=None):
+        """convert float speech into the ring, blocks while the ring is full"""
+        if isinstance(speech, torch.Tensor):
+            speech = speech.numpy()
+        speech = speech.reshape(-1)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        offset = 0
+        while offset < speech.shape[0]:
+            write_pos = int(self.header[self.WRITE_POS])
+            num_samples = min(self.capacity - (write_pos - int(self.header[self.READ_POS])), speech.shape[0] - offset)
+            if num_samples == 0:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError('pcm ring {} is full, the reader does not keep up'.format(self.path))
+                time.sleep(self.poll_interval)
+                continue
+            start = write_pos % self.capacity
+            first = min(num_samples, self.capacity - start)
+            float_to_int16(speech[offset: offset + first], self.data[start: start + first])
+            float_to_int16(speech[offset + first: offset + num_samples], self.data[:num_samples - first])
+            self.header[self.WRITE_POS] = write_pos + num_samples
+            offset += num_samples
+
+    def close(self):
+        """mark the end of the stream"""
+        self.header[self.CLOSED] = 1
+
+    def read(self, max_samples=None, timeout=None):
+        """copy out available samples, waits for at least one, returns None once the stream is closed and drained"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            read_pos = int(self.header[self.READ_POS])
+            available = int(self.header[self.WRITE_POS]) - read_pos
+            if available > 0:
+                break
+            if self.header[self.CLOSED] == 1:
+                return None
+            if deadline is not None and time.monotonic() > deadline:
+                return np.empty(0, dtype=np.int16)
+            time.sleep(self.poll_interval)
+        num_samples = available if max_samples is None else min(available, max_samples)
+        start = read_pos % self.capacity
+        first = min(num_samples, self.capacity - start)
+        pcm = np.empty(num_samples, dtype=np.int16)
+        pcm[:first] = self.data[start: start + first]
+        pcm[first:] = self.data[:num_samples - first]
+        self.header[self.READ_POS] = read_pos + num_samples
+        return pcm
+
+    def __iter__(self):
+        while True:
+            pcm = self.read()
+            if pcm is None:
+                break
+            yield pcm
+
+    def release(self):
+        del self.header, self.data
+        self.mm.close()
+        self.file.close()
+
+    def unlink(self):
+        self.release()
+        os.remove(self.path)
@@ -20,7 +20,10 @@ import torch
 import json
 import re
 import datetime
+import time
+import threading
 import yaml
+from functools import partial
 
 import deepspeed
 import torch.optim as optim
@@ -50,22 +53,40 @@ def init_distributed(args):
     return world_size, local_rank, rank
 
 
+def init_worker(worker_id, get_tokenizer):
+    # tokenizer is cached per process, forked workers inherit the one built in main process
+    start_time = time.time()
+    get_tokenizer()
+    logging.info('DataLoader worker {} pid {} init tokenizer in {:.3f}s'.format(worker_id, os.getpid(), time.time() - start_time))
+
+
 def init_dataset_and_dataloader(args, configs, gan, dpo):
     data_pipeline = configs['data_pipeline_gan'] if gan is True else configs['data_pipeline']
     train_dataset = Dataset(args.train_data, data_pipeline=data_pipeline, mode='train', gan=gan, dpo=dpo, shuffle=True, partition=True)
     cv_dataset = Dataset(args.cv_data, data_pipeline=data_pipeline, mode='dev', gan=gan, dpo=dpo, shuffle=False, partition=False)
 
-    # do not use persistent_workers=True, as whisper tokenizer opens tiktoken file each time when the for loop starts
+    # build tokenizer and feat_extractor cache (mel basis, window) before workers are forked,
+    # so that persistent workers share them instead of re-initializing every epoch
+    start_time = time.time()
+    configs['get_tokenizer']()
+    configs['feat_extractor'](torch.zeros(1, configs['sample_rate']))
+    logging.info('init tokenizer and feat_extractor in {:.3f}s'.format(time.time() - start_time))
+    persistent_workers = args.num_workers > 0
+    worker_init_fn = partial(init_worker, get_tokenizer=configs['get_tokenizer']) if persistent_workers is True else None
     train_data_loader = DataLoader(train_dataset,
                                    batch_size=None,
                                    pin_memory=args.pin_memory,
                                    num_workers=args.num_workers,
-                                   prefetch_factor=args.prefetch)
+                                   prefetch_factor=args.prefetch,
+                                   persistent_workers=persistent_workers,
+                                   worker_init_fn=worker_init_fn)
     cv_data_loader = DataLoader(cv_dataset,
                                 batch_size=None,
                                 pin_memory=args.pin_memory,
                                 num_workers=args.num_workers,
-                                prefetch_factor=args.prefetch)
+                                prefetch_factor=args.prefetch,
+                                persistent_workers=persistent_workers,
+                                worker_init_fn=worker_init_fn)
     return train_dataset, cv_dataset, train_data_loader, cv_data_loader
 
 
@@ -192,26 +213,79 @@ def init_summarywriter(args):
     return writer
 
 
-def save_model(model, model_name, info_dict):
+class AsyncCheckpointWriter:
+    """ Write checkpoint in a background thread, so training resumes right
+        after state dict is snapshotted to cpu. The .pt file and its .yaml
+        are written to temporary files first and then renamed, so a .yaml
+        only exists for a complete .pt file. Only the serialization is
+        async, the cv pass that produces the .yaml still runs on every
+        rank before each save.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.exception = None
+
+    def save(self, state_dict, save_model_path, info_str):
+        # only one checkpoint is in flight, so at most one extra cpu copy is kept
+        self.wait()
+        state_dict = {k: v.detach().to('cpu', copy=True) if isinstance(v, torch.Tensor) else v for k, v in state_dict.items()}
+        self.thread = threading.Thread(target=self._write, args=(state_dict, save_model_path, info_str))
+        self.thread.start()
+
+    def _write(self, state_dict, save_model_path, info_str):
+        try:
+            start_time = time.time()
+            write_checkpoint(state_dict, save_model_path, info_str)
+            logging.info('Checkpoint: async save to checkpoint {} in {:.3f}s'.format(save_model_path, time.time() - start_time))
+        except Exception as e:
+            self.exception = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.exception is not None:
+            e, self.exception = self.exception, None
+            raise e
+
+
+def write_checkpoint(state_dict, save_model_path, info_str):
+    info_path = re.sub('.pt$', '.yaml', save_model_path)
+    torch.save(state_dict, save_model_path + '.tmp')
+    with open(info_path + '.tmp', 'w') as fout:
+        fout.write(info_str)
+    os.replace(save_model_path + '.tmp', save_model_path)
+    os.replace(info_path + '.tmp', info_path)
+
+
+def save_model(model, model_name, info_dict, checkpoint_writer=None):
     rank = int(os.environ.get('RANK', 0))
     model_dir = info_dict["model_dir"]
     save_model_path = os.path.join(model_dir, '{}.pt'.format(model_name))
 
     if info_dict["train_engine"] == "torch_ddp":
         if rank == 0:
-            torch.save({**model.module.state_dict(), 'epoch': info_dict['epoch'], 'step': info_dict['step']}, save_model_path)
+            info_dict['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+            state_dict = {**model.module.state_dict(), 'epoch': info_dict['epoch'], 'step': info_dict['step']}
+            if checkpoint_writer is not None:
+                checkpoint_writer.save(state_dict, save_model_path, yaml.dump(info_dict))
+                logging.info('[Rank {}] Checkpoint: snapshot for checkpoint {}'.format(rank, save_model_path))
+            else:
+                write_checkpoint(state_dict, save_model_path, yaml.dump(info_dict))
+                logging.info('[Rank {}] Checkpoint: save to checkpoint {}'.format(rank, save_model_path))
     else:
         with torch.no_grad():
             model.save_checkpoint(save_dir=model_dir,
                                   tag=model_name,
                                   client_state=info_dict)
-    if rank == 0:
-        info_path = re.sub('.pt$', '.yaml', save_model_path)
-        info_dict['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        with open(info_path, 'w') as fout:
-            data = yaml.dump(info_dict)
-            fout.write(data)
-        logging.info('[Rank {}] Checkpoint: save to checkpoint {}'.format(rank, save_model_path))
+        if rank == 0:
+            info_path = re.sub('.pt$', '.yaml', save_model_path)
+            info_dict['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+            with open(info_path, 'w') as fout:
+                data = yaml.dump(info_dict)
+                fout.write(data)
+            logging.info('[Rank {}] Checkpoint: save to checkpoint {}'.format(rank, save_model_path))
 
 
 def cosyvoice_join(group_join, info_dict):
@@ -1,20 +1,33 @@
 import os
+import time
 import uuid
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import Optional, Union
 
 import torch
 import torchaudio
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
 
 from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils import metrics
+from cosyvoice.utils.admission import AdmissionError, RequestScheduler, parse_tenant_priorities
+from cosyvoice.utils.pcm import PcmRingBuffer, is_ring_path
 
 MODEL_DIR = os.getenv("COSYVOICE3_MODEL_DIR", "pretrained_models/Fun-CosyVoice3-0.5B")
 AUDIO_IN_DIR = os.getenv("AUDIO_FILE_DIR", "audio_file")
 AUDIO_OUT_DIR = os.getenv("AUDIO_FILE_GEN_DIR", "audio_file_gen")
+MAX_CONCURRENCY = int(os.getenv("COSYVOICE_MAX_CONCURRENCY", "1"))
+MAX_QUEUE_SIZE = int(os.getenv("COSYVOICE_MAX_QUEUE_SIZE", "16"))
+# comma separated tenant:priority pairs, priority is interactive or batch
+TENANT_PRIORITIES = os.getenv("COSYVOICE_TENANT_PRIORITIES", "")
+TRACING = os.getenv("COSYVOICE_TRACING", "0") == "1"
+# seconds to wait for a client that does not drain its pcm ring buffer
+PCM_RING_TIMEOUT = float(os.getenv("COSYVOICE_PCM_RING_TIMEOUT", "30"))
 
 cosyvoice = None
+scheduler = RequestScheduler(MAX_CONCURRENCY, MAX_QUEUE_SIZE, parse_tenant_priorities(TENANT_PRIORITIES.split(",") if TENANT_PRIORITIES else []))
 
 
 def _ensure_dirs() -> None:
@@ -53,6 +66,69 @@ def _collect_audio(gen) -> torch.Tensor:
     return torch.cat(chunks, dim=1)
 
 
+def _write_pcm_ring(gen, pcm_ring: str) -> int:
+    # int16 pcm goes straight into the shared memory of a co-located client, no wav is written
+    ring = PcmRingBuffer(pcm_ring)
+    num_samples = 0
+    try:
+        for out in gen:
+            ring.write(out["tts_speech"].cpu(), timeout=PCM_RING_TIMEOUT)
+            num_samples += out["tts_speech"].shape[1]
+    finally:
+        ring.close()
+        ring.release()
+    return num_samples
+
+
+def _synthesize_admitted(text: str, tenant: str, deadline: Optional[float], inference, pcm_ring: Optional[str]) -> Union[torch.Tensor, int]:
+    ticket = scheduler.acquire(
+        len(text),
+        scheduler.priority_of(tenant),
+        None if deadline is None else time.monotonic() + deadline,
+    )
+    audio_seconds = 0.0
+    try:
+        if pcm_ring:
+            num_samples = _write_pcm_ring(inference(), pcm_ring)
+            audio_seconds = num_samples / cosyvoice.sample_rate
+            return num_samples
+        audio = _collect_audio(inference())
+        audio_seconds = audio.shape[1] / cosyvoice.sample_rate
+        return audio
+    finally:
+        ticket.release(audio_seconds)
+
+
+async def _synthesize(text: str, tenant: str, deadline: Optional[float], inference, pcm_ring: Optional[str] = None) -> Union[torch.Tensor, int]:
+    # queueing and synthesis run in the threadpool, the event loop keeps serving other requests
+    if pcm_ring and not is_ring_path(pcm_ring):
+        raise HTTPException(status_code=400, detail=f"{pcm_ring} is not a pcm ring buffer")
+    try:
+        return await run_in_threadpool(_synthesize_admitted, text, tenant, deadline, inference, pcm_ring)
+    except AdmissionError as e:
+        status_code = 429 if e.reason == "queue_full" else 503
+        raise HTTPException(status_code=status_code, detail=str(e))
+
+
+def _audio_response(result: Union[torch.Tensor, int], pcm_ring: Optional[str]) -> dict:
+    if pcm_ring:
+        return {
+            "status": "success",
+            "pcm_ring": pcm_ring,
+            "num_samples": result,
+            "sample_rate": cosyvoice.sample_rate,
+        }
+    out_name = f"{uuid.uuid4().hex}.wav"
+    out_path = os.path.abspath(os.path.join(AUDIO_OUT_DIR, out_name))
+    torchaudio.save(out_path, result, cosyvoice.sample_rate)
+    return {
+        "status": "success",
+        "audio_filename": out_name,
+        "audio_path": out_path,
+        "sample_rate": cosyvoice.sample_rate,
+    }
+
+
 def _normalize_prompt_text(prompt_text: str) -> str:
     if "<|endofprompt|>" not in prompt_text:
         return f"{prompt_text}<|endofprompt|>"
@@ -63,6 +139,7 @@ def _normalize_prompt_text(prompt_text: str) -> str:
 async def lifespan(app: FastAPI):
     global cosyvoice
     _ensure_dirs()
+    metrics.enable(tracing=TRACING)
     cosyvoice = AutoModel(model_dir=MODEL_DIR)
     try:
         yield
@@ -75,7 +152,12 @@ app = FastAPI(title="CosyVoice3 Service", lifespan=lifespan)
 
 @app.get("/health")
 async def health() -> dict:
-    return {"status": "ok"}
+    return {"status": "ok", "scheduler": scheduler.stats()}
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.get("/audio/{filename}")
@@ -93,6 +175,9 @@ async def tts_zero_shot(
     prompt_wav: Optional[UploadFile] = File(None),
     prompt_wav_path: Optional[str] = Form(None),
     speed: float = Form(1.0),
+    tenant: str = Form(""),
+    deadline: Optional[float] = Form(None),
+    pcm_ring: Optional[str] = Form(None),
 ) -> dict:
     if cosyvoice is None:
         raise HTTPException(status_code=503, detail="model not loaded")
@@ -104,24 +189,20 @@ async def tts_zero_shot(
         raise HTTPException(status_code=400, detail="prompt_wav or prompt_wav_path required")
     prompt_text = _normalize_prompt_text(prompt_text)
 
-    audio = _collect_audio(
-        cosyvoice.inference_zero_shot(
+    result = await _synthesize(
+        text,
+        tenant,
+        deadline,
+        lambda: cosyvoice.inference_zero_shot(
             text,
             prompt_text,
             prompt_path,
-            stream=False,
+            stream=bool(pcm_ring),
             speed=speed,
-        )
+        ),
+        pcm_ring,
     )
-    out_name = f"{uuid.uuid4().hex}.wav"
-    out_path = os.path.abspath(os.path.join(AUDIO_OUT_DIR, out_name))
-    torchaudio.save(out_path, audio, cosyvoice.sample_rate)
-    return {
-        "status": "success",
-        "audio_filename": out_name,
-        "audio_path": out_path,
-        "sample_rate": cosyvoice.sample_rate,
-    }
+    return _audio_response(result, pcm_ring)
 
 
 @app.post("/tts/cross_lingual")
@@ -130,6 +211,9 @@ async def tts_cross_lingual(
     prompt_wav: Optional[UploadFile] = File(None),
     prompt_wav_path: Optional[str] = Form(None),
     speed: float = Form(1.0),
+    tenant: str = Form(""),
+    deadline: Optional[float] = Form(None),
+    pcm_ring: Optional[str] = Form(None),
 ) -> dict:
     if cosyvoice is None:
         raise HTTPException(status_code=503, detail="model not loaded")
@@ -140,23 +224,19 @@ async def tts_cross_lingual(
     else:
         raise HTTPException(status_code=400, detail="prompt_wav or prompt_wav_path required")
 
-    audio = _collect_audio(
-        cosyvoice.inference_cross_lingual(
+    result = await _synthesize(
+        text,
+        tenant,
+        deadline,
+        lambda: cosyvoice.inference_cross_lingual(
             text,
             prompt_path,
-            stream=False,
+            stream=bool(pcm_ring),
             speed=speed,
-        )
+        ),
+        pcm_ring,
     )
-    out_name = f"{uuid.uuid4().hex}.wav"
-    out_path = os.path.abspath(os.path.join(AUDIO_OUT_DIR, out_name))
-    torchaudio.save(out_path, audio, cosyvoice.sample_rate)
-    return {
-        "status": "success",
-        "audio_filename": out_name,
-        "audio_path": out_path,
-        "sample_rate": cosyvoice.sample_rate,
-    }
+    return _audio_response(result, pcm_ring)
 
 
 @app.post("/tts/instruct")
@@ -166,6 +246,9 @@ async def tts_instruct(
     prompt_wav: Optional[UploadFile] = File(None),
     prompt_wav_path: Optional[str] = Form(None),
     speed: float = Form(1.0),
+    tenant: str = Form(""),
+    deadline: Optional[float] = Form(None),
+    pcm_ring: Optional[str] = Form(None),
 ) -> dict:
     if cosyvoice is None:
         raise HTTPException(status_code=503, detail="model not loaded")
@@ -177,21 +260,17 @@ async def tts_instruct(
         raise HTTPException(status_code=400, detail="prompt_wav or prompt_wav_path required")
     instruct_text = _normalize_prompt_text(instruct_text)
 
-    audio = _collect_audio(
-        cosyvoice.inference_instruct2(
+    result = await _synthesize(
+        text,
+        tenant,
+        deadline,
+        lambda: cosyvoice.inference_instruct2(
             text,
             instruct_text,
             prompt_path,
-            stream=False,
+            stream=bool(pcm_ring),
             speed=speed,
-        )
+        ),
+        pcm_ring,
     )
-    out_name = f"{uuid.uuid4().hex}.wav"
-    out_path = os.path.abspath(os.path.join(AUDIO_OUT_DIR, out_name))
-    torchaudio.save(out_path, audio, cosyvoice.sample_rate)
-    return {
-        "status": "success",
-        "audio_filename": out_name,
-        "audio_path": out_path,
-        "sample_rate": cosyvoice.sample_rate,
-    }
+    return _audio_response(result, pcm_ring)
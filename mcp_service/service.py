@@ -9,10 +9,13 @@ import torchaudio
 from mcp.server import FastMCP
 
 from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.pcm import PcmRingBuffer, is_ring_path
 
 MODEL_DIR = os.getenv("COSYVOICE3_MODEL_DIR", "pretrained_models/Fun-CosyVoice3-0.5B")
 AUDIO_IN_DIR = os.getenv("AUDIO_FILE_DIR", "audio_file")
 AUDIO_OUT_DIR = os.getenv("AUDIO_FILE_GEN_DIR", "audio_file_gen")
+# seconds to wait for a client that does not drain its pcm ring buffer
+PCM_RING_TIMEOUT = float(os.getenv("COSYVOICE_PCM_RING_TIMEOUT", "30"))
 
 
 mcp = FastMCP(name="CosyVoice3MCP")
@@ -78,6 +81,39 @@ def _save_audio(audio: torch.Tensor) -> str:
     return out_path
 
 
+def _write_pcm_ring(gen, pcm_ring_path: str) -> int:
+    # int16 pcm goes straight into the shared memory of a co-located client, no wav is written
+    if not is_ring_path(pcm_ring_path):
+        raise ValueError(f"{pcm_ring_path} is not a pcm ring buffer")
+    ring = PcmRingBuffer(pcm_ring_path)
+    num_samples = 0
+    try:
+        for out in gen:
+            ring.write(out["tts_speech"].cpu(), timeout=PCM_RING_TIMEOUT)
+            num_samples += out["tts_speech"].shape[1]
+    finally:
+        ring.close()
+        ring.release()
+    return num_samples
+
+
+def _audio_result(inference, prompt_path: str, pcm_ring_path: str) -> Dict[str, Any]:
+    if pcm_ring_path:
+        result = {
+            "status": "success",
+            "pcm_ring_path": pcm_ring_path,
+            "num_samples": _write_pcm_ring(inference(stream=True), pcm_ring_path),
+        }
+    else:
+        result = {
+            "status": "success",
+            "audio_path": _save_audio(_collect_audio(inference(stream=False))),
+        }
+    result["prompt_audio_path"] = os.path.abspath(prompt_path)
+    result["sample_rate"] = cosyvoice.sample_rate
+    return result
+
+
 @mcp.tool(
     name="cosyvoice3_zero_shot",
     description="Zero-shot voice clone using local path or URL prompt audio.",
@@ -87,25 +123,21 @@ async def cosyvoice3_zero_shot(
     prompt_text: str,
     prompt_wav_path: str,
     speed: float = 1.0,
+    pcm_ring_path: str = "",
 ) -> Dict[str, Any]:
     prompt_path = _resolve_prompt_audio(prompt_wav_path)
     prompt_text = _normalize_prompt_text(prompt_text)
-    audio = _collect_audio(
-        cosyvoice.inference_zero_shot(
+    return _audio_result(
+        lambda stream: cosyvoice.inference_zero_shot(
             text,
             prompt_text,
             prompt_path,
-            stream=False,
+            stream=stream,
             speed=speed,
-        )
+        ),
+        prompt_path,
+        pcm_ring_path,
     )
-    out_path = _save_audio(audio)
-    return {
-        "status": "success",
-        "audio_path": out_path,
-        "prompt_audio_path": os.path.abspath(prompt_path),
-        "sample_rate": cosyvoice.sample_rate,
-    }
 
 
 @mcp.tool(
@@ -116,23 +148,19 @@ async def cosyvoice3_cross_lingual(
     text: str,
     prompt_wav_path: str,
     speed: float = 1.0,
+    pcm_ring_path: str = "",
 ) -> Dict[str, Any]:
     prompt_path = _resolve_prompt_audio(prompt_wav_path)
-    audio = _collect_audio(
-        cosyvoice.inference_cross_lingual(
+    return _audio_result(
+        lambda stream: cosyvoice.inference_cross_lingual(
             text,
             prompt_path,
-            stream=False,
+            stream=stream,
             speed=speed,
-        )
+        ),
+        prompt_path,
+        pcm_ring_path,
     )
-    out_path = _save_audio(audio)
-    return {
-        "status": "success",
-        "audio_path": out_path,
-        "prompt_audio_path": os.path.abspath(prompt_path),
-        "sample_rate": cosyvoice.sample_rate,
-    }
 
 
 @mcp.tool(
@@ -144,22 +172,18 @@ async def cosyvoice3_instruct(
     instruct_text: str,
     prompt_wav_path: str,
     speed: float = 1.0,
+    pcm_ring_path: str = "",
 ) -> Dict[str, Any]:
     prompt_path = _resolve_prompt_audio(prompt_wav_path)
     instruct_text = _normalize_prompt_text(instruct_text)
-    audio = _collect_audio(
-        cosyvoice.inference_instruct2(
+    return _audio_result(
+        lambda stream: cosyvoice.inference_instruct2(
             text,
             instruct_text,
             prompt_path,
-            stream=False,
+            stream=stream,
             speed=speed,
-        )
+        ),
+        prompt_path,
+        pcm_ring_path,
     )
-    out_path = _save_audio(audio)
-    return {
-        "status": "success",
-        "audio_path": out_path,
-        "prompt_audio_path": os.path.abspath(prompt_path),
-        "sample_rate": cosyvoice.sample_rate,
-    }
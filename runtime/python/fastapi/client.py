@@ -11,12 +11,41 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import sys
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import torch
 import torchaudio
 import numpy as np
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../../..'.format(ROOT_DIR))
+from cosyvoice.utils.pcm import PcmRingBuffer
+
+
+def receive_pcm_ring(url, payload, files):
+    # the server runs on the same host, it writes int16 pcm into a shared memory ring buffer created here
+    ring = PcmRingBuffer(capacity=args.pcm_ring_seconds * target_sr, sample_rate=target_sr, create=True)
+    payload['pcm_ring'] = ring.path
+    tts_audio = []
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(requests.request, "GET", url, data=payload, files=files)
+            while True:
+                pcm = ring.read(timeout=0.1)
+                if pcm is None:
+                    break
+                if len(pcm) == 0 and future.done():
+                    # the server returned without closing the ring, the request failed
+                    future.result().raise_for_status()
+                    break
+                tts_audio.append(pcm)
+            logging.info('server response {}'.format(future.result().json()))
+    finally:
+        ring.unlink()
+    return np.concatenate(tts_audio) if len(tts_audio) > 0 else np.zeros(0, dtype=np.int16)
 
 
 def main():
@@ -26,31 +55,33 @@ def main():
             'tts_text': args.tts_text,
             'spk_id': args.spk_id
         }
-        response = requests.request("GET", url, data=payload, stream=True)
+        files = None
     elif args.mode == 'zero_shot':
         payload = {
             'tts_text': args.tts_text,
             'prompt_text': args.prompt_text
         }
         files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
-        response = requests.request("GET", url, data=payload, files=files, stream=True)
     elif args.mode == 'cross_lingual':
         payload = {
             'tts_text': args.tts_text,
         }
         files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
-        response = requests.request("GET", url, data=payload, files=files, stream=True)
     else:
         payload = {
             'tts_text': args.tts_text,
             'spk_id': args.spk_id,
             'instruct_text': args.instruct_text
         }
-        response = requests.request("GET", url, data=payload, stream=True)
-    tts_audio = b''
-    for r in response.iter_content(chunk_size=16000):
-        tts_audio += r
-    tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
+        files = None
+    if args.pcm_ring:
+        tts_speech = torch.from_numpy(receive_pcm_ring(url, payload, files)).unsqueeze(dim=0)
+    else:
+        response = requests.request("GET", url, data=payload, files=files, stream=True)
+        tts_audio = b''
+        for r in response.iter_content(chunk_size=16000):
+            tts_audio += r
+        tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
     logging.info('save response to {}'.format(args.tts_wav))
     torchaudio.save(args.tts_wav, tts_speech, target_sr)
     logging.info('get response')
@@ -87,6 +118,13 @@ if __name__ == "__main__":
     parser.add_argument('--tts_wav',
                         type=str,
                         default='demo.wav')
+    parser.add_argument('--pcm_ring',
+                        action='store_true',
+                        help='receive the audio through a shared memory ring buffer, the server must run on the same host')
+    parser.add_argument('--pcm_ring_seconds',
+                        type=int,
+                        default=10,
+                        help='capacity of the ring buffer in seconds of audio')
     args = parser.parse_args()
     prompt_sr, target_sr = 16000, 22050
     main()
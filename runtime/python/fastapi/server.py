@@ -13,19 +13,23 @@
 # limitations under the License.
 import os
 import sys
+import time
 import argparse
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import numpy as np
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import AutoModel
 from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.utils.admission import AdmissionError, RequestScheduler, parse_tenant_priorities
+from cosyvoice.utils import metrics
+from cosyvoice.utils.pcm import Int16Buffer, PcmRingBuffer, is_ring_path
 
 app = FastAPI()
 # set cross region allowance
@@ -37,48 +41,103 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+def generate_data(model_output, ticket):
+    audio_seconds, buffer = 0, Int16Buffer()
+    try:
+        for i in model_output:
+            audio_seconds += i['tts_speech'].shape[1] / cosyvoice.sample_rate
+            yield buffer.convert(i['tts_speech']).tobytes()
+    finally:
+        ticket.release(audio_seconds)
+
+
+def write_pcm_ring(model_output, ticket, pcm_ring):
+    ring, num_samples = PcmRingBuffer(pcm_ring), 0
+    try:
+        for i in model_output:
+            ring.write(i['tts_speech'], timeout=args.pcm_ring_timeout)
+            num_samples += i['tts_speech'].shape[1]
+    finally:
+        ring.close()
+        ring.release()
+        ticket.release(num_samples / cosyvoice.sample_rate)
+    return num_samples
+
+
+async def respond(model_output, ticket, pcm_ring):
+    if pcm_ring == '':
+        return StreamingResponse(generate_data(model_output, ticket))
+    # a co-located client created the ring buffer and reads the pcm from it, only the sample count goes over http
+    if not is_ring_path(pcm_ring):
+        ticket.release(0)
+        raise HTTPException(status_code=400, detail='{} is not a pcm ring buffer'.format(pcm_ring))
+    num_samples = await run_in_threadpool(write_pcm_ring, model_output, ticket, pcm_ring)
+    return {'num_samples': num_samples, 'sample_rate': cosyvoice.sample_rate}
+
+
+async def admit(tts_text, tenant, deadline):
+    # wait for a slot in the threadpool, so queued requests do not block the event loop
+    priority = scheduler.priority_of(tenant, stream=True)
+    try:
+        return await run_in_threadpool(scheduler.acquire, len(tts_text), priority, time.monotonic() + deadline if deadline > 0 else None)
+    except AdmissionError as e:
+        raise HTTPException(status_code=429 if e.reason == 'queue_full' else 503, detail=str(e))
+
+
+@app.get("/scheduler_stats")
+async def scheduler_stats():
+    return scheduler.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.get("/inference_sft")
 @app.post("/inference_sft")
-async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
+async def inference_sft(tts_text: str = Form(), spk_id: str = Form(), tenant: str = Form(''), deadline: float = Form(0), pcm_ring: str = Form('')):
+    ticket = await admit(tts_text, tenant, deadline)
     model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+    return await respond(model_output, ticket, pcm_ring)
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File(),
+                              tenant: str = Form(''), deadline: float = Form(0), pcm_ring: str = Form('')):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
+    ticket = await admit(tts_text, tenant, deadline)
     model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    return await respond(model_output, ticket, pcm_ring)
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File(), tenant: str = Form(''), deadline: float = Form(0), pcm_ring: str = Form('')):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
+    ticket = await admit(tts_text, tenant, deadline)
     model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    return await respond(model_output, ticket, pcm_ring)
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
-async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
+async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form(),
+                             tenant: str = Form(''), deadline: float = Form(0), pcm_ring: str = Form('')):
+    ticket = await admit(tts_text, tenant, deadline)
     model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+    return await respond(model_output, ticket, pcm_ring)
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
-async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
+async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File(),
+                              tenant: str = Form(''), deadline: float = Form(0), pcm_ring: str = Form('')):
     prompt_speech_16k = load_wav(prompt_wav.file, 16000)
+    ticket = await admit(tts_text, tenant, deadline)
     model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+    return await respond(model_output, ticket, pcm_ring)
 
 
 if __name__ == '__main__':
@@ -90,6 +149,28 @@ if __name__ == '__main__':
                         type=str,
                         default='iic/CosyVoice2-0.5B',
                         help='local path or modelscope repo id')
+    parser.add_argument('--max_concurrency',
+                        type=int,
+                        default=1,
+                        help='number of requests synthesized at the same time')
+    parser.add_argument('--max_queue_size',
+                        type=int,
+                        default=16,
+                        help='number of waiting requests of every priority class')
+    parser.add_argument('--tenant_priorities',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='tenant:priority pairs, priority is interactive or batch')
+    parser.add_argument('--pcm_ring_timeout',
+                        type=float,
+                        default=30,
+                        help='seconds to wait for a client that does not drain its pcm ring buffer')
+    parser.add_argument('--tracing',
+                        action='store_true',
+                        help='emit an opentelemetry span per inference stage, needs opentelemetry installed')
     args = parser.parse_args()
+    metrics.enable(tracing=args.tracing)
+    scheduler = RequestScheduler(args.max_concurrency, args.max_queue_size, parse_tenant_priorities(args.tenant_priorities))
     cosyvoice = AutoModel(model_dir=args.model_dir)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
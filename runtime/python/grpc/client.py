@@ -27,10 +27,25 @@ import numpy as np
 from cosyvoice.utils.file_utils import load_wav
 
 
+def stream_requests():
+    yield cosyvoice_pb2.StreamRequest(setup=cosyvoice_pb2.streamSetup(spk_id=args.spk_id))
+    # simulate text coming from a text llm, a few characters at a time
+    for i in range(0, len(args.tts_text), 5):
+        yield cosyvoice_pb2.StreamRequest(tts_text=args.tts_text[i:i + 5])
+
+
 def main():
     with grpc.insecure_channel("{}:{}".format(args.host, args.port)) as channel:
         stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
         request = cosyvoice_pb2.Request()
+        if args.mode == 'register':
+            logging.info('send register speaker request')
+            prompt_speech = load_wav(args.prompt_wav, 16000)
+            response = stub.RegisterSpeaker(cosyvoice_pb2.RegisterSpeakerRequest(spk_id=args.spk_id,
+                                                                                 prompt_text=args.prompt_text,
+                                                                                 prompt_audio=(prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()))
+            logging.info('registered speaker {}'.format(response.spk_id))
+            return
         if args.mode == 'sft':
             logging.info('send sft request')
             sft_request = cosyvoice_pb2.sftRequest()
@@ -41,9 +56,12 @@ def main():
             logging.info('send zero_shot request')
             zero_shot_request = cosyvoice_pb2.zeroshotRequest()
             zero_shot_request.tts_text = args.tts_text
-            zero_shot_request.prompt_text = args.prompt_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            zero_shot_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            if args.use_registered_spk:
+                zero_shot_request.spk_id = args.spk_id
+            else:
+                zero_shot_request.prompt_text = args.prompt_text
+                prompt_speech = load_wav(args.prompt_wav, 16000)
+                zero_shot_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
             request.zero_shot_request.CopyFrom(zero_shot_request)
         elif args.mode == 'cross_lingual':
             logging.info('send cross_lingual request')
@@ -52,6 +70,8 @@ def main():
             prompt_speech = load_wav(args.prompt_wav, 16000)
             cross_lingual_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
             request.cross_lingual_request.CopyFrom(cross_lingual_request)
+        elif args.mode == 'stream':
+            logging.info('send stream request')
         else:
             logging.info('send instruct request')
             instruct_request = cosyvoice_pb2.instructRequest()
@@ -60,7 +80,13 @@ def main():
             instruct_request.instruct_text = args.instruct_text
             request.instruct_request.CopyFrom(instruct_request)
 
-        response = stub.Inference(request)
+        # the server schedules by tenant and rejects early when it can not finish before the timeout
+        metadata = [('tenant', args.tenant)]
+        timeout = args.timeout if args.timeout > 0 else None
+        if args.mode == 'stream':
+            response = stub.StreamInference(stream_requests(), metadata=metadata, timeout=timeout)
+        else:
+            response = stub.Inference(request, metadata=metadata, timeout=timeout)
         tts_audio = b''
         for r in response:
             tts_audio += r.tts_audio
@@ -80,8 +106,11 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
-                        help='request mode')
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'register', 'stream'],
+                        help='request mode, register a zero shot speaker as spk_id, stream sends tts_text in fragments to spk_id')
+    parser.add_argument('--use_registered_spk',
+                        action='store_true',
+                        help='reference the speaker registered as spk_id in zero_shot mode instead of sending prompt_wav')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
@@ -101,6 +130,13 @@ if __name__ == "__main__":
     parser.add_argument('--tts_wav',
                         type=str,
                         default='demo.wav')
+    parser.add_argument('--tenant',
+                        type=str,
+                        default='')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=0,
+                        help='rpc deadline in seconds, 0 means no deadline')
     args = parser.parse_args()
     prompt_sr, target_sr = 16000, 22050
     main()
@@ -15,58 +15,475 @@ import os
 import sys
 from concurrent import futures
 import argparse
+import collections
+import io
+import itertools
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import cosyvoice_pb2
 import cosyvoice_pb2_grpc
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 import grpc
 import torch
+import torchaudio
 import numpy as np
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.admission import AdmissionError, RequestScheduler, parse_tenant_priorities
+from cosyvoice.utils import metrics
+from cosyvoice.utils.pcm import Int16Buffer, PcmRingBuffer
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 
+def load_prompt_audio(prompt_audio):
+    """the 16k int16 pcm of a request as an in memory wav file, the frontend loads prompt_wav with load_wav"""
+    prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
+    prompt_wav = io.BytesIO()
+    torchaudio.save(prompt_wav, prompt_speech_16k.float() / (2**15), 16000, format='wav', backend='soundfile')
+    return prompt_wav
+
+
+class RequestError(Exception):
+    """a request the client has to fix, the rpc is aborted with code"""
+
+    def __init__(self, code, details):
+        super().__init__(code, details)
+        self.code = code
+        self.details = details
+
+
+def check_speaker(cosyvoice, spk_id):
+    if spk_id not in cosyvoice.frontend.spk2info:
+        raise RequestError(grpc.StatusCode.NOT_FOUND, 'speaker {} is not registered'.format(spk_id))
+
+
+def check_request(cosyvoice, request):
+    """raise RequestError when the speaker of an Inference request is unknown, zero_shot and cross_lingual requests
+    without spk_id bring their own prompt"""
+    payload = getattr(request, request.WhichOneof('RequestPayload'))
+    if payload.spk_id != '' or request.HasField('sft_request') or request.HasField('instruct_request'):
+        check_speaker(cosyvoice, payload.spk_id)
+
+
+def model_inference(cosyvoice, request):
+    if request.HasField('sft_request'):
+        logging.info('get sft inference request')
+        model_output = cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
+    elif request.HasField('zero_shot_request'):
+        logging.info('get zero_shot inference request')
+        if request.zero_shot_request.spk_id != '':
+            model_output = cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text, '', '',
+                                                         zero_shot_spk_id=request.zero_shot_request.spk_id)
+        else:
+            model_output = cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
+                                                         request.zero_shot_request.prompt_text,
+                                                         load_prompt_audio(request.zero_shot_request.prompt_audio))
+    elif request.HasField('cross_lingual_request'):
+        logging.info('get cross_lingual inference request')
+        if request.cross_lingual_request.spk_id != '':
+            model_output = cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, '',
+                                                             zero_shot_spk_id=request.cross_lingual_request.spk_id)
+        else:
+            model_output = cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text,
+                                                             load_prompt_audio(request.cross_lingual_request.prompt_audio))
+    else:
+        logging.info('get instruct inference request')
+        model_output = cosyvoice.inference_instruct(request.instruct_request.tts_text,
+                                                    request.instruct_request.spk_id,
+                                                    request.instruct_request.instruct_text)
+    return model_output
+
+
+def register_speaker(cosyvoice, request):
+    logging.info('register speaker {}'.format(request.spk_id))
+    assert cosyvoice.add_zero_shot_spk(request.prompt_text, load_prompt_audio(request.prompt_audio), request.spk_id) is True
+
+
+def worker_main(model_dir, num_threads, request_queue, cancel_queue, text_queue, output_queue, ring_path):
+    torch.set_num_threads(num_threads)
+    server_pid = os.getppid()
+    ring = PcmRingBuffer(ring_path)
+    # weights are loaded with mmap, so all workers share their pages through the page cache
+    cosyvoice = AutoModel(model_dir=model_dir, mmap=True)
+    output_queue.put((None, cosyvoice.sample_rate))
+    cancelled = set()
+    # request_id -> text fragments of a StreamInference that arrived before the worker got to it
+    texts = {}
+    serving = [None]
+
+    def is_cancelled(request_id):
+        # a killed server cannot stop its daemon workers, the worker is reparented and stops by itself
+        if os.getppid() != server_pid:
+            return True
+        while True:
+            try:
+                cancelled.add(cancel_queue.get_nowait())
+            except queue.Empty:
+                return request_id in cancelled
+
+    def stream_text(request_id):
+        """text fragments of a StreamInference request, until the client finished sending or the request is cancelled"""
+        fragments = texts.setdefault(request_id, collections.deque())
+        while True:
+            while len(fragments) == 0:
+                try:
+                    text_request_id, text = text_queue.get(timeout=1.0)
+                except queue.Empty:
+                    # the llm thread of a closed request may still wait for text after the worker moved on
+                    if is_cancelled(request_id) or serving[0] != request_id:
+                        return
+                    continue
+                # fragments of cancelled older streams are dropped, those of newer ones wait for their turn
+                if text_request_id >= request_id:
+                    texts.setdefault(text_request_id, collections.deque()).append(text)
+            text = fragments.popleft()
+            if text is None:
+                return
+            yield text
+
+    while True:
+        try:
+            request_id, method, request = request_queue.get(timeout=1.0)
+        except queue.Empty:
+            if os.getppid() != server_pid:
+                break
+            continue
+        if request_id is None:
+            break
+        serving[0] = request_id
+        try:
+            if is_cancelled(request_id):
+                logging.info('skip cancelled request {}'.format(request_id))
+            elif method == 'RegisterSpeaker':
+                register_speaker(cosyvoice, cosyvoice_pb2.RegisterSpeakerRequest.FromString(request))
+            else:
+                if method == 'StreamInference':
+                    request = cosyvoice_pb2.StreamRequest.FromString(request)
+                    check_speaker(cosyvoice, request.setup.spk_id)
+                    model_output = cosyvoice.inference_zero_shot(stream_text(request_id), '', '', zero_shot_spk_id=request.setup.spk_id, stream=True)
+                else:
+                    request = cosyvoice_pb2.Request.FromString(request)
+                    check_request(cosyvoice, request)
+                    model_output = model_inference(cosyvoice, request)
+                for i in model_output:
+                    # the client is gone, stop synthesizing the rest of the text
+                    if is_cancelled(request_id):
+                        logging.info('cancel request {}'.format(request_id))
+                        model_output.close()
+                        break
+                    # the speech is converted to int16 straight into the shared memory ring, only its length is sent, in
+                    # pieces of at most the ring capacity as the relay frees the ring only for samples it was told about.
+                    # The relay drains the ring right away, a ring full for long means the server is gone
+                    speech = i['tts_speech'].reshape(-1)
+                    for start in range(0, speech.shape[0], ring.capacity):
+                        ring.write(speech[start: start + ring.capacity], timeout=60)
+                        output_queue.put((request_id, min(ring.capacity, speech.shape[0] - start)))
+            output_queue.put((request_id, None))
+        except RequestError as e:
+            output_queue.put((request_id, (e.code, e.details)))
+        except Exception as e:
+            logging.exception('inference request {} failed'.format(request_id))
+            output_queue.put((request_id, str(e)))
+        # requests are served in the order of their ids, older cancels and texts are of no use anymore
+        cancelled -= {i for i in cancelled if i <= request_id}
+        for i in [i for i in texts if i <= request_id]:
+            texts.pop(i)
+
+
+class WorkerExitedError(RuntimeError):
+    pass
+
+
+Worker = collections.namedtuple('Worker', ['process', 'request_queue', 'cancel_queue', 'text_queue'])
+
+
+class WorkerPool:
+    """N model processes, each request goes to the worker with the least outstanding text to synthesize
+
+    Every worker writes its speech as int16 into its own shared memory PcmRingBuffer and only sends the number of
+    samples through its output queue, the relay thread copies them out of the ring into the response of the session.
+    A worker process that dies fails its in-flight sessions with WorkerExitedError and is respawned, the speakers
+    registered so far are registered again on the new process before it serves requests.
+    """
+
+    def __init__(self, model_dir, num_workers, num_threads, poll_interval=1.0, ring_capacity=2 ** 20):
+        self.ctx = torch.multiprocessing.get_context('spawn')
+        self.model_dir = model_dir
+        self.num_threads = num_threads
+        self.poll_interval = poll_interval
+        self.ring_capacity = ring_capacity
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        # request_id -> (worker_id, session)
+        self.sessions = {}
+        # spk_id -> serialized RegisterSpeakerRequest
+        self.speakers = {}
+        self.sample_rate = None
+        self.outstanding_work = [0] * num_workers
+        self.workers = [None] * num_workers
+        with self.lock:
+            for worker_id in range(num_workers):
+                self.start_worker(worker_id)
+
+    def start_worker(self, worker_id):
+        """start the process of worker_id and its relay thread, the caller holds self.lock"""
+        request_queue, cancel_queue, text_queue, output_queue = self.ctx.Queue(), self.ctx.Queue(), self.ctx.Queue(), self.ctx.Queue()
+        ring = PcmRingBuffer(capacity=self.ring_capacity, sample_rate=0, create=True)
+        process = self.ctx.Process(target=worker_main, args=(self.model_dir, self.num_threads, request_queue, cancel_queue, text_queue,
+                                                             output_queue, ring.path), daemon=True)
+        process.start()
+        for request in self.speakers.values():
+            # no session waits for these outputs, relay drops them
+            request_queue.put((next(self.request_ids), 'RegisterSpeaker', request))
+        self.workers[worker_id] = Worker(process, request_queue, cancel_queue, text_queue)
+        threading.Thread(target=self.relay, args=(worker_id, process, output_queue, ring), daemon=True).start()
+
+    def relay(self, worker_id, process, output_queue, ring):
+        try:
+            while True:
+                try:
+                    request_id, output = output_queue.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    if not process.is_alive():
+                        self.respawn(worker_id, process)
+                        return
+                    continue
+                if request_id is None:
+                    # the worker has mapped the ring before loading its model, the file is not needed anymore
+                    os.remove(ring.path)
+                    self.sample_rate = output
+                    continue
+                if isinstance(output, int):
+                    # copied out right away, also for gone sessions, so the worker never waits for a slow client
+                    output = ring.read(max_samples=output)
+                with self.lock:
+                    session = self.sessions.get(request_id)
+                # the session is gone when the client cancelled the rpc, drop the rest of its outputs
+                if session is not None:
+                    session[1].put(output)
+        finally:
+            if os.path.exists(ring.path):
+                os.remove(ring.path)
+            ring.release()
+
+    def respawn(self, worker_id, process):
+        with self.lock:
+            logging.error('worker {} exited with code {}, respawn it'.format(worker_id, process.exitcode))
+            for session_worker_id, session in self.sessions.values():
+                if session_worker_id == worker_id:
+                    session.put(WorkerExitedError('worker {} exited with code {}'.format(worker_id, process.exitcode)))
+            self.start_worker(worker_id)
+
+    def cancel(self, worker_id, request_id):
+        with self.lock:
+            self.workers[worker_id].cancel_queue.put(request_id)
+
+    def register_speaker(self, request, context):
+        # every worker keeps its own spk2info, so the speaker is registered on all of them
+        serialized_request = request.SerializeToString()
+        with self.lock:
+            request_ids = [next(self.request_ids) for _ in self.workers]
+            sessions = [queue.Queue() for _ in self.workers]
+            for worker_id, (request_id, session) in enumerate(zip(request_ids, sessions)):
+                self.sessions[request_id] = (worker_id, session)
+                self.workers[worker_id].request_queue.put((request_id, 'RegisterSpeaker', serialized_request))
+        try:
+            for worker_id, session in enumerate(sessions):
+                output = session.get()
+                if isinstance(output, WorkerExitedError):
+                    context.abort(grpc.StatusCode.UNAVAILABLE, str(output))
+                if isinstance(output, str):
+                    raise RuntimeError('register speaker failed in worker {}: {}'.format(worker_id, output))
+            with self.lock:
+                self.speakers[request.spk_id] = serialized_request
+        finally:
+            with self.lock:
+                for request_id in request_ids:
+                    self.sessions.pop(request_id)
+
+    def submit(self, request, context, text_iterator=None):
+        """int16 pcm of an Inference request, or with text_iterator of a StreamInference whose setup is request, the text
+        fragments are forwarded to the worker while it synthesizes"""
+        if text_iterator is None:
+            method, work = 'Inference', [len(getattr(request, request.WhichOneof('RequestPayload')).tts_text)]
+        else:
+            # the text is not known yet, the fragments count once they are forwarded
+            method, work = 'StreamInference', [0]
+        session = queue.Queue()
+        with self.lock:
+            worker_id = min(range(len(self.outstanding_work)), key=lambda i: self.outstanding_work[i])
+            self.outstanding_work[worker_id] += work[0]
+            request_id = next(self.request_ids)
+            self.sessions[request_id] = (worker_id, session)
+            # queued under the lock, so a respawn either fails this session or the request goes to the new process
+            self.workers[worker_id].request_queue.put((request_id, method, request.SerializeToString()))
+            if text_iterator is not None:
+                threading.Thread(target=self.forward_text, args=(worker_id, request_id, text_iterator, work), daemon=True).start()
+        finished = False
+        try:
+            while context.is_active():
+                try:
+                    output = session.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+                if output is None:
+                    finished = True
+                    break
+                if isinstance(output, WorkerExitedError):
+                    finished = True
+                    context.abort(grpc.StatusCode.UNAVAILABLE, str(output))
+                if isinstance(output, tuple):
+                    # a RequestError of the worker
+                    finished = True
+                    context.abort(*output)
+                if isinstance(output, str):
+                    finished = True
+                    raise RuntimeError('inference failed in worker {}: {}'.format(worker_id, output))
+                yield {'tts_audio': output}
+            if not finished:
+                logging.info('request {} cancelled by the client'.format(request_id))
+        finally:
+            with self.lock:
+                self.outstanding_work[worker_id] -= work[0]
+                self.sessions.pop(request_id)
+            # also reached when grpc closes the generator of a cancelled rpc
+            if not finished:
+                self.cancel(worker_id, request_id)
+
+    def forward_text(self, worker_id, request_id, text_iterator, work):
+        with self.lock:
+            text_queue = self.workers[worker_id].text_queue
+        try:
+            for text in text_iterator:
+                with self.lock:
+                    # the session is gone, its work is settled already
+                    if request_id not in self.sessions:
+                        return
+                    self.outstanding_work[worker_id] += len(text)
+                    work[0] += len(text)
+                text_queue.put((request_id, text))
+        except grpc.RpcError as e:
+            logging.info('stop forwarding the text of request {}: {}'.format(request_id, e))
+        finally:
+            text_queue.put((request_id, None))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
-        self.cosyvoice = AutoModel(model_dir=args.model_dir)
+        if args.num_workers > 0:
+            self.cosyvoice = None
+            self.worker_pool = WorkerPool(args.model_dir, args.num_workers, args.num_threads)
+        else:
+            self.cosyvoice = AutoModel(model_dir=args.model_dir)
+        self.scheduler = RequestScheduler(args.max_conc, args.max_queue_size, parse_tenant_priorities(args.tenant_priorities))
         logging.info('grpc service initialized')
 
+    def admit(self, context, work, stream):
+        tenant = dict(context.invocation_metadata()).get('tenant', '')
+        time_remaining = context.time_remaining()
+        try:
+            return self.scheduler.acquire(work, self.scheduler.priority_of(tenant, stream=stream),
+                                          None if time_remaining is None else time.monotonic() + time_remaining)
+        except AdmissionError as e:
+            logging.warning('reject request of tenant {}: {}'.format(tenant, e))
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED if e.reason == 'queue_full' else grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
+
+    def send(self, model_output, ticket):
+        audio_samples, buffer = 0, Int16Buffer()
+        try:
+            for i in model_output:
+                # the worker pool relays int16 pcm already
+                tts_audio = i['tts_audio'] if 'tts_audio' in i else buffer.convert(i['tts_speech'])
+                audio_samples += tts_audio.shape[0]
+                response = cosyvoice_pb2.Response()
+                response.tts_audio = tts_audio.tobytes()
+                yield response
+        finally:
+            # worker pool learns the sample rate once the first worker has loaded its model
+            sample_rate = self.worker_pool.sample_rate if self.cosyvoice is None else self.cosyvoice.sample_rate
+            ticket.release(audio_samples / sample_rate if audio_samples > 0 else 0)
+
+    def check_request(self, context, check, *args):
+        # with the worker pool the worker checks the request against its own spk2info
+        if self.cosyvoice is None:
+            return
+        try:
+            check(self.cosyvoice, *args)
+        except RequestError as e:
+            context.abort(e.code, e.details)
+
     def Inference(self, request, context):
-        if request.HasField('sft_request'):
-            logging.info('get sft inference request')
-            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
-        elif request.HasField('zero_shot_request'):
-            logging.info('get zero_shot inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
-                                                              request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
-        elif request.HasField('cross_lingual_request'):
-            logging.info('get cross_lingual inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+        if request.WhichOneof('RequestPayload') is None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'the request has no payload')
+        self.check_request(context, check_request, request)
+        ticket = self.admit(context, len(getattr(request, request.WhichOneof('RequestPayload')).tts_text), stream=False)
+        if self.cosyvoice is None:
+            model_output = self.worker_pool.submit(request, context)
         else:
-            logging.info('get instruct inference request')
-            model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
-                                                             request.instruct_request.spk_id,
-                                                             request.instruct_request.instruct_text)
+            model_output = model_inference(self.cosyvoice, request)
 
         logging.info('send inference response')
-        for i in model_output:
-            response = cosyvoice_pb2.Response()
-            response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-            yield response
+        yield from self.send(model_output, ticket)
+
+    def StreamInference(self, request_iterator, context):
+        request = next(request_iterator, None)
+        if request is None or not request.HasField('setup'):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'the first StreamInference message must be a setup')
+        self.check_request(context, check_speaker, request.setup.spk_id)
+        logging.info('get stream inference request')
+        # the text is not known yet, only the work queued ahead counts against the deadline
+        ticket = self.admit(context, 0, stream=True)
+        # the text generator is consumed by the llm thread while the client keeps sending fragments
+        text_generator = (i.tts_text for i in request_iterator if i.tts_text != '')
+        if self.cosyvoice is None:
+            model_output = self.worker_pool.submit(request, context, text_generator)
+        else:
+            model_output = self.cosyvoice.inference_zero_shot(text_generator, '', '', zero_shot_spk_id=request.setup.spk_id, stream=True)
+        yield from self.send(model_output, ticket)
+
+    def RegisterSpeaker(self, request, context):
+        if request.spk_id == '':
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'do not use empty spk_id')
+        if self.cosyvoice is None:
+            self.worker_pool.register_speaker(request, context)
+        else:
+            register_speaker(self.cosyvoice, request)
+        return cosyvoice_pb2.RegisterSpeakerResponse(spk_id=request.spk_id)
 
 
 def main():
-    grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_conc), maximum_concurrent_rpcs=args.max_conc)
+    if args.metrics_port > 0:
+        # with --num_workers the model stages run in the workers, only the scheduler metrics are collected here
+        metrics.enable(tracing=args.tracing)
+        metrics_server = ThreadingHTTPServer(('0.0.0.0', args.metrics_port), MetricsHandler)
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+        logging.info('metrics served on 0.0.0.0:{}/metrics'.format(args.metrics_port))
+    # queued rpcs hold a server thread while they wait for the scheduler
+    max_rpcs = args.max_conc + 2 * args.max_queue_size
+    grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=max_rpcs), maximum_concurrent_rpcs=max_rpcs)
     cosyvoice_pb2_grpc.add_CosyVoiceServicer_to_server(CosyVoiceServiceImpl(args), grpcServer)
     grpcServer.add_insecure_port('0.0.0.0:{}'.format(args.port))
     grpcServer.start()
@@ -82,6 +499,31 @@ if __name__ == '__main__':
     parser.add_argument('--max_conc',
                         type=int,
                         default=4)
+    parser.add_argument('--max_queue_size',
+                        type=int,
+                        default=16,
+                        help='number of waiting requests of every priority class')
+    parser.add_argument('--tenant_priorities',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='tenant:priority pairs read from the tenant metadata, priority is interactive or batch')
+    parser.add_argument('--metrics_port',
+                        type=int,
+                        default=0,
+                        help='serve prometheus metrics on this http port, 0 disables metrics')
+    parser.add_argument('--tracing',
+                        action='store_true',
+                        help='emit an opentelemetry span per inference stage, needs opentelemetry installed')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=0,
+                        help='number of model worker processes sharing mmap weights on cpu, their speech is relayed through shared memory, '
+                             '0 serves one model in process')
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=1,
+                        help='torch threads of every worker process')
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice2-0.5B',
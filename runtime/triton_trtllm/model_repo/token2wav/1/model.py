@@ -36,7 +36,7 @@ from torch.nn import functional as F
 import triton_python_backend_utils as pb_utils
 
 from hyperpyyaml import load_hyperpyyaml
-from cosyvoice.utils.common import fade_in_out
+from cosyvoice.utils.common import overlap_add
 from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
 from cosyvoice.utils.common import TrtContextWrapper
 from collections import defaultdict
@@ -90,7 +90,6 @@ class CosyVoice2Model:
         self.token_hop_len = 25
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
-        self.speech_window = np.hamming(2 * self.source_cache_len)
         self.hift_cache_dict = defaultdict(lambda: None)
 
     def load_jit(self, flow_encoder_model):
@@ -145,7 +144,7 @@ class CosyVoice2Model:
         if finalize is False:
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = overlap_add(tts_speech, self.hift_cache_dict[uuid]['speech'], self.source_cache_len)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
                                           'source': tts_source[:, :, -self.source_cache_len:],
                                           'speech': tts_speech[:, -self.source_cache_len:]}
@@ -156,7 +155,7 @@ class CosyVoice2Model:
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = overlap_add(tts_speech, self.hift_cache_dict[uuid]['speech'], self.source_cache_len)
         return tts_speech
 
 
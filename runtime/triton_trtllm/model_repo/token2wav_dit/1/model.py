@@ -108,6 +108,12 @@ class TritonPythonModel:
         responses = []
         # Process each request in batch
         for request in requests:
+            if request.is_cancelled():
+                # release the session caches of an aborted stream right away instead of waiting for the ttl reaper
+                self.token2wav_model.cancel_streaming(request.request_id())
+                responses.append(pb_utils.InferenceResponse(
+                    error=pb_utils.TritonError("request cancelled", pb_utils.TritonError.CANCELLED)))
+                continue
             target_speech_tokens_tensor = pb_utils.get_input_tensor_by_name(request, "target_speech_tokens").as_numpy()
             target_speech_tokens = torch.from_numpy(target_speech_tokens_tensor)
             target_speech_tokens = target_speech_tokens - ORIGINAL_VOCAB_SIZE
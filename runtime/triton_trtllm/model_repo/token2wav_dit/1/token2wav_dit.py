@@ -33,17 +33,7 @@ import queue
 import time
 import numpy as np
 from hyperpyyaml import load_hyperpyyaml
-
-
-def fade_in_out(fade_in_mel: torch.Tensor, fade_out_mel: torch.Tensor, window: torch.Tensor):
-    """perform fade_in_out in tensor style
-    """
-    mel_overlap_len = int(window.shape[0] / 2)
-    fade_in_mel = fade_in_mel.clone()
-    fade_in_mel[..., :mel_overlap_len] = \
-        fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel
+from cosyvoice.utils.common import CacheManager, overlap_add
 
 
 def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, dtype):
@@ -112,7 +102,8 @@ class TrtContextWrapper:
 
 
 class CosyVoice2_Token2Wav(torch.nn.Module):
-    def __init__(self, model_dir: str, enable_trt: bool = False, device_id: int = 0, streaming: bool = False, dtype: torch.dtype = torch.float16):
+    def __init__(self, model_dir: str, enable_trt: bool = False, device_id: int = 0, streaming: bool = False, dtype: torch.dtype = torch.float16,
+                 speaker_cache_bytes: int = 2 << 30, session_ttl: float = 300):
         super().__init__()
         self.device_id = device_id
         self.device = f"cuda:{device_id}"
@@ -162,15 +153,16 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
                 False
             )
 
-        self.streaming_flow_cache = {}
-        self.speaker_cache = {}
+        # speakers are evicted in lru order beyond speaker_cache_bytes, request sessions without a last_chunk
+        # (aborted streams) are reaped after session_ttl seconds, together with their hifigan cache
+        self.streaming_flow_cache = CacheManager(ttl=session_ttl, on_evict=lambda request_id, _: self.hift_cache_dict.pop(request_id, None))
+        self.speaker_cache = CacheManager(max_bytes=speaker_cache_bytes)
 
         self.mel_cache_len = 8  # hard-coded, 160ms
         self.source_cache_len = int(self.mel_cache_len * 480)   # 50hz mel -> 24kHz wave
-        self.speech_window = torch.from_numpy(np.hamming(2 * self.source_cache_len)).cuda()
 
         # hifigan cache for streaming tts
-        self.hift_cache_dict = {}
+        self.hift_cache_dict = CacheManager()
 
     def forward_spk_embedding(self, spk_feat):
         if isinstance(self.spk_model, onnxruntime.InferenceSession):
@@ -386,11 +378,18 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
         # Hack: this is a hack to avoid in-place changes to the cache['estimator_att_cache'] and cache['estimator_cnn_cache']
         return new_cache
 
-    @torch.inference_mode()
-    def forward_streaming(
-        self, generated_speech_tokens: list[int], last_chunk: bool, request_id: str, speaker_id: str, prompt_audio: torch.Tensor = None, prompt_audio_sample_rate: int = 16000
-    ):
-        if speaker_id not in self.speaker_cache:
+    def cancel_streaming(self, request_id: str) -> bool:
+        """release the caches of a request aborted before its last_chunk"""
+        cancelled = self.streaming_flow_cache.cancel(request_id)
+        self.hift_cache_dict.cancel(request_id)
+        return cancelled
+
+    def cache_stats(self) -> dict:
+        return {'speaker': self.speaker_cache.stats(), 'session': self.streaming_flow_cache.stats()}
+
+    def get_speaker_cache(self, speaker_id: str, prompt_audio: torch.Tensor = None, prompt_audio_sample_rate: int = 16000):
+        speaker = self.speaker_cache.get(speaker_id)
+        if speaker is None:
             assert prompt_audio is not None, "prompt_audio is required for new speaker"
             assert prompt_audio_sample_rate == 16000
 
@@ -403,19 +402,28 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
             prompt_audio_dict = {'spk_emb_for_flow': spk_emb_for_flow, 'prompt_mels_for_flow': prompt_mels_for_flow}
 
             cache_dict = self.get_prompt_audio_cache_for_streaming_tts(prompt_speech_tokens_list, prompt_mels_for_flow, prompt_mels_lens_for_flow, spk_emb_for_flow)
-            self.speaker_cache[speaker_id] = {'prompt_audio_dict': prompt_audio_dict, 'cache_dict': cache_dict}
+            speaker = {'prompt_audio_dict': prompt_audio_dict, 'cache_dict': cache_dict}
+            self.speaker_cache[speaker_id] = speaker
+        return speaker
 
+    @torch.inference_mode()
+    def forward_streaming(
+        self, generated_speech_tokens: list[int], last_chunk: bool, request_id: str, speaker_id: str, prompt_audio: torch.Tensor = None, prompt_audio_sample_rate: int = 16000
+    ):
         if request_id not in self.streaming_flow_cache:
-            self.streaming_flow_cache[request_id] = {k: v.clone() for k, v in self.speaker_cache[speaker_id]['cache_dict'].items()}
+            speaker = self.get_speaker_cache(speaker_id, prompt_audio, prompt_audio_sample_rate)
+            self.streaming_flow_cache[request_id] = {k: v.clone() for k, v in speaker['cache_dict'].items()}
+            # keep a reference to the prompt, so that the session survives the eviction of its speaker
             self.hift_cache_dict[request_id] = dict(
                 mel=torch.zeros(1, 80, 0, device='cuda'),
                 source=torch.zeros(1, 1, 0, device='cuda'),
                 speech=torch.zeros(1, 0, device='cuda'),
+                prompt_audio_dict=speaker['prompt_audio_dict'],
             )
 
         current_request_cache = self.streaming_flow_cache[request_id]
 
-        current_prompt_audio_dict = self.speaker_cache[speaker_id]['prompt_audio_dict']
+        current_prompt_audio_dict = self.hift_cache_dict[request_id]['prompt_audio_dict']
         generated_speech_tokens = torch.tensor([generated_speech_tokens], dtype=torch.int32, device='cuda')
 
         chunk_mel, new_streaming_flow_cache = self.flow.inference_chunk(
@@ -443,13 +451,14 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
 
         # overlap speech smooth
         if hift_cache_speech.shape[-1] > 0:
-            speech = fade_in_out(speech, hift_cache_speech, self.speech_window)
+            speech = overlap_add(speech, hift_cache_speech, self.source_cache_len)
 
         # update vocoder cache
         self.hift_cache_dict[request_id] = dict(
             mel=mel[..., -self.mel_cache_len:].clone().detach(),
             source=source[:, :, -self.source_cache_len:].clone().detach(),
             speech=speech[:, -self.source_cache_len:].clone().detach(),
+            prompt_audio_dict=current_prompt_audio_dict,
         )
         if not last_chunk:
             speech = speech[:, :-self.source_cache_len]
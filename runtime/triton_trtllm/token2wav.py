@@ -18,7 +18,8 @@
 """
 import torch
 from flashcosyvoice.modules.flow import CausalMaskedDiffWithXvec
-from flashcosyvoice.modules.hifigan import HiFTGenerator
+from cosyvoice.hifigan.generator import HiFTGenerator
+from cosyvoice.hifigan.f0_predictor import ConvRNNF0Predictor
 from flashcosyvoice.utils.audio import mel_spectrogram
 import torchaudio.compliance.kaldi as kaldi
 import onnxruntime
@@ -91,7 +92,7 @@ class TrtContextWrapper:
 
 
 class CosyVoice2_Token2Wav(torch.nn.Module):
-    def __init__(self, model_dir: str = "./CosyVoice2-0.5B", enable_trt: bool = False, device_id: int = 0):
+    def __init__(self, model_dir: str = "./CosyVoice2-0.5B", enable_trt: bool = False, device_id: int = 0, spk_crop_ratio: float = 0.0):
         super().__init__()
         self.device_id = device_id
         self.device = f"cuda:{device_id}"
@@ -101,7 +102,10 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
         self.flow.load_state_dict(torch.load(f"{model_dir}/flow.pt", map_location="cpu", weights_only=True), strict=True)
         self.flow.to(self.device).eval()
 
-        self.hift = HiFTGenerator()
+        # cosyvoice2 hift, whose inference vocodes a padded batch with lengths
+        self.hift = HiFTGenerator(sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+                                  source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                                  f0_predictor=ConvRNNF0Predictor())
         hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(f"{model_dir}/hift.pt", map_location="cpu", weights_only=True).items()}
         self.hift.load_state_dict(hift_state_dict, strict=True)
         self.hift.to(self.device).eval()
@@ -110,6 +114,14 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         option.intra_op_num_threads = 1
         self.spk_model = onnxruntime.InferenceSession(f"{model_dir}/campplus.onnx", sess_options=option, providers=["CPUExecutionProvider"])
+        # campplus exported with a dynamic batch axis embeds a bucket of prompts in one run, prompts in a bucket are
+        # cropped to the shortest one, spk_crop_ratio bounds how much of a prompt may be cropped, the default 0 only batches
+        # equal lengths, cropping is opt-in, check a ratio with tests/test_spk_crop.py against the campplus.onnx in use
+        self.spk_max_batch_size = 1 if isinstance(self.spk_model.get_inputs()[0].shape[0], int) else 16
+        self.spk_crop_ratio = spk_crop_ratio
+        # resample kernels are cached per sample rate, mel_spectrogram defaults for 24k audio
+        self.resamplers = {}
+        self.mel_n_fft, self.mel_hop_size = 1920, 480
 
         self.audio_tokenizer = s3tokenizer.load_model(f"{model_dir}/speech_tokenizer_v2.onnx").to(self.device).eval()
 
@@ -119,22 +131,23 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
                           f'{model_dir}/flow.decoder.estimator.fp32.dynamic_batch.onnx',
                           1,
                           True)
-            self.load_spk_trt(f'{model_dir}/campplus.{gpu}.fp32.trt',
+            self.load_spk_trt(f'{model_dir}/campplus.{gpu}.fp32.dynamic_batch.trt',
                               f'{model_dir}/campplus.onnx',
                               1,
                               False)
 
     def forward_spk_embedding(self, spk_feat):
+        """spk_feat [B, T, 80] -> B embeddings of 192 floats"""
         if isinstance(self.spk_model, onnxruntime.InferenceSession):
             return self.spk_model.run(
-                None, {self.spk_model.get_inputs()[0].name: spk_feat.unsqueeze(dim=0).cpu().numpy()}
-            )[0].flatten().tolist()
+                None, {self.spk_model.get_inputs()[0].name: spk_feat.cpu().numpy()}
+            )[0].reshape(spk_feat.size(0), -1).tolist()
         else:
             [spk_model, stream], trt_engine = self.spk_model.acquire_estimator()
             # NOTE need to synchronize when switching stream
             with torch.cuda.device(self.device_id):
                 torch.cuda.current_stream().synchronize()
-                spk_feat = spk_feat.unsqueeze(dim=0).to(self.device)
+                spk_feat = spk_feat.to(self.device)
                 batch_size = spk_feat.size(0)
 
                 with stream:
@@ -151,7 +164,7 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
                     torch.cuda.current_stream().synchronize()
                 self.spk_model.release_estimator(spk_model, stream)
 
-            return output_tensor.cpu().numpy().flatten().tolist()
+            return output_tensor.cpu().tolist()
 
     def load_spk_trt(self, spk_model, spk_onnx_model, trt_concurrent=1, fp16=True):
         if not os.path.exists(spk_model) or os.path.getsize(spk_model) == 0:
@@ -165,8 +178,8 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
 
     def get_spk_trt_kwargs(self):
         min_shape = [(1, 4, 80)]
-        opt_shape = [(1, 500, 80)]
-        max_shape = [(1, 3000, 80)]
+        opt_shape = [(min(4, self.spk_max_batch_size), 500, 80)]
+        max_shape = [(self.spk_max_batch_size, 3000, 80)]
         input_names = ["input"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
@@ -205,32 +218,72 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
             prompt_speech_tokens_list.append(speech_tokens_i)
         return prompt_speech_tokens_list
 
-    def get_spk_emb(self, prompt_audios_list: list[torch.Tensor]) -> torch.Tensor:
-        spk_emb_for_flow = []
+    def get_spk_feats(self, prompt_audios_list: list[torch.Tensor], frame_length: int = 400, frame_shift: int = 160) -> list[torch.Tensor]:
+        # without dither and with snip_edges, a kaldi fbank frame only depends on its own samples, so clips concatenated
+        # at frame_shift aligned offsets give exactly the per clip features in a single fbank call
+        chunks, offsets, offset = [], [], 0
         for audio in prompt_audios_list:
             assert len(audio.shape) == 1
-            spk_feat = kaldi.fbank(audio.unsqueeze(0), num_mel_bins=80, dither=0, sample_frequency=16000)
-            spk_feat = spk_feat - spk_feat.mean(dim=0, keepdim=True)
-            spk_emb = self.forward_spk_embedding(spk_feat)
+            assert audio.shape[0] >= frame_length, 'prompt audio shorter than one fbank frame'
+            padded_len = (audio.shape[0] + frame_shift - 1) // frame_shift * frame_shift
+            chunks.append(torch.nn.functional.pad(audio, (0, padded_len - audio.shape[0])))
+            offsets.append(offset)
+            offset += padded_len // frame_shift
+        feats = kaldi.fbank(torch.cat(chunks).unsqueeze(0), num_mel_bins=80, dither=0, sample_frequency=16000,
+                            frame_length=frame_length / 16, frame_shift=frame_shift / 16)
+        spk_feats = []
+        for audio, offset in zip(prompt_audios_list, offsets):
+            spk_feat = feats[offset: offset + 1 + (audio.shape[0] - frame_length) // frame_shift]
+            spk_feats.append(spk_feat - spk_feat.mean(dim=0, keepdim=True))
+        return spk_feats
+
+    def get_spk_buckets(self, spk_feats_lens: list[int]) -> list[list[int]]:
+        buckets = []
+        for i in sorted(range(len(spk_feats_lens)), key=lambda i: spk_feats_lens[i], reverse=True):
+            if len(buckets) == 0 or len(buckets[-1]) == self.spk_max_batch_size or \
+                    spk_feats_lens[i] < (1 - self.spk_crop_ratio) * spk_feats_lens[buckets[-1][0]]:
+                buckets.append([])
+            buckets[-1].append(i)
+        return buckets
 
-            spk_emb_for_flow.append(spk_emb)
+    def get_spk_emb(self, prompt_audios_list: list[torch.Tensor]) -> torch.Tensor:
+        spk_feats = self.get_spk_feats(prompt_audios_list)
+        spk_emb_for_flow = [None] * len(spk_feats)
+        for bucket in self.get_spk_buckets([spk_feat.shape[0] for spk_feat in spk_feats]):
+            # campplus pools statistics over all frames, so a bucket is cropped to its shortest prompt instead of padded
+            min_len = spk_feats[bucket[-1]].shape[0]
+            spk_embs = self.forward_spk_embedding(torch.stack([spk_feats[i][:min_len] for i in bucket]))
+            for i, spk_emb in zip(bucket, spk_embs):
+                spk_emb_for_flow[i] = spk_emb
         spk_emb_for_flow = torch.tensor(spk_emb_for_flow)
         return spk_emb_for_flow
 
+    def get_resampler(self, sample_rate: int) -> torchaudio.transforms.Resample:
+        if sample_rate not in self.resamplers:
+            self.resamplers[sample_rate] = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=24000)
+        return self.resamplers[sample_rate]
+
     def get_prompt_mels(self, prompt_audios_list: list[torch.Tensor], prompt_audios_sample_rate: list[int]):
-        prompt_mels_for_flow = []
+        # resample is a zero padded convolution, so clips of one sample rate are resampled together as a zero padded batch
+        audios = list(prompt_audios_list)
+        for sample_rate in set(prompt_audios_sample_rate) - {24000}:
+            indices = [i for i, rate in enumerate(prompt_audios_sample_rate) if rate == sample_rate]
+            resampled = self.get_resampler(sample_rate)(torch.nn.utils.rnn.pad_sequence([audios[i] for i in indices], batch_first=True))
+            for i, audio in zip(indices, resampled):
+                audios[i] = audio[:(audios[i].shape[0] * 24000 + sample_rate - 1) // sample_rate]
+        # mel_spectrogram reflect pads (n_fft - hop_size) / 2 samples on both sides, append the reflection of every clip
+        # before zero padding them to a batch, so that the valid frames are the same as computing each clip alone
+        pad = (self.mel_n_fft - self.mel_hop_size) // 2
         prompt_mels_lens_for_flow = []
-        for audio, sample_rate in zip(prompt_audios_list, prompt_audios_sample_rate):
+        for i, audio in enumerate(audios):
             assert len(audio.shape) == 1
-            audio = audio.unsqueeze(0)
-            if sample_rate != 24000:
-                audio = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=24000)(audio)
-            mel = mel_spectrogram(audio).transpose(1, 2).squeeze(0)  # [T, num_mels]
-            mel_len = mel.shape[0]
-            prompt_mels_for_flow.append(mel)
-            prompt_mels_lens_for_flow.append(mel_len)
-        prompt_mels_for_flow = torch.nn.utils.rnn.pad_sequence(prompt_mels_for_flow, batch_first=True, padding_value=0)  # [B, T', num_mels=80]
+            prompt_mels_lens_for_flow.append((audio.shape[0] + 2 * pad - self.mel_n_fft) // self.mel_hop_size + 1)
+            audios[i] = torch.nn.functional.pad(audio.view(1, 1, -1), (0, pad), mode='reflect').view(-1)
         prompt_mels_lens_for_flow = torch.tensor(prompt_mels_lens_for_flow)
+        prompt_mels_for_flow = mel_spectrogram(torch.nn.utils.rnn.pad_sequence(audios, batch_first=True)).transpose(1, 2)
+        prompt_mels_for_flow = prompt_mels_for_flow[:, :prompt_mels_lens_for_flow.max()].contiguous()  # [B, T', num_mels=80]
+        pad_mask = torch.arange(prompt_mels_for_flow.shape[1]).unsqueeze(0) >= prompt_mels_lens_for_flow.unsqueeze(1)
+        prompt_mels_for_flow.masked_fill_(pad_mask.unsqueeze(2), 0)
         return prompt_mels_for_flow, prompt_mels_lens_for_flow
 
     def forward_flow(self, prompt_speech_tokens_list: list[list[int]], generated_speech_tokens_list: list[list[int]], prompt_mels_for_flow: torch.Tensor,
@@ -256,11 +309,12 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
 
     def forward_hift(self, generated_mels: torch.Tensor, generated_mels_lens: torch.Tensor, prompt_mels_lens_for_flow: torch.Tensor):
         batch_size = generated_mels.shape[0]
-        generated_wavs = []
-        for i in range(batch_size):
-            mel = generated_mels[i, :, prompt_mels_lens_for_flow[i].item():generated_mels_lens[i].item()].unsqueeze(0)
-            wav, _ = self.hift(speech_feat=mel)
-            generated_wavs.append(wav)
+        mels = [generated_mels[i, :, prompt_mels_lens_for_flow[i].item():generated_mels_lens[i].item()].transpose(0, 1) for i in range(batch_size)]
+        mels_lens = torch.tensor([mel.shape[0] for mel in mels], device=generated_mels.device)
+        mels = torch.nn.utils.rnn.pad_sequence(mels, batch_first=True).transpose(1, 2)
+        wavs, _ = self.hift.inference(speech_feat=mels.float(), speech_feat_lens=mels_lens)
+        wavs_lens = mels_lens * wavs.shape[1] // mels.shape[2]
+        generated_wavs = [wavs[i:i + 1, :wavs_lens[i].item()] for i in range(batch_size)]
         return generated_wavs
 
     @torch.inference_mode()
@@ -303,13 +357,16 @@ def get_args():
     parser.add_argument("--batch-size", type=int, default=4)
     parser.add_argument("--output-dir", type=str, default="generated_wavs")
     parser.add_argument("--huggingface-dataset-split", type=str, default="wenetspeech4tts")
+    parser.add_argument("--spk-crop-ratio", type=float, default=0.0,
+                        help="Max ratio of a prompt cropped to batch it with shorter prompts for speaker embedding, "
+                        "default 0 only batches equal lengths, opt-in after checking the ratio with tests/test_spk_crop.py")
     parser.add_argument("--warmup", type=int, default=3, help="Number of warmup epochs, performance statistics will only be collected from the last epoch")
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = get_args()
-    model = CosyVoice2_Token2Wav(model_dir=args.model_dir, enable_trt=args.enable_trt)
+    model = CosyVoice2_Token2Wav(model_dir=args.model_dir, enable_trt=args.enable_trt, spk_crop_ratio=args.spk_crop_ratio)
     # mkdir output_dir if not exists
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -0,0 +1,93 @@
+"""Every rank yields the same number of batches from the length bucketed sampler after the full processor chain.
+
+    python -m pytest tests/test_bucket_sampler.py
+"""
+import os
+import sys
+from functools import partial
+from io import BytesIO
+
+import pandas as pd
+import torch
+import torch.distributed as dist
+import torchaudio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cosyvoice.dataset import processor  # noqa
+from cosyvoice.dataset.dataset import Dataset  # noqa
+
+SAMPLE_RATE = 16000
+HOP_SIZE = 160
+
+
+class CharTokenizer:
+    def encode(self, text, allowed_special='all'):
+        return [ord(c) for c in text]
+
+
+def make_shards(tmp_path, shard_sizes, seed=0):
+    """parquet shards in the layout of tools/make_parquet_list.py, some utterances are out of the filter limits"""
+    generator = torch.Generator().manual_seed(seed)
+    lists = []
+    for shard, num_utts in enumerate(shard_sizes):
+        rows = []
+        for utt in range(num_utts):
+            # 0.05s is below min_length of the filter and 3s is above max_length
+            duration = [0.05, 3.0][utt % 2] if utt % 7 == 0 else 0.2 + 1.5 * torch.rand(1, generator=generator).item()
+            num_samples = int(duration * SAMPLE_RATE)
+            audio = BytesIO()
+            torchaudio.save(audio, 0.1 * torch.randn(1, num_samples, generator=generator), SAMPLE_RATE, format='wav')
+            rows.append(dict(utt='{}_{}'.format(shard, utt), audio_data=audio.getvalue(), duration=num_samples / SAMPLE_RATE,
+                             text='text of utterance {}'.format(utt), speech_token=list(range(int(duration * 25) + 1)),
+                             utt_embedding=[1.0] * 4, spk_embedding=[1.0] * 4))
+        url = str(tmp_path / 'shard_{}.parquet'.format(shard))
+        pd.DataFrame(rows).to_parquet(url)
+        lists.append(url)
+    data_list_file = tmp_path / 'data.list'
+    data_list_file.write_text('\n'.join(lists) + '\n')
+    return str(data_list_file)
+
+
+def data_pipeline(max_frames_in_batch):
+    feat_extractor = torchaudio.transforms.MelSpectrogram(sample_rate=SAMPLE_RATE, n_fft=400, hop_length=HOP_SIZE, n_mels=20)
+    return [
+        partial(processor.parquet_opener),
+        partial(processor.tokenize, get_tokenizer=CharTokenizer, allowed_special='all'),
+        partial(processor.filter, max_length=200, min_length=10),
+        partial(processor.resample, resample_rate=SAMPLE_RATE),
+        partial(processor.compute_fbank, feat_extractor=feat_extractor),
+        partial(processor.parse_embedding, normalize=True),
+        # a lower frame rate than the features have, planned batches must still not be split
+        partial(processor.bucket_batch, max_frames_in_batch=max_frames_in_batch, feat_frame_rate=SAMPLE_RATE / HOP_SIZE * 0.8, drop_uneven=True),
+        partial(processor.padding, use_spk_embedding=False),
+    ]
+
+
+def count_batches(monkeypatch, data_list_file, rank, world_size, epoch, max_frames_in_batch):
+    monkeypatch.setattr(dist, 'is_initialized', lambda: True)
+    monkeypatch.setattr(dist, 'get_rank', lambda: rank)
+    monkeypatch.setattr(dist, 'get_world_size', lambda: world_size)
+    dataset = Dataset(data_list_file, data_pipeline(max_frames_in_batch), mode='train', shuffle=True, partition=True)
+    dataset.set_epoch(epoch)
+    num_batches, utts = 0, []
+    for batch in dataset:
+        num_batches += 1
+        utts.extend(batch['utts'])
+    return num_batches, utts
+
+
+def test_same_number_of_batches_on_every_rank(tmp_path, monkeypatch):
+    data_list_file = make_shards(tmp_path, [9, 23, 4, 16, 30])
+    world_size = 3
+    for epoch in range(3):
+        for max_frames_in_batch in [200, 600]:
+            counts, utts = [], []
+            for rank in range(world_size):
+                num_batches, rank_utts = count_batches(monkeypatch, data_list_file, rank, world_size, epoch, max_frames_in_batch)
+                counts.append(num_batches)
+                utts.extend(rank_utts)
+            assert counts[0] > 0
+            assert counts == [counts[0]] * world_size, (epoch, max_frames_in_batch, counts)
+            # utterances out of the filter limits are not trained on, the rest is trained on at most once
+            assert len(utts) == len(set(utts))
+            assert all(int(utt.split('_')[1]) % 7 != 0 for utt in utts)
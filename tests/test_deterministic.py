@@ -0,0 +1,43 @@
+"""With deterministic set, the same speech tokens give the same waveform in every run, streamed or not.
+
+    python -m pytest tests/test_deterministic.py
+"""
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'third_party/Matcha-TTS'))
+from benchmarks.tiny_model import SPEECH_TOKEN_SIZE, make_model_input, make_tiny_model  # noqa
+from cosyvoice.hifigan.generator import SourceModuleHnNSF  # noqa
+
+
+def synthesize(model, model_input, source_speech_token, stream):
+    # voice conversion takes the speech tokens as they are, no llm sampling is involved
+    model_input = {k: v for k, v in model_input.items() if k not in ['text', 'prompt_text', 'llm_prompt_speech_token', 'llm_embedding']}
+    return torch.concat([i['tts_speech'] for i in model.tts(**model_input, source_speech_token=source_speech_token, stream=stream)], dim=1)
+
+
+def test_same_waveform_in_every_run():
+    model = make_tiny_model()
+    model.hift.remove_weight_norm()
+    model_input = make_model_input(num_prompt_speech_tokens=40)
+    source_speech_token = torch.randint(0, SPEECH_TOKEN_SIZE, (1, 120), dtype=torch.int32)
+    for stream in [False, True]:
+        model.set_deterministic(False)
+        assert not torch.equal(synthesize(model, model_input, source_speech_token, stream),
+                               synthesize(model, model_input, source_speech_token, stream))
+        model.set_deterministic(True)
+        assert torch.equal(synthesize(model, model_input, source_speech_token, stream),
+                           synthesize(model, model_input, source_speech_token, stream))
+
+
+def test_same_source_in_every_run():
+    # CosyVoice1 vocodes 22050Hz with SineGen, which also draws the initial phases of the harmonics
+    for sinegen_type in ['1', '2']:
+        m_source = SourceModuleHnNSF(sampling_rate=22050, upsample_scale=256, harmonic_num=8, sinegen_type=sinegen_type).eval()
+        m_source.set_deterministic(True)
+        f0 = torch.from_numpy(np.linspace(100, 300, 50 * 256, dtype=np.float32)).view(1, -1, 1)
+        assert torch.equal(m_source(f0)[0], m_source(f0)[0])
@@ -0,0 +1,99 @@
+"""The CosyVoice1 llm decodes the same speech tokens with the in place chunk caches as with the concatenated ones.
+
+    python tests/test_llm_cache.py
+"""
+import os
+import sys
+from functools import partial
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'third_party/Matcha-TTS'))
+from cosyvoice.llm.llm import TransformerLM  # noqa
+from cosyvoice.transformer.encoder import ConformerEncoder, TransformerEncoder  # noqa
+from cosyvoice.utils.common import ras_sampling  # noqa
+
+
+class ConcatCacheEncoder(torch.nn.Module):
+    """only exposes forward_chunk, like a jit model exported before forward_chunk_inplace"""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward_chunk(self, *args, **kwargs):
+        return self.encoder.forward_chunk(*args, **kwargs)
+
+
+def make_tiny_llm(use_sdpa=False):
+    # examples/libritts/cosyvoice/conf/cosyvoice.yaml scaled down
+    text_encoder = ConformerEncoder(input_size=64, output_size=64, attention_heads=4, linear_units=128, num_blocks=1,
+                                    input_layer='linear', pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                                    use_cnn_module=False, macaron_style=False, static_chunk_size=1)
+    llm = TransformerEncoder(input_size=64, output_size=64, attention_heads=4, linear_units=128, num_blocks=3,
+                             input_layer='linear_legacy', pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                             static_chunk_size=1, use_sdpa=use_sdpa)
+    return TransformerLM(text_encoder_input_size=64, llm_input_size=64, llm_output_size=64, text_token_size=100, speech_token_size=50,
+                         text_encoder=text_encoder, llm=llm, sampling=partial(ras_sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1),
+                         spk_embed_dim=192).eval()
+
+
+def decode(model, seed=0):
+    torch.manual_seed(seed)
+    text = torch.randint(0, 100, (1, 20), dtype=torch.int32)
+    prompt_text = torch.randint(0, 100, (1, 5), dtype=torch.int32)
+    prompt_speech_token = torch.randint(0, 50, (1, 10), dtype=torch.int32)
+    with torch.inference_mode():
+        return list(model.inference(text=text, text_len=torch.tensor([20], dtype=torch.int32),
+                                    prompt_text=prompt_text, prompt_text_len=torch.tensor([5], dtype=torch.int32),
+                                    prompt_speech_token=prompt_speech_token, prompt_speech_token_len=torch.tensor([10], dtype=torch.int32),
+                                    embedding=torch.randn(1, 192), min_token_text_ratio=2, max_token_text_ratio=4))
+
+
+def check_same_tokens(use_sdpa):
+    torch.manual_seed(0)
+    model = make_tiny_llm(use_sdpa)
+    tokens = decode(model)
+    encoder = model.llm
+    model.llm = ConcatCacheEncoder(encoder)
+    ref_tokens = decode(model)
+    model.llm = torch.jit.script(encoder)
+    jit_tokens = decode(model)
+    assert len(tokens) >= 40, len(tokens)
+    assert tokens == ref_tokens, (tokens, ref_tokens)
+    assert jit_tokens == ref_tokens, (jit_tokens, ref_tokens)
+
+
+def test_same_tokens():
+    check_same_tokens(use_sdpa=False)
+
+
+def test_same_tokens_sdpa():
+    check_same_tokens(use_sdpa=True)
+
+
+def test_forward_chunk_inplace_conformer():
+    # a causal conformer also carries a cnn cache between chunks
+    torch.manual_seed(0)
+    encoder = ConformerEncoder(input_size=32, output_size=32, attention_heads=2, linear_units=64, num_blocks=2, input_layer='linear',
+                               pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn', use_cnn_module=True,
+                               cnn_module_kernel=5, causal=True).eval()
+    xs = torch.randn(1, 30, 32)
+    with torch.inference_mode():
+        ys, att_cache, cnn_cache = encoder.forward_chunk(xs[:, :10], 0, -1)
+        ref_ys, ref_att_cache, ref_cnn_cache = ys, att_cache, cnn_cache
+        att_cache = torch.concat([att_cache, att_cache.new_zeros(att_cache.size(0), att_cache.size(1), 20, att_cache.size(3))], dim=2)
+        for offset in range(10, 30, 5):
+            ref_ys, ref_att_cache, ref_cnn_cache = encoder.forward_chunk(xs[:, offset:offset + 5], offset, -1, ref_att_cache, ref_cnn_cache)
+            ys = encoder.forward_chunk_inplace(xs[:, offset:offset + 5], offset, att_cache, cnn_cache)
+            assert torch.allclose(ys, ref_ys, atol=1e-6)
+            assert torch.equal(cnn_cache, ref_cnn_cache)
+        assert torch.allclose(att_cache, ref_att_cache, atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_same_tokens()
+    test_same_tokens_sdpa()
+    test_forward_chunk_inplace_conformer()
+    print('ok')
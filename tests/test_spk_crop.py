@@ -0,0 +1,72 @@
+"""Speaker embeddings of prompts embedded in one campplus batch cropped by spk_crop_ratio stay close to the embeddings
+of every prompt alone.
+
+    COSYVOICE2_MODEL_DIR=pretrained_models/CosyVoice2-0.5B SPK_CROP_RATIO=0.05 python -m pytest tests/test_spk_crop.py
+
+The runtime only batches equal lengths by default, run the test against the campplus.onnx in use before opting in to a
+ratio with --spk-crop-ratio. The test needs the requirements of runtime/triton_trtllm and campplus.onnx of a CosyVoice2 model dir.
+"""
+import inspect
+import os
+import sys
+
+import pytest
+import torch
+import torchaudio
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'runtime/triton_trtllm'))
+MODEL_DIR = os.environ.get('COSYVOICE2_MODEL_DIR', os.path.join(ROOT_DIR, 'pretrained_models/CosyVoice2-0.5B'))
+# min cosine similarity of a cropped embedding with the embedding of the whole prompt
+MIN_SIMILARITY = 0.98
+SPK_CROP_RATIO = float(os.environ.get('SPK_CROP_RATIO', '0.05'))
+
+for module in ['onnxruntime', 'flashcosyvoice', 's3tokenizer', 'datasets']:
+    pytest.importorskip(module)
+if not os.path.exists(os.path.join(MODEL_DIR, 'campplus.onnx')):
+    pytest.skip('campplus.onnx not found in {}'.format(MODEL_DIR), allow_module_level=True)
+import onnxruntime  # noqa
+from token2wav import CosyVoice2_Token2Wav  # noqa
+
+
+def make_spk_model(spk_crop_ratio):
+    # only the speaker embedding frontend, without loading the flow and hift of the model dir
+    model = CosyVoice2_Token2Wav.__new__(CosyVoice2_Token2Wav)
+    torch.nn.Module.__init__(model)
+    model.spk_model = onnxruntime.InferenceSession(os.path.join(MODEL_DIR, 'campplus.onnx'), providers=['CPUExecutionProvider'])
+    model.spk_max_batch_size = 1 if isinstance(model.spk_model.get_inputs()[0].shape[0], int) else 16
+    model.spk_crop_ratio = spk_crop_ratio
+    return model
+
+
+def load_prompts():
+    prompts = []
+    for name in ['zero_shot_prompt.wav', 'cross_lingual_prompt.wav']:
+        speech, sample_rate = torchaudio.load(os.path.join(ROOT_DIR, 'asset', name))
+        speech = torchaudio.transforms.Resample(sample_rate, 16000)(speech.mean(dim=0))
+        # lengths at most 5% apart land in one bucket and are cropped to the shortest of them
+        for seconds in [3.0, 2.95, 2.9, 2.86]:
+            prompts.append(speech[:int(seconds * 16000)])
+    return prompts
+
+
+def test_cropping_is_opt_in():
+    assert inspect.signature(CosyVoice2_Token2Wav).parameters['spk_crop_ratio'].default == 0.0
+    model = make_spk_model(0.0)
+    model.spk_max_batch_size = 16
+    # without cropping only prompts of equal lengths share a bucket
+    assert model.get_spk_buckets([300, 290, 300, 299]) == [[0, 2], [3], [1]]
+
+
+def test_cropped_embeddings_within_tolerance():
+    model = make_spk_model(SPK_CROP_RATIO)
+    if model.spk_max_batch_size == 1:
+        pytest.skip('campplus.onnx has a static batch axis, prompts are not batched')
+    prompts = load_prompts()
+    buckets = model.get_spk_buckets([spk_feat.shape[0] for spk_feat in model.get_spk_feats(prompts)])
+    assert len(buckets) < len(prompts), buckets
+    batched = model.get_spk_emb(prompts)
+    alone = torch.cat([model.get_spk_emb([prompt]) for prompt in prompts])
+    similarity = torch.nn.functional.cosine_similarity(batched, alone, dim=1)
+    assert similarity.min().item() >= MIN_SIMILARITY, similarity.tolist()
@@ -21,6 +21,7 @@ import pandas as pd
 import multiprocessing
 import time
 import torch
+import torchaudio
 
 
 def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
@@ -30,6 +31,11 @@ def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
         data = open(utt2wav[utt], 'rb').read()
         data_list.append(data)
     wav_list = [utt2wav[utt] for utt in utt_list]
+    # utterance duration, used by LengthBucketSampler to plan batches without decoding audio
+    duration_list = []
+    for utt in utt_list:
+        info = torchaudio.info(utt2wav[utt])
+        duration_list.append(info.num_frames / info.sample_rate)
     text_list = [utt2text[utt] for utt in utt_list]
     spk_list = [utt2spk[utt] for utt in utt_list]
     uttembedding_list = [utt2embedding[utt] for utt in utt_list]
@@ -45,6 +51,7 @@ def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
     df['utt'] = utt_list
     df['wav'] = wav_list
     df['audio_data'] = data_list
+    df['duration'] = duration_list
     df['text'] = text_list
     df['spk'] = spk_list
     df['utt_embedding'] = uttembedding_list